@@ -0,0 +1,128 @@
+"""Runs an operation on many repositories at once, for scheduled jobs.
+
+'wit batch OPERATION REPO...' runs status, add, commit or log on every
+repository through the Repository API, all in a single process. An asyncio
+loop schedules the repositories and their blocking file I/O runs in a
+thread pool of CONCURRENCY workers, so at most CONCURRENCY repositories are
+worked on at a time. An optional bandwidth cap, see the iolimit module, is
+shared by all of them.
+
+The results are aggregated into one JSON report, with one entry per
+repository in the given order. A repository which fails is reported and
+does not stop the others. Paths inside the same repository are run once:
+the repository locks would only make the second run wait for the first,
+then repeat its work, or for a commit find nothing left to commit.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import iolimit
+import wit
+from repository import Repository
+
+
+DEFAULT_CONCURRENCY: int = 8
+
+Operation = Callable[[Repository, Dict[str, Any]], Dict[str, Any]]
+
+
+def _status(repository: Repository, options: Dict[str, Any]) -> Dict[str, Any]:
+    return repository.status()._asdict()
+
+
+def _add(repository: Repository, options: Dict[str, Any]) -> Dict[str, Any]:
+    return {'staged': repository.add(add_all=True)}
+
+
+def _commit(repository: Repository, options: Dict[str, Any]) -> Dict[str, Any]:
+    return {'commit_id': repository.commit(options['message'])}
+
+
+def _log(repository: Repository, options: Dict[str, Any]) -> Dict[str, Any]:
+    return {'commits': [entry._asdict() for entry in repository.log(limit=options.get('limit'))]}
+
+
+OPERATIONS: Dict[str, Operation] = {
+    'status': _status,
+    'add': _add,
+    'commit': _commit,
+    'log': _log,
+}
+
+
+def run_repository(path: str, operation: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    """Runs an operation on a repository, and returns its report entry."""
+    start = time.perf_counter()
+    entry: Dict[str, Any] = {'path': path}
+    try:
+        result = OPERATIONS[operation](Repository(path), options)
+    except wit.WitError as error:
+        entry.update(ok=False, error=str(error))
+    except Exception as error:  # A broken repository does not stop the batch.
+        entry.update(ok=False, error=f"{type(error).__name__}: {error}")
+    else:
+        entry.update(ok=True, result=result)
+    entry['seconds'] = round(time.perf_counter() - start, 6)
+    return entry
+
+
+async def run_all(paths: List[str], operation: str, options: Dict[str, Any],
+                  concurrency: int) -> List[Dict[str, Any]]:
+    """Runs an operation on all the repositories, at most concurrency at a time."""
+    loop = asyncio.get_running_loop()
+    entries: Dict[int, Dict[str, Any]] = {}
+    scheduled = []
+    repositories: Dict[str, str] = {}
+    for position, path in enumerate(paths):
+        backup_folder = wit.find_directory(path)
+        key = os.path.realpath(backup_folder) if backup_folder is not None else path
+        if key in repositories:
+            entries[position] = {'path': path, 'ok': False, 'error': f"Same repository as {repositories[key]}."}
+            continue
+        repositories[key] = path
+        scheduled.append(position)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, run_repository, paths[position], operation, options)
+            for position in scheduled
+        ))
+    entries.update(zip(scheduled, results))
+    return [entries[position] for position in range(len(paths))]
+
+
+def run_batch(paths: List[str], operation: str, options: Optional[Dict[str, Any]] = None,
+              concurrency: int = DEFAULT_CONCURRENCY,
+              bandwidth: Optional[int] = None) -> Dict[str, Any]:
+    """Runs an operation on many repositories and returns the JSON report.
+
+    Args:
+        paths (list): Paths inside the repositories.
+        operation (str): One of OPERATIONS.
+        options (dict, optional): The operation options, 'message' for commit and 'limit' for log.
+        concurrency (int, optional): The number of repositories worked on at a time.
+        bandwidth (int, optional): The I/O cap in bytes per second, shared by all the repositories.
+    Returns:
+        dict: The report, with the results of every repository in the given order.
+    """
+    if operation not in OPERATIONS:
+        raise wit.WitError(f"The batch operation should be one of: {', '.join(OPERATIONS)}.")
+    start = time.perf_counter()
+    iolimit.set_limit(bandwidth)
+    try:
+        entries = asyncio.run(run_all(paths, operation, options or {}, max(1, concurrency)))
+    finally:
+        iolimit.set_limit(None)
+    failed = sum(not entry['ok'] for entry in entries)
+    return {
+        'operation': operation,
+        'concurrency': concurrency,
+        'bandwidth': bandwidth,
+        'seconds': round(time.perf_counter() - start, 6),
+        'repositories': len(entries),
+        'succeeded': len(entries) - failed,
+        'failed': failed,
+        'results': entries,
+    }
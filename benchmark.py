@@ -0,0 +1,301 @@
+"""Benchmark suite for wit commands on synthetic repositories.
+
+Generates a repository in a temporary directory, then times every wit
+command through the Repository API and prints a JSON report with the wall
+time, the bytes read and written and the peak RSS of each run. The peak
+RSS is reset before every run, so it is measured on Linux only, and is
+null elsewhere. A command which fails stops the benchmark, so the report
+never times failures.
+
+With '--startup', it measures the cold start of a single command instead:
+it runs wit in fresh interpreters on a small clean repository, fails if the
+best time is over the budget, and reports the slowest imports as measured
+by 'python -X importtime'.
+
+Usage:
+    python benchmark.py --files 10000 --depth 4 --commits 20 --branches 3
+    python benchmark.py --startup --command status --budget-ms 150
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import workers
+from repository import Repository
+
+
+DATA_DIR: str = 'data'
+WIT_SCRIPT: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wit.py')
+
+
+def io_counters() -> Dict[str, Optional[int]]:
+    """Returns the bytes this process read and wrote so far, on Linux."""
+    counters: Dict[str, Optional[int]] = {'rchar': None, 'wchar': None}
+    try:
+        with open('/proc/self/io', 'r') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def reset_peak_rss() -> bool:
+    """Lowers the peak RSS of this process to its current RSS, returns False if it is not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')  # Resets VmHWM, since Linux 4.0.
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_kb() -> Optional[int]:
+    """Returns the peak resident set size of this process in KB since the last reset, on Linux."""
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Recorder:
+    """Runs wit commands and records a measurement for each one."""
+
+    def __init__(self) -> None:
+        self.runs: List[Dict[str, Any]] = []
+
+    def run(self, command: str, operation: Callable[..., Any], *args: Any) -> Any:
+        """Times a Repository operation and returns its result, errors are not caught."""
+        # ru_maxrss is the peak of the whole process, so the peak is reset for each run instead.
+        peak_reset = reset_peak_rss()
+        before = io_counters()
+        start = time.perf_counter()
+        result = operation(*args)
+        wall_time = time.perf_counter() - start
+        after = io_counters()
+        self.runs.append({
+            'command': command,
+            'wall_time': wall_time,
+            'bytes_read': None if before['rchar'] is None else after['rchar'] - before['rchar'],
+            'bytes_written': None if before['wchar'] is None else after['wchar'] - before['wchar'],
+            'peak_rss_kb': peak_rss_kb() if peak_reset else None,
+        })
+        return result
+
+    def commit(self, repository: Repository, message: str) -> str:
+        """Times a commit, which must record changes."""
+        commit_id = self.run('commit', repository.commit, message)
+        if commit_id is None:
+            raise RuntimeError(f"The commit '{message}' found nothing to commit.")
+        return commit_id
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Aggregates the runs by command."""
+        summary: Dict[str, Dict[str, Any]] = {}
+        for item in self.runs:
+            stats = summary.setdefault(item['command'], {
+                'runs': 0, 'total_wall_time': 0.0, 'max_wall_time': 0.0,
+                'bytes_read': 0, 'bytes_written': 0, 'peak_rss_kb': 0,
+            })
+            stats['runs'] += 1
+            stats['total_wall_time'] += item['wall_time']
+            stats['max_wall_time'] = max(stats['max_wall_time'], item['wall_time'])
+            stats['bytes_read'] += item['bytes_read'] or 0
+            stats['bytes_written'] += item['bytes_written'] or 0
+            stats['peak_rss_kb'] = max(stats['peak_rss_kb'], item['peak_rss_kb'] or 0)
+        for stats in summary.values():
+            stats['mean_wall_time'] = stats['total_wall_time'] / stats['runs']
+        return summary
+
+
+def file_size(rng: random.Random, options: argparse.Namespace) -> int:
+    """Draws a file size, log-uniformly between the minimum and maximum sizes."""
+    low = max(1, options.min_size)
+    return int(low * (options.max_size / low) ** rng.random())
+
+
+def generate_files(root: str, rng: random.Random, options: argparse.Namespace) -> List[str]:
+    """Creates the synthetic working tree files and returns their relative paths."""
+    files = []
+    for number in range(options.files):
+        depth = rng.randint(0, options.depth)
+        dirs = [f'd{rng.randrange(options.fanout)}' for _ in range(depth)]
+        relative_path = os.path.join(DATA_DIR, *dirs, f'f{number}.bin')
+        write_file(os.path.join(root, relative_path), rng, file_size(rng, options))
+        files.append(relative_path)
+    return files
+
+
+def write_file(path: str, rng: random.Random, size: int) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(rng.randbytes(size))
+
+
+def modify_files(root: str, files: List[str], rng: random.Random, options: argparse.Namespace) -> None:
+    """Rewrites a fraction of the files, as a new revision would."""
+    count = max(1, int(len(files) * options.change_ratio))
+    for relative_path in rng.sample(files, min(count, len(files))):
+        write_file(os.path.join(root, relative_path), rng, file_size(rng, options))
+
+
+def run_benchmark(options: argparse.Namespace) -> Dict[str, Any]:
+    """Builds a synthetic repository, runs all the commands on it and returns the report.
+
+    Branches and master modify disjoint halves of the files, so every merge
+    is a clean three-way merge of two real commits.
+    """
+    rng = random.Random(options.seed)
+    root = tempfile.mkdtemp(prefix='wit-benchmark-')
+    recorder = Recorder()
+    try:
+        files = generate_files(root, rng, options)
+        master_files, branch_files = files[0::2] or files, files[1::2] or files
+        repository = recorder.run('init', Repository.init, root)
+        recorder.run('add', repository.add, DATA_DIR)
+        recorder.commit(repository, 'initial')
+        recorder.run('status', repository.status)
+
+        for number in range(options.commits):
+            modify_files(root, files, rng, options)
+            recorder.run('status', repository.status)
+            recorder.run('add', repository.add, DATA_DIR)
+            recorder.commit(repository, f'revision {number}')
+
+        for number in range(options.branches):
+            name = f'branch{number}'
+            recorder.run('branch', repository.branch, name)
+            recorder.run('checkout', repository.checkout, name)
+            modify_files(root, branch_files, rng, options)
+            recorder.run('add', repository.add, DATA_DIR)
+            recorder.commit(repository, f'{name} change')
+            recorder.run('checkout', repository.checkout, 'master')
+            modify_files(root, master_files, rng, options)
+            recorder.run('add', repository.add, DATA_DIR)
+            recorder.commit(repository, f'master change {number}')
+            result = recorder.run('merge', repository.merge, name)
+            if result.commit_id is None:
+                raise RuntimeError(f"The merge of {name} failed, conflicts: {result.conflicts}")
+        recorder.run('status', repository.status)
+        recorder.run('log', repository.log)
+    finally:
+        if not options.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'parameters': vars(options),
+        'repository': root if options.keep else None,
+        'summary': recorder.summary(),
+        'runs': recorder.runs,
+    }
+
+
+def parse_importtime(output: str) -> List[Dict[str, Any]]:
+    """Parses 'python -X importtime' lines into (module, self, cumulative) microseconds."""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, module = line[len('import time:'):].split('|')
+        imports.append({
+            'module': module.strip(),
+            'self_us': int(self_time),
+            'cumulative_us': int(cumulative),
+        })
+    return imports
+
+
+def run_startup_benchmark(options: argparse.Namespace) -> Dict[str, Any]:
+    """Times a command in fresh interpreters and reports its slowest imports."""
+    root = tempfile.mkdtemp(prefix='wit-startup-')
+    try:
+        rng = random.Random(options.seed)
+        for number in range(options.files):
+            write_file(os.path.join(root, DATA_DIR, f'f{number}.bin'), rng, options.min_size)
+        repository = Repository.init(root)
+        repository.add(DATA_DIR)
+        repository.commit('initial')
+
+        command = [sys.executable, WIT_SCRIPT, *options.command.split()]
+        wall_times = []
+        for _ in range(options.repeat):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=root, stdout=subprocess.DEVNULL, check=True)
+            wall_times.append(time.perf_counter() - start)
+        traced = subprocess.run(
+            [sys.executable, '-X', 'importtime', *command[1:]], cwd=root,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    imports = parse_importtime(traced.stderr)
+    best_ms = min(wall_times) * 1000
+    return {
+        'command': options.command,
+        'best_ms': best_ms,
+        'median_ms': statistics.median(wall_times) * 1000,
+        'budget_ms': options.budget_ms,
+        'within_budget': best_ms <= options.budget_ms,
+        'total_import_us': sum(item['self_us'] for item in imports),
+        'slowest_imports': sorted(imports, key=lambda item: item['self_us'], reverse=True)[:options.top],
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=1000, help='number of files in the working tree')
+    parser.add_argument('--min-size', type=int, default=128, help='minimum file size in bytes')
+    parser.add_argument('--max-size', type=int, default=64 * 1024, help='maximum file size in bytes')
+    parser.add_argument('--depth', type=int, default=3, help='maximum directory depth')
+    parser.add_argument('--fanout', type=int, default=8, help='sub-directories per directory')
+    parser.add_argument('--commits', type=int, default=5, help='number of linear commits')
+    parser.add_argument('--branches', type=int, default=2, help='number of branches merged back')
+    parser.add_argument('--change-ratio', type=float, default=0.05, help='files changed per revision')
+    parser.add_argument('--jobs', type=int, default=None, help='number of workers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report to a file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep the generated repository')
+    startup = parser.add_argument_group('startup benchmark')
+    startup.add_argument('--startup', action='store_true', help='measure the cold start of a command')
+    startup.add_argument('--command', default='status', help='the command to start, such "status"')
+    startup.add_argument('--repeat', type=int, default=10, help='number of timed runs')
+    startup.add_argument('--budget-ms', type=float, default=150.0, help='maximum best run time')
+    startup.add_argument('--top', type=int, default=15, help='number of imports to report')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    options = parse_args(argv)
+    if options.jobs is not None:
+        workers.set_jobs(options.jobs)
+    if options.startup:
+        report = run_startup_benchmark(options)
+    else:
+        report = run_benchmark(options)
+    output = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    if options.startup and not report['within_budget']:
+        sys.exit(1)
+    return None
+
+
+if __name__ == '__main__':
+    main()
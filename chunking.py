@@ -0,0 +1,69 @@
+"""Content-defined chunking of large files.
+
+Large files are split into chunks whose boundaries depend on the bytes
+around them instead of their offsets, so an edit only changes the chunks
+it touches and the following boundaries are found again as before.
+
+Cut points are chosen as in FastCDC: no cut before MIN_SIZE, a strict mask
+up to AVERAGE_SIZE and a looser one after it, which keeps the chunk sizes
+close to the average, and a forced cut at MAX_SIZE. To keep this fast in
+Python, the rolling hash is only evaluated at candidate positions, after
+the newlines found by 'bytes.find', where the hash of the preceding window
+decides if the position is a cut point. Newlines give text files regular
+candidates and are as common as any other byte in binary data.
+"""
+import re
+import zlib
+from typing import BinaryIO, Iterator, Union
+
+
+CHUNKING_THRESHOLD: int = 32 * 1024 * 1024
+MIN_SIZE: int = 256 * 1024
+AVERAGE_SIZE: int = 1024 * 1024
+MAX_SIZE: int = 4 * 1024 * 1024
+READ_SIZE: int = 1024 * 1024
+WINDOW_SIZE: int = 48
+
+_NEWLINES = re.compile(b'\n+')
+_STRICT_MASK: int = (1 << 12) - 1
+_LOOSE_MASK: int = (1 << 9) - 1
+
+
+def cut_point(data: Union[bytes, bytearray], length: int) -> int:
+    """Returns the size of the first chunk of data.
+
+    Args:
+        data (bytes): The data to split, at least MAX_SIZE bytes unless it is the end of the file.
+        length (int): The number of bytes of data to consider.
+    Returns:
+        int: The chunk size.
+    """
+    if length <= MIN_SIZE:
+        return length
+    end = min(length, MAX_SIZE)
+    normal = min(end, AVERAGE_SIZE)
+    position = data.find(b'\n', MIN_SIZE, end)
+    while position != -1:
+        # Only the end of a run of newlines is a candidate.
+        position = _NEWLINES.match(data, position, end).end()
+        mask = _STRICT_MASK if position < normal else _LOOSE_MASK
+        if not zlib.crc32(data[position - WINDOW_SIZE:position]) & mask:
+            return position
+        position = data.find(b'\n', position, end)
+    return end
+
+
+def iter_chunks(file: BinaryIO) -> Iterator[bytes]:
+    """Yields the chunks of a file, holding at most MAX_SIZE + READ_SIZE bytes in memory."""
+    buffer = bytearray()
+    end_of_file = False
+    while True:
+        while not end_of_file and len(buffer) < MAX_SIZE:
+            block = file.read(READ_SIZE)
+            end_of_file = not block
+            buffer += block
+        if not buffer:
+            return
+        size = cut_point(buffer, len(buffer))
+        yield bytes(buffer[:size])
+        del buffer[:size]
@@ -0,0 +1,193 @@
+"""Serialized commit graph for fast history walks.
+
+The '.wit/commit-graph' file holds one line per commit, parents first:
+    <commit id> <generation> <timestamp> <parent positions separated by ',' or '-'>
+A commit generation is 1 + the highest generation of its parents, so an
+ancestor always has a lower generation than its descendants.
+"""
+import heapq
+import os
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import storage
+
+
+COMMIT_GRAPH_FILE: str = 'commit-graph'
+
+# Gets a commit id, returns its parent ids and its timestamp.
+CommitReader = Callable[[str], Tuple[List[str], int]]
+
+
+class CommitGraph(NamedTuple):
+    ids: List[str]
+    positions: Dict[str, int]
+    parents: List[List[int]]
+    generations: List[int]
+    timestamps: List[int]
+
+
+def _graph_path(backup_folder: str) -> str:
+    return os.path.join(backup_folder, COMMIT_GRAPH_FILE)
+
+
+def read_graph(backup_folder: str) -> Optional[CommitGraph]:
+    """Returns the commit graph, or None if there is no commit graph file."""
+    graph = CommitGraph([], {}, [], [], [])
+    try:
+        with open(_graph_path(backup_folder), 'r') as file:
+            for line in file:
+                commit_id, generation, timestamp, parents = line.split()
+                graph.positions[commit_id] = len(graph.ids)
+                graph.ids.append(commit_id)
+                graph.generations.append(int(generation))
+                graph.timestamps.append(int(timestamp))
+                graph.parents.append(
+                    [] if parents == '-' else [int(p) for p in parents.split(',')])
+    except FileNotFoundError:
+        return None
+    return graph
+
+
+def init_graph(backup_folder: str) -> None:
+    """Creates an empty commit graph file."""
+    with open(_graph_path(backup_folder), 'w'):
+        pass
+    return None
+
+
+def _format_line(graph: CommitGraph, position: int) -> str:
+    parents = ','.join(str(p) for p in graph.parents[position]) or '-'
+    return (
+        f"{graph.ids[position]} {graph.generations[position]} "
+        + f"{graph.timestamps[position]} {parents}\n"
+    )
+
+
+def _append(graph: CommitGraph, commit_id: str, parents: Iterable[str], timestamp: int) -> int:
+    """Adds a commit to an in-memory graph and returns its position."""
+    parent_positions = [graph.positions[p] for p in parents if p in graph.positions]
+    generation = 1 + max((graph.generations[p] for p in parent_positions), default=0)
+    graph.positions[commit_id] = len(graph.ids)
+    graph.ids.append(commit_id)
+    graph.parents.append(parent_positions)
+    graph.generations.append(generation)
+    graph.timestamps.append(timestamp)
+    return graph.positions[commit_id]
+
+
+def add_commit(backup_folder: str, commit_id: str, parents: Iterable[str], timestamp: int,
+               graph: Optional[CommitGraph] = None) -> None:
+    """Appends a new commit to the commit graph file.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        commit_id (str): The new commit id.
+        parents (iterable): The parents commit ids.
+        timestamp (int): The commit time in seconds since the epoch.
+        graph (CommitGraph, optional): The already loaded graph.
+    Returns:
+        None.
+    """
+    if graph is None:
+        graph = read_graph(backup_folder)
+    if graph is None:
+        return None  # The graph will be rebuilt including this commit when it is needed.
+    if commit_id in graph.positions:
+        return None  # An identical commit was already made.
+    parents = list(parents)
+    if any(p not in graph.positions for p in parents):
+        # The graph is missing older commits, so it is dropped and rebuilt when needed.
+        os.remove(_graph_path(backup_folder))
+        return None
+    position = _append(graph, commit_id, parents, timestamp)
+    with open(_graph_path(backup_folder), 'a') as file:
+        file.write(_format_line(graph, position))
+    return None
+
+
+def rebuild_graph(backup_folder: str, commit_ids: Iterable[str], read_commit: CommitReader) -> CommitGraph:
+    """Builds the commit graph from the commits metadata and writes it."""
+    commits = {commit_id: read_commit(commit_id) for commit_id in commit_ids}
+    graph = CommitGraph([], {}, [], [], [])
+    for start in sorted(commits):
+        stack = [start]
+        while stack:
+            commit_id = stack[-1]
+            if commit_id in graph.positions:
+                stack.pop()
+                continue
+            missing = [
+                p for p in commits[commit_id][0]
+                if p in commits and p not in graph.positions
+            ]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            _append(graph, commit_id, *commits[commit_id])
+
+    with storage.replacing(_graph_path(backup_folder)) as file:
+        for position in range(len(graph.ids)):
+            file.write(_format_line(graph, position))
+    return graph
+
+
+def merge_base(graph: CommitGraph, commit1: str, commit2: str) -> Optional[str]:
+    """Returns the nearest common ancestor of two commits.
+
+    Commits are visited from the highest generation down, so every commit
+    is reached by all its descendants before it is visited. The first
+    commit reached from both sides is therefore the common ancestor with
+    the highest generation, and the walk stops there.
+    """
+    first, second = graph.positions[commit1], graph.positions[commit2]
+    if first == second:
+        return commit1
+    flags = {first: 1, second: 2}
+    queue = [
+        (-graph.generations[p], -graph.timestamps[p], p) for p in (first, second)
+    ]
+    heapq.heapify(queue)
+    while queue:
+        _, _, position = heapq.heappop(queue)
+        flag = flags[position]
+        if flag == 3:
+            return graph.ids[position]
+        for parent in graph.parents[position]:
+            if parent not in flags:
+                flags[parent] = 0
+                heapq.heappush(
+                    queue, (-graph.generations[parent], -graph.timestamps[parent], parent))
+            flags[parent] |= flag
+    return None
+
+
+def walk(graph: CommitGraph, commit_ids: Iterable[str], first_parent: bool = False) -> Iterator[int]:
+    """Yields the positions of some commits and their ancestors, lazily and once each.
+
+    With first_parent, only the first parent of every commit is followed.
+    Otherwise commits are yielded from the highest generation down, which
+    is a topological order: a commit always comes after all its
+    descendants, and commits of the same generation come newest first.
+    """
+    starts = [graph.positions[commit_id] for commit_id in commit_ids]
+    seen = set(starts)
+    if first_parent:
+        for position in starts:
+            yield position
+            parents = graph.parents[position]
+            while parents and parents[0] not in seen:
+                seen.add(parents[0])
+                yield parents[0]
+                parents = graph.parents[parents[0]]
+        return
+    queue = [(-graph.generations[p], -graph.timestamps[p], p) for p in seen]
+    heapq.heapify(queue)
+    while queue:
+        _, _, position = heapq.heappop(queue)
+        yield position
+        for parent in graph.parents[position]:
+            if parent not in seen:
+                seen.add(parent)
+                heapq.heappush(
+                    queue, (-graph.generations[parent], -graph.timestamps[parent], parent))
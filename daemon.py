@@ -0,0 +1,434 @@
+"""Filesystem watcher daemon which keeps the working tree status ready.
+
+The daemon keeps the stat data of every working tree file in memory and
+updates it from inotify events, so answering a status request does not
+walk the tree. Only the files whose stat data differs from their index
+entry are hashed, and their hashes are cached by stat data. Pending events
+are read before every answer, so changes which completed before a request
+are always part of its answer.
+
+Where inotify is not available, the daemon rescans the tree every
+POLL_INTERVAL seconds instead. Such answers may miss the latest changes,
+so they are marked as not exact and commands which must not lose changes
+(checkout, merge) scan the tree themselves.
+
+Clients talk to the daemon through a Unix socket in the '.wit' directory,
+with one JSON request and one JSON answer per connection. Without a
+running daemon, 'request' returns None and the caller scans the tree.
+"""
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import ignore
+import index
+import objectstore
+import sparse
+import workers
+
+
+SOCKET_FILE: str = 'daemon.sock'
+POLL_INTERVAL: float = 1.0
+CLIENT_TIMEOUT: float = 5.0
+
+# inotify constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+DIRECTORY_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+Prune = Callable[[str, os.DirEntry], bool]
+
+
+def socket_path(backup_folder: str) -> str:
+    return os.path.join(backup_folder, SOCKET_FILE)
+
+
+class Inotify:
+    """A minimal inotify binding through ctypes."""
+
+    def __init__(self) -> None:
+        import ctypes
+        import ctypes.util
+        import struct
+
+        self._header = struct.Struct('iIII')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path: str) -> int:
+        import ctypes
+
+        watch = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if watch < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        return watch
+
+    def read_events(self) -> List[Tuple[int, int, str]]:
+        """Returns all the pending (watch, mask, name) events without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            position = 0
+            while position < len(data):
+                watch, mask, _, length = self._header.unpack_from(data, position)
+                position += self._header.size
+                name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+                position += length
+                events.append((watch, mask, name))
+
+    def close(self) -> None:
+        os.close(self.fd)
+        return None
+
+
+class WorkingTree:
+    """In-memory stat data of the working tree files, by directory."""
+
+    def __init__(self, root: str, prune: Optional[Prune] = None,
+                 on_directory: Optional[Callable[[str], None]] = None) -> None:
+        self.root = root
+        self.prune = prune
+        self.on_directory = on_directory
+        self.files: Dict[str, Dict[str, os.stat_result]] = {}
+        self.subdirs: Dict[str, Set[str]] = {}
+
+    def load(self, relative_dir: str = '') -> None:
+        """Reads a directory and everything under it."""
+        stack = [relative_dir]
+        while stack:
+            directory = stack.pop()
+            if self.on_directory is not None:
+                # Watching first, so changes made while reading are not missed.
+                self.on_directory(directory)
+            stack.extend(self.sync_directory(directory))
+        return None
+
+    def forget(self, relative_dir: str) -> None:
+        """Drops a directory and everything under it."""
+        stack = [relative_dir]
+        while stack:
+            directory = stack.pop()
+            self.files.pop(directory, None)
+            stack.extend(os.path.join(directory, name) for name in self.subdirs.pop(directory, ()))
+        return None
+
+    def sync_directory(self, relative_dir: str) -> List[str]:
+        """Reads the entries of a single directory again.
+
+        Returns:
+            list: The new sub-directories, which are not read yet.
+        """
+        try:
+            entries = list(os.scandir(os.path.join(self.root, relative_dir)))
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget(relative_dir)
+            return []
+        files = {}
+        subdirs = set()
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            if self.prune is not None and self.prune(relative_path, entry):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.name)
+                else:
+                    files[entry.name] = entry.stat()
+            except FileNotFoundError:
+                continue
+        old_subdirs = self.subdirs.get(relative_dir, set())
+        for name in old_subdirs - subdirs:
+            self.forget(os.path.join(relative_dir, name))
+        self.files[relative_dir] = files
+        self.subdirs[relative_dir] = subdirs
+        return [os.path.join(relative_dir, name) for name in subdirs - old_subdirs]
+
+    def refresh_file(self, relative_dir: str, name: str) -> bool:
+        """Reads the stat data of a known file again.
+
+        Returns:
+            bool: False if the file is gone, and its directory should be synced.
+        """
+        try:
+            self.files[relative_dir][name] = os.stat(os.path.join(self.root, relative_dir, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def items(self):
+        for relative_dir, files in self.files.items():
+            for name, stat in files.items():
+                yield os.path.join(relative_dir, name), stat
+
+
+class Daemon:
+    """Serves status requests for a single repository."""
+
+    def __init__(self, backup_folder: str, prune: Optional[Prune] = None) -> None:
+        self.backup_folder = backup_folder
+        self.root = os.path.dirname(backup_folder)
+        self.inotify: Optional[Inotify] = None
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError):
+            pass
+        self.watches: Dict[int, str] = {}
+        self.base_prune = prune
+        self.rules = ignore.load_rules(backup_folder, cache=False)
+        self.selection = sparse.load_sparse(backup_folder)
+        self.rules_key = self._rules_key()
+        self.tree = WorkingTree(self.root, self._prune, self._watch if self.inotify else None)
+        self.hashes: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+        self.index_key: Optional[Tuple[int, int, int]] = None
+        self.entries: Dict[str, index.IndexEntry] = {}
+        self.last_scan = 0.0
+        self.running = True
+
+    def _watch(self, relative_dir: str) -> None:
+        try:
+            watch = self.inotify.add_watch(os.path.join(self.root, relative_dir))
+        except OSError:
+            return None
+        self.watches[watch] = relative_dir
+        return None
+
+    def _prune(self, relative_path: str, entry: os.DirEntry) -> bool:
+        if self.base_prune is not None and self.base_prune(relative_path, entry):
+            return True
+        return self.selection.prune(relative_path, entry) or self.rules.prune(relative_path, entry)
+
+    def _rules_key(self) -> Tuple[Optional[Tuple[int, int, int]], ...]:
+        """Returns the stat data of the ignore and the sparse checkout files."""
+        keys = []
+        for path in (os.path.join(self.root, ignore.IGNORE_FILE), sparse.sparse_path(self.backup_folder)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                keys.append(None)
+            else:
+                keys.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(keys)
+
+    def rescan(self) -> None:
+        self.tree.forget('')
+        self.tree.load('')
+        self.last_scan = time.monotonic()
+        return None
+
+    def process_events(self) -> None:
+        """Applies the pending inotify events on the in-memory tree."""
+        if self.inotify is None:
+            return None
+        dirty_dirs: Set[str] = set()
+        dirty_files: Set[Tuple[str, str]] = set()
+        for watch, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.rescan()
+                return None
+            relative_dir = self.watches.get(watch)
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+            if relative_dir is None or relative_dir not in self.tree.files:
+                continue
+            if mask & (DIRECTORY_EVENTS | IN_DELETE_SELF | IN_MOVE_SELF) or not name:
+                dirty_dirs.add(relative_dir)
+            elif name in self.tree.files[relative_dir]:
+                dirty_files.add((relative_dir, name))
+            else:
+                dirty_dirs.add(relative_dir)
+        for relative_dir, name in dirty_files:
+            if relative_dir not in dirty_dirs and not self.tree.refresh_file(relative_dir, name):
+                dirty_dirs.add(relative_dir)
+        for relative_dir in sorted(dirty_dirs):
+            if relative_dir in self.tree.files:
+                for new_dir in self.tree.sync_directory(relative_dir):
+                    self.tree.load(new_dir)
+        return None
+
+    def _load_index(self) -> Dict[str, index.IndexEntry]:
+        """Returns the index entries, reading the index again only when it was replaced."""
+        try:
+            stat = os.stat(os.path.join(self.backup_folder, index.INDEX_FILE))
+        except FileNotFoundError:
+            return {}
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if key != self.index_key:
+            self.entries = index.read_index(self.backup_folder) or {}
+            self.index_key = key
+        return self.entries
+
+    def _hash(self, relative_path: str, stat: os.stat_result) -> Optional[str]:
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self.hashes.get(relative_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            object_id = objectstore.hash_file(os.path.join(self.root, relative_path))
+        except FileNotFoundError:
+            return None
+        self.hashes[relative_path] = (key, object_id)
+        return object_id
+
+    def status(self) -> Dict[str, Any]:
+        """Returns the modified and the untracked files, as the working tree scan does."""
+        self.process_events()
+        rules_key = self._rules_key()
+        if rules_key != self.rules_key:
+            self.rules = ignore.load_rules(self.backup_folder, cache=False)
+            self.selection = sparse.load_sparse(self.backup_folder)
+            self.rules_key = rules_key
+            self.rescan()
+        entries = self._load_index()
+        modified, untracked, candidates = [], [], []
+        seen = set()
+        for relative_path, stat in self.tree.items():
+            entry = entries.get(relative_path)
+            if entry is None:
+                untracked.append(relative_path)
+                continue
+            seen.add(relative_path)
+            if not index.is_stat_unchanged(entry, stat):
+                candidates.append((relative_path, stat))
+        for relative_path in entries.keys() - seen:
+            if not self.selection.includes(relative_path):
+                continue
+            # Ignored files stay tracked once they were added, they are checked one by one.
+            try:
+                stat = os.stat(os.path.join(self.root, relative_path))
+            except (FileNotFoundError, NotADirectoryError):
+                stat = None
+            if stat is None or not self.rules.is_path_ignored(relative_path):
+                modified.append(relative_path)
+            elif not index.is_stat_unchanged(entries[relative_path], stat):
+                candidates.append((relative_path, stat))
+        object_ids = workers.imap(lambda item: self._hash(*item), candidates)
+        for (relative_path, _), object_id in zip(candidates, object_ids):
+            if object_id != entries[relative_path].object_id:
+                modified.append(relative_path)
+        return {
+            'modified': sorted(modified),
+            'untracked': sorted(untracked),
+            'exact': self.inotify is not None,
+        }
+
+    def handle(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        command = message.get('command')
+        if command == 'status':
+            return self.status()
+        if command == 'stop':
+            self.running = False
+            return {'stopped': True}
+        if command == 'ping':
+            return {
+                'pid': os.getpid(),
+                'mode': 'inotify' if self.inotify is not None else 'polling',
+                'files': sum(len(files) for files in self.tree.files.values()),
+            }
+        return {'error': f'unknown command: {command}'}
+
+    def serve(self) -> None:
+        """Answers requests until a stop request."""
+        import select
+        import socket
+
+        path = socket_path(self.backup_folder)
+        if os.path.exists(path):
+            if request(self.backup_folder, {'command': 'ping'}) is not None:
+                raise RuntimeError('A daemon is already running for this repository.')
+            os.remove(path)
+        self.rescan()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        readers = [server] + ([self.inotify.fd] if self.inotify is not None else [])
+        try:
+            while self.running:
+                timeout = None if self.inotify is not None else POLL_INTERVAL
+                ready, _, _ = select.select(readers, [], [], timeout)
+                if self.inotify is not None and self.inotify.fd in ready:
+                    self.process_events()
+                if self.inotify is None and time.monotonic() - self.last_scan >= POLL_INTERVAL:
+                    self.rescan()
+                if server in ready:
+                    connection, _ = server.accept()
+                    with connection:
+                        self._answer(connection)
+        finally:
+            server.close()
+            os.remove(path)
+            if self.inotify is not None:
+                self.inotify.close()
+        return None
+
+    def _answer(self, connection) -> None:
+        import json
+
+        connection.settimeout(CLIENT_TIMEOUT)
+        with connection.makefile('rwb') as stream:
+            try:
+                message = json.loads(stream.readline())
+            except (OSError, ValueError):
+                return None
+            stream.write(json.dumps(self.handle(message)).encode() + b'\n')
+        return None
+
+
+def request(backup_folder: str, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Sends a request to the repository daemon.
+
+    Returns:
+        dict: The answer, or None if no daemon is running.
+    """
+    path = socket_path(backup_folder)
+    if not os.path.exists(path):
+        return None
+    # Imported here, commands only pay for them when a daemon is running.
+    import json
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(CLIENT_TIMEOUT)
+            connection.connect(path)
+            with connection.makefile('rwb') as stream:
+                stream.write(json.dumps(message).encode() + b'\n')
+                stream.flush()
+                return json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def query_status(backup_folder: str, exact: bool = True) -> Optional[Tuple[List[str], List[str]]]:
+    """Returns the modified and the untracked files from the daemon.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        exact (bool, optional): Only accept answers which include all the changes so far.
+    Returns:
+        tuple: The modified and the untracked files, or None if the tree should be scanned.
+    """
+    answer = request(backup_folder, {'command': 'status'})
+    if answer is None or 'modified' not in answer or (exact and not answer.get('exact')):
+        return None
+    return answer['modified'], answer['untracked']
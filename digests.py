@@ -0,0 +1,112 @@
+"""Persistent cache of the content hashes of large working tree files.
+
+Large files are hashed again whenever their stat data does not match the
+index: a modified file which is not staged is read by every 'status', and
+'add' reads all the files it is given. The sha1 of every file of at least
+MIN_SIZE bytes is cached in '.wit/digest-cache', keyed by its
+(device, inode, size, mtime_ns), so an unchanged large file costs one stat
+in the next runs, whether it is tracked or not.
+
+Files modified in the last RACY_SECONDS may change again within the same
+mtime, they are hashed but not cached. The cache keeps the MAX_ENTRIES
+most recently hashed files.
+"""
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import objectstore
+import storage
+import tracing
+
+
+CACHE_FILE: str = 'digest-cache'
+MIN_SIZE: int = 1024 * 1024
+RACY_SECONDS: float = 2.0
+MAX_ENTRIES: int = 4096
+
+Key = Tuple[int, int, int, int]
+
+
+def file_key(stat: os.stat_result) -> Key:
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def same_version(stat: os.stat_result, other: os.stat_result) -> bool:
+    """Check if two stat results have the same size and mtime, as a file and its copies do."""
+    return stat.st_size == other.st_size and stat.st_mtime_ns == other.st_mtime_ns
+
+
+class DigestCache:
+    """The cached digests of a repository, loaded on the first large file."""
+
+    def __init__(self, cache_path: Optional[str]) -> None:
+        self.cache_path = cache_path
+        self._digests: Optional[Dict[Key, str]] = None
+        self._changed = False
+
+    def _load(self) -> Dict[Key, str]:
+        digests: Dict[Key, str] = {}
+        if self.cache_path is not None:
+            try:
+                with open(self.cache_path, 'r') as file:
+                    for line in file:
+                        dev, inode, size, mtime_ns, object_id = line.split()
+                        digests[(int(dev), int(inode), int(size), int(mtime_ns))] = object_id
+            except (OSError, ValueError):
+                digests = {}
+        return digests
+
+    def digest(self, path: str, stat: Optional[os.stat_result] = None,
+               content_path: Optional[str] = None) -> str:
+        """Return the sha1 hex digest of a file content, from the cache when it is unchanged.
+
+        A digest is only cached when the file still has the given stat data
+        after it was read, so a file written meanwhile is never cached with
+        the content of another version.
+
+        Args:
+            path (str): The file path.
+            stat (os.stat_result, optional): The file stat data, if the caller already has it.
+            content_path (str, optional): A copy of the file made after stat was taken, such
+                                          as its staged copy, which is read instead of path.
+                                          It is only trusted with the cached digest of path
+                                          if it has the same size and mtime.
+        """
+        if stat is None:
+            stat = os.stat(path)
+        content_path = content_path or path
+        if stat.st_size < MIN_SIZE:
+            return objectstore.hash_file(content_path)
+        if content_path != path and not same_version(os.stat(content_path), stat):
+            return objectstore.hash_file(content_path)
+        if self._digests is None:
+            # Workers may load it twice at first, a lost entry only costs a hash in the next run.
+            self._digests = self._load()
+        key = file_key(stat)
+        object_id = self._digests.get(key)
+        if object_id is not None:
+            tracing.count('digest_cache_hits')
+            return object_id
+        object_id = objectstore.hash_file(content_path)
+        if (stat.st_mtime_ns < (time.time() - RACY_SECONDS) * 1e9
+                and same_version(os.stat(content_path), stat)):
+            self._digests[key] = object_id
+            self._changed = True
+        return object_id
+
+    def save(self) -> None:
+        """Writes the digests hashed in this run into the cache."""
+        if self.cache_path is None or not self._changed:
+            return None
+        digests = list(self._digests.items())[-MAX_ENTRIES:]
+        with storage.replacing(self.cache_path) as file:
+            for (dev, inode, size, mtime_ns), object_id in digests:
+                file.write(f'{dev} {inode} {size} {mtime_ns} {object_id}\n')
+        self._changed = False
+        return None
+
+
+def load_cache(backup_folder: str) -> DigestCache:
+    """Returns the digest cache of a repository."""
+    return DigestCache(os.path.join(backup_folder, CACHE_FILE))
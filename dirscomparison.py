@@ -1,20 +1,149 @@
 # Reupload
-import filecmp
 import os
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import digests
+import tracing
+import workers
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+BUFFER_SIZE = 1024 * 1024
 
 
 def differentiate(path):
     """Returns dict indicate directories and files in a given path."""
     files = {'path': path, 'dirs': [], 'files': []}
-    list_dir = os.listdir(path)
-    for file in list_dir:
-        if os.path.isdir(os.path.join(path, file)):
-            files['dirs'].append(file)
-        else:
-            files['files'].append(file)
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                files['dirs'].append(entry.name)
+            else:
+                files['files'].append(entry.name)
     return files
 
 
+def scan(path: str) -> Dict[str, os.DirEntry]:
+    """Returns the entries of a directory by name, or an empty dict if it is missing."""
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        return {}
+
+
+def walk_files(root: str, prune: Optional[Callable[[str, os.DirEntry], bool]] = None,
+               prefix: str = '') -> Iterator[Tuple[str, os.DirEntry]]:
+    """Yields (relative path, entry) for every file under a given directory.
+
+    The walk uses an explicit stack instead of recursion, and the yielded
+    entries keep their cached stat results.
+
+    Args:
+        root (str): Directory to walk.
+        prune (callable, optional): Gets (relative path, entry) and returns True
+                                    for entries which should be skipped.
+        prefix (str, optional): Prefix for the yielded relative paths.
+    """
+    stack = [(root, prefix)]
+    while stack:
+        directory, relative_dir = stack.pop()
+        entries = scan(directory)
+        tracing.count('directories_scanned')
+        tracing.count('entries_scanned', len(entries))
+        for name in sorted(entries, reverse=True):
+            entry = entries[name]
+            relative_path = os.path.join(relative_dir, name)
+            if prune is not None and prune(relative_path, entry):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, relative_path))
+            else:
+                yield relative_path, entry
+
+
+def same_content(path1: str, path2: str) -> bool:
+    """Check if two files of the same size have the same content."""
+    with open(path1, 'rb') as file1, open(path2, 'rb') as file2:
+        while True:
+            block1 = file1.read(BUFFER_SIZE)
+            if block1 != file2.read(BUFFER_SIZE):
+                return False
+            if not block1:
+                return True
+
+
+def same_file(path1: str, path2: str, cache: Optional[digests.DigestCache] = None) -> bool:
+    """Check if two files have the same content, starting by their sizes.
+
+    With a digest cache, large files are compared by their cached digests,
+    so comparing unchanged files again costs a stat each.
+    """
+    stat1 = os.stat(path1)
+    stat2 = os.stat(path2)
+    if stat1.st_size != stat2.st_size:
+        return False
+    if cache is not None and stat1.st_size >= digests.MIN_SIZE:
+        return cache.digest(path1, stat1) == cache.digest(path2, stat2)
+    return same_content(path1, path2)
+
+
+def diff_trees(dir1: str, dir2: str,
+               prune: Optional[Callable[[str, os.DirEntry], bool]] = None) -> Iterator[Tuple[str, str]]:
+    """Yields (change, relative path) for every file which differs between two directories.
+
+    Changes are relative to dir1: ADDED files are only in dir2, REMOVED files
+    are only in dir1 and MODIFIED files are in both with a different content.
+    """
+    stack = [('', dir1, dir2)]
+    while stack:
+        relative_dir, path1, path2 = stack.pop()
+        entries1 = scan(path1)
+        entries2 = scan(path2)
+        subdirs = []
+        candidates = []
+        for name in sorted(entries1.keys() | entries2.keys()):
+            relative_path = os.path.join(relative_dir, name)
+            entry1 = entries1.get(name)
+            entry2 = entries2.get(name)
+            if prune is not None and prune(relative_path, entry1 or entry2):
+                continue
+            is_dir1 = entry1 is not None and entry1.is_dir(follow_symlinks=False)
+            is_dir2 = entry2 is not None and entry2.is_dir(follow_symlinks=False)
+            if is_dir1 and is_dir2:
+                subdirs.append((relative_path, entry1.path, entry2.path))
+                continue
+            if entry1 is not None and entry2 is not None and not is_dir1 and not is_dir2:
+                if entry1.stat().st_size != entry2.stat().st_size:
+                    yield MODIFIED, relative_path
+                else:
+                    candidates.append((relative_path, entry1.path, entry2.path))
+                continue
+            if entry1 is not None:
+                if is_dir1:
+                    for file, _ in walk_files(entry1.path, prune, relative_path):
+                        yield REMOVED, file
+                else:
+                    yield REMOVED, relative_path
+            if entry2 is not None:
+                if is_dir2:
+                    for file, _ in walk_files(entry2.path, prune, relative_path):
+                        yield ADDED, file
+                else:
+                    yield ADDED, relative_path
+        results = workers.run(
+            same_content,
+            (path1 for _, path1, _ in candidates),
+            (path2 for _, _, path2 in candidates),
+        )
+        for (relative_path, _, _), is_same in zip(candidates, results):
+            if not is_same:
+                yield MODIFIED, relative_path
+        stack.extend(reversed(subdirs))
+
+
 def get_report(report):
     for key, value in report.items():
         print(f"{key.upper()}:")
@@ -26,9 +155,11 @@ def get_report(report):
     print("-" * 70)
 
 
-def dirs_comparison(*args):
+def dirs_comparison(*args, cache=None):
     """Function compare between two given directories.
 
+    Common files are compared by same_file, 'cache' is an optional digest cache.
+
     The function returns a dictionart 'report' indicates the comperison results.
     report dict attributes:
         'dits': Indicates the paths of the full path of the given directories.
@@ -61,11 +192,12 @@ def dirs_comparison(*args):
     set2 = set(dirs_contents[1]['files'])
     report['diffrent_files'] = set1.difference(
         set2).union(set2. difference(set1))
-    common_files_to_check = set1.intersection(set2)
-    for file in common_files_to_check:
-        file1 = os.path.join(dirs_contents[0]['path'], file)
-        file2 = os.path.join(dirs_contents[1]['path'], file)
-        if filecmp.cmp(file1, file2):
+    common_files_to_check = sorted(set1.intersection(set2))
+    files1 = [os.path.join(dirs_contents[0]['path'], file) for file in common_files_to_check]
+    files2 = [os.path.join(dirs_contents[1]['path'], file) for file in common_files_to_check]
+    results = workers.run(lambda file1, file2: same_file(file1, file2, cache), files1, files2)
+    for file, file1, file2, is_equal in zip(common_files_to_check, files1, files2, results):
+        if is_equal:
             report['common_files'].update({file})
         else:
             report['diffrent_files'].update({file1, file2})
@@ -78,15 +210,12 @@ def deep_comparison(dir1, dir2, getreport=None):
     """Recursively checks whether two directories are equal.
 
     The function checks all directories and subdirectories.
+    The returned report lists the added, removed and modified relative paths.
     """
-    report = dirs_comparison(dir1, dir2)
+    report = {'dirs': [dir1, dir2], ADDED: [], REMOVED: [], MODIFIED: [], 'equal': None}
+    for change, relative_path in diff_trees(dir1, dir2):
+        report[change].append(relative_path)
+    report['equal'] = not (report[ADDED] or report[REMOVED] or report[MODIFIED])
     if getreport is not None:
         get_report(report)
-    if not report['equal']:
-        return [False, report]
-    if len(report['common_dirs']) == 0:
-        return [True, report]
-    for d in report['common_dirs']:
-        dir1 = os.path.join(dir1, d)
-        dir2 = os.path.join(dir2, d)
-        return deep_comparison(dir1, dir2, getreport=getreport)
+    return [report['equal'], report]
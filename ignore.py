@@ -0,0 +1,181 @@
+"""Ignore rules, read from the '.witignore' file of the repository root.
+
+One pattern per line, as in '.gitignore':
+    - blank lines and lines starting with '#' are skipped,
+    - '!' negates a pattern, the last matching pattern wins,
+    - a trailing '/' only matches directories,
+    - a pattern with a '/' before its end is relative to the root,
+      otherwise it matches a name at any depth,
+    - '*' and '?' do not match '/', '**' matches any number of directories.
+All the patterns are compiled once into a single regular expression, and
+walks prune ignored directories, so they are never read.
+
+The ignored names of every directory are cached in '.wit/ignore-cache',
+keyed by the directory mtime and the rules, so unchanged directories skip
+the matching in the next runs.
+"""
+import hashlib
+import os
+import re
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import storage
+
+
+IGNORE_FILE: str = '.witignore'
+CACHE_FILE: str = 'ignore-cache'
+# Directories changed this recently may change again within the same mtime, they are not cached.
+RACY_SECONDS: float = 2.0
+
+
+def translate(pattern: str) -> Tuple[str, bool]:
+    """Returns the regular expression of a pattern, and True if it is negated.
+
+    The expression matches '/' separated relative paths, with a trailing '/' for directories.
+    """
+    negated = pattern.startswith('!')
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\'):
+        pattern = pattern[1:]
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            content = pattern[i + 1:end]
+            if content.startswith('!'):
+                content = '^' + content[1:]
+            regex += '[' + content.replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    prefix = '' if anchored else '(?:.*/)?'
+    suffix = '/' if directory_only else '/?'
+    return prefix + regex + suffix, negated
+
+
+class IgnoreRules:
+    """Compiled ignore patterns, with the per-directory cache of their results."""
+
+    def __init__(self, root: str, patterns: List[str], cache_path: Optional[str] = None) -> None:
+        self.root = root
+        self.cache_path = cache_path
+        self.digest = hashlib.sha1('\n'.join(patterns).encode()).hexdigest()
+        translated = [translate(pattern) for pattern in reversed(patterns)]
+        # Alternatives are tried in order, so the patterns are reversed and the first group that matches is the last pattern.
+        self.regex = re.compile('|'.join(f'({regex})' for regex, _ in translated)) if translated else None
+        self.negated = [negated for _, negated in translated]
+        self._cached: Dict[str, Tuple[int, Set[str]]] = {}
+        self._directories: Dict[str, Tuple[int, Set[str], bool]] = {}
+        if self.regex is not None and cache_path is not None:
+            self._load_cache()
+
+    def is_ignored(self, relative_path: str, is_dir: bool) -> bool:
+        """Check if a path is ignored by the patterns themselves."""
+        if self.regex is None:
+            return False
+        path = relative_path.replace(os.sep, '/') + ('/' if is_dir else '')
+        match = self.regex.fullmatch(path)
+        return match is not None and not self.negated[match.lastindex - 1]
+
+    def is_path_ignored(self, relative_path: str) -> bool:
+        """Check if a file is ignored, or is inside an ignored directory."""
+        if self.regex is None:
+            return False
+        parts = relative_path.split(os.sep)
+        return any(
+            self.is_ignored(os.sep.join(parts[:end]), is_dir=end < len(parts))
+            for end in range(1, len(parts) + 1)
+        )
+
+    def prune(self, relative_path: str, entry: os.DirEntry) -> bool:
+        """Prune callback for directory walks, see dirscomparison.walk_files."""
+        if self.regex is None:
+            return False
+        directory, name = os.path.split(relative_path)
+        state = self._directories.get(directory)
+        if state is None:
+            mtime = os.stat(os.path.join(self.root, directory)).st_mtime_ns
+            cached = self._cached.get(directory)
+            if cached is not None and cached[0] == mtime:
+                state = (mtime, cached[1], True)
+            else:
+                state = (mtime, set(), False)
+            self._directories[directory] = state
+        _, names, from_cache = state
+        if from_cache:
+            return name in names
+        if self.is_ignored(relative_path, entry.is_dir(follow_symlinks=False)):
+            names.add(name)
+            return True
+        return False
+
+    def _load_cache(self) -> None:
+        try:
+            with open(self.cache_path, 'r') as file:
+                if file.readline().strip() != self.digest:
+                    return None
+                for line in file:
+                    mtime, directory, *names = line.rstrip('\n').split('\0')
+                    self._cached[directory] = (int(mtime), set(names))
+        except (OSError, ValueError):
+            self._cached = {}
+        return None
+
+    def save_cache(self) -> None:
+        """Writes the results of the directories matched in this run into the cache."""
+        computed = {
+            directory: (mtime, names)
+            for directory, (mtime, names, from_cache) in self._directories.items()
+            if not from_cache
+        }
+        if self.cache_path is None or not computed:
+            return None
+        racy = (time.time() - RACY_SECONDS) * 1e9
+        self._cached.update(
+            (directory, state) for directory, state in computed.items() if state[0] < racy)
+        with storage.replacing(self.cache_path) as file:
+            file.write(self.digest + '\n')
+            for directory, (mtime, names) in self._cached.items():
+                file.write('\0'.join([str(mtime), directory, *sorted(names)]) + '\n')
+        return None
+
+
+def read_patterns(root: str) -> List[str]:
+    """Returns the patterns of the '.witignore' file of a directory."""
+    try:
+        with open(os.path.join(root, IGNORE_FILE), 'r') as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [
+        line.rstrip() for line in lines
+        if line.strip() and not line.startswith('#')
+    ]
+
+
+def load_rules(backup_folder: str, cache: bool = True) -> IgnoreRules:
+    """Returns the ignore rules of a repository."""
+    root = os.path.dirname(backup_folder)
+    cache_path = os.path.join(backup_folder, CACHE_FILE) if cache else None
+    return IgnoreRules(root, read_patterns(root), cache_path)
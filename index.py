@@ -0,0 +1,91 @@
+"""Stat-cached index of the wit staging area.
+
+The index keeps one entry per staged file with the size, mtime and inode of
+the working tree file it was staged from, and the staged content hash.
+A working tree file whose stat data still matches its entry is known to be
+unchanged without reading its content.
+
+A file modified in the last RACY_SECONDS before the index is written may
+be written again within the same mtime, so its entry is written without
+stat data and the file is hashed by the next commands, until it is older.
+"""
+import os
+import time
+from typing import Dict, NamedTuple, Optional
+
+import objectstore
+import storage
+import tracing
+
+
+INDEX_FILE: str = 'index'
+# Files changed this recently may change again within the same mtime, their stat data is not kept.
+RACY_SECONDS: float = 2.0
+
+
+class IndexEntry(NamedTuple):
+    object_id: str
+    size: int = -1
+    mtime_ns: int = -1
+    inode: int = -1
+
+
+def make_entry(object_id: str, stat: Optional[os.stat_result] = None) -> IndexEntry:
+    """Creates an index entry, without stat data if stat is not given."""
+    if stat is None:
+        return IndexEntry(object_id)
+    return IndexEntry(object_id, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def is_stat_unchanged(entry: IndexEntry, stat: os.stat_result) -> bool:
+    """Check if a file stat data matches the one recorded in the index."""
+    return (
+        entry.size == stat.st_size
+        and entry.mtime_ns == stat.st_mtime_ns
+        and entry.inode == stat.st_ino
+    )
+
+
+def read_index(backup_folder: str) -> Optional[Dict[str, IndexEntry]]:
+    """Returns the index entries by relative path, or None if there is no index."""
+    index_path = os.path.join(backup_folder, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+    entries = {}
+    with tracing.span('index.read'), open(index_path, 'r') as file:
+        for line in file:
+            header, _, relative_path = line.rstrip('\n').partition('\t')
+            object_id, size, mtime_ns, inode = header.split(' ')
+            entries[relative_path] = IndexEntry(
+                object_id, int(size), int(mtime_ns), int(inode))
+    return entries
+
+
+def write_index(backup_folder: str, entries: Dict[str, IndexEntry]) -> None:
+    """Writes the index entries, replacing the previous index at once.
+
+    Entries of files modified in the last RACY_SECONDS are written without stat data.
+    """
+    index_path = os.path.join(backup_folder, INDEX_FILE)
+    racy = (time.time() - RACY_SECONDS) * 1e9
+    with tracing.span('index.write'), storage.replacing(index_path) as file:
+        for relative_path, entry in sorted(entries.items()):
+            if entry.mtime_ns >= racy:
+                entry = make_entry(entry.object_id)
+            file.write(
+                f"{entry.object_id} {entry.size} {entry.mtime_ns} {entry.inode}"
+                + f"\t{relative_path}\n"
+            )
+    return None
+
+
+def rebuild_index(backup_folder: str, staging_area: str) -> Dict[str, IndexEntry]:
+    """Hash the staging area content and write a new index for it."""
+    entries = {}
+    for root, _, files in os.walk(staging_area):
+        for file in files:
+            file_path = os.path.join(root, file)
+            entries[os.path.relpath(file_path, staging_area)] = make_entry(
+                objectstore.hash_file(file_path))
+    write_index(backup_folder, entries)
+    return entries
@@ -0,0 +1,67 @@
+"""Process-wide cap on the file I/O bandwidth.
+
+The code which reads or writes file content calls 'consume' with the bytes
+it moved. Without a cap it returns at once. With a cap, a token bucket
+lets one second of bandwidth through in a burst, then makes the callers
+sleep for the bytes they took ahead of the rate, whatever thread they run
+in, so all the threads of a process share the same bandwidth.
+"""
+import time
+from typing import Optional
+
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class RateLimiter:
+    """A token bucket of bytes, refilled at a given rate."""
+
+    def __init__(self, bytes_per_second: float) -> None:
+        import threading  # Only needed when a cap is set.
+
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return None
+
+
+_limiter: Optional[RateLimiter] = None
+
+
+def set_limit(bytes_per_second: Optional[float]) -> None:
+    """Sets the bandwidth cap of the process, None removes it."""
+    global _limiter
+    _limiter = RateLimiter(bytes_per_second) if bytes_per_second else None
+    return None
+
+
+def is_limited() -> bool:
+    """Check if there is a cap, for callers which must stat files to know their sizes."""
+    return _limiter is not None
+
+
+def consume(amount: int) -> None:
+    """Accounts for bytes read or written, sleeping as needed to keep under the cap."""
+    if _limiter is not None:
+        _limiter.consume(amount)
+    return None
+
+
+def parse_rate(text: str) -> int:
+    """Return the bytes per second of a rate such '512K', '20M' or '1G', plain numbers are bytes."""
+    text = text.strip().upper().removesuffix('/S').removesuffix('B')
+    multiplier = SIZE_SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SIZE_SUFFIXES:
+        text = text[:-1]
+    return int(float(text) * multiplier)
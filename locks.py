@@ -0,0 +1,181 @@
+"""Repository locks, which let several wit processes work on the same repository.
+
+Two fcntl (flock) lock files in the '.wit' directory guard the state:
+    INDEX: the index, the staging area, the working tree, the sparse checkout
+           and the merge conflicts,
+    REFS: the references, the active branch, the commit graph and MERGE_HEAD.
+Commands which only read take shared locks, so 'status' and 'log' run in
+parallel with each other, and commands which write take exclusive locks
+only on what they change: 'branch' does not wait for 'add', and 'commit'
+only reads the index. Files are still replaced through renames, so readers
+which take no lock never see partial content.
+
+The index lock is always taken before the refs lock, so processes never
+wait for each other in a cycle. Threads of one process share the flock
+through an in-process read/write lock, so they exclude each other as
+processes do. Locks are re-entrant within a thread, a function holding a
+lock can call another one which asks for it, but a shared lock can not be
+upgraded to an exclusive one.
+
+The time spent waiting for a lock is traced as a 'lock_wait.NAME' phase,
+see the tracing module, and printed to the standard error when it is over
+WAIT_NOTICE_SECONDS. Where fcntl is not available, locks do nothing.
+"""
+import contextlib
+import functools
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows.
+    fcntl = None  # type: ignore
+
+import tracing
+
+
+INDEX: str = 'index'
+REFS: str = 'refs'
+SHARED: str = 'shared'
+EXCLUSIVE: str = 'exclusive'
+LOCK_SUFFIX: str = '.lock'
+WAIT_NOTICE_SECONDS: float = 1.0
+
+F = TypeVar('F', bound=Callable)
+
+
+class _Lock:
+    """The threads of this process holding a lock, and the flock they hold together."""
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.descriptor = -1
+
+    def free(self) -> bool:
+        return self.readers == 0 and not self.writer
+
+
+# (backup folder, lock name) -> the in-process state of the lock.
+_locks: Dict[Tuple[str, str], _Lock] = {}
+_locks_guard = threading.Lock()
+# Per thread, (backup folder, lock name) -> [mode, depth] of the locks the thread holds.
+_local = threading.local()
+
+
+def _held() -> Dict[Tuple[str, str], List]:
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = {}
+    return held
+
+
+def lock_path(backup_folder: str, name: str) -> str:
+    return os.path.join(backup_folder, name + LOCK_SUFFIX)
+
+
+def acquire(backup_folder: str, name: str, mode: str) -> None:
+    """Takes a lock, waiting for other threads and processes as needed."""
+    key = (os.path.abspath(backup_folder), name)
+    held = _held()
+    if key in held:
+        if mode == EXCLUSIVE and held[key][0] == SHARED:
+            raise RuntimeError(f"The {name} lock is held shared, it can not be taken exclusive.")
+        held[key][1] += 1
+        return None
+    with _locks_guard:
+        lock = _locks.setdefault(key, _Lock())
+    with lock.condition:
+        def available() -> bool:
+            return not lock.writer if mode == SHARED else lock.free()
+        if not available():
+            with tracing.span(f'lock_wait.{name}'):
+                lock.condition.wait_for(available)
+        if lock.free():
+            lock.descriptor = _flock(backup_folder, name, mode)
+        if mode == SHARED:
+            lock.readers += 1
+        else:
+            lock.writer = True
+    held[key] = [mode, 1]
+    return None
+
+
+def _flock(backup_folder: str, name: str, mode: str) -> int:
+    """Takes the lock file in the given mode and returns its descriptor, or -1 without fcntl."""
+    if fcntl is None:
+        return -1
+    descriptor = os.open(lock_path(backup_folder, name), os.O_RDWR | os.O_CREAT, 0o644)
+    operation = fcntl.LOCK_SH if mode == SHARED else fcntl.LOCK_EX
+    try:
+        fcntl.flock(descriptor, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        start = time.perf_counter()
+        try:
+            with tracing.span(f'lock_wait.{name}'):
+                fcntl.flock(descriptor, operation)
+        except BaseException:
+            os.close(descriptor)
+            raise
+        waited = time.perf_counter() - start
+        if waited >= WAIT_NOTICE_SECONDS:
+            sys.stderr.write(f"Waited {waited:.1f}s for the {name} lock of another wit process.\n")
+    return descriptor
+
+
+def release(backup_folder: str, name: str) -> None:
+    """Releases a lock taken by acquire."""
+    key = (os.path.abspath(backup_folder), name)
+    held = _held()
+    mode, depth = held[key]
+    if depth > 1:
+        held[key][1] -= 1
+        return None
+    del held[key]
+    lock = _locks[key]
+    with lock.condition:
+        if mode == SHARED:
+            lock.readers -= 1
+        else:
+            lock.writer = False
+        if lock.free():
+            if lock.descriptor != -1:
+                os.close(lock.descriptor)  # Closing the last descriptor releases the flock.
+            lock.descriptor = -1
+        lock.condition.notify_all()
+    return None
+
+
+@contextlib.contextmanager
+def locked(backup_folder: str, index: Optional[str] = None, refs: Optional[str] = None) -> Iterator[None]:
+    """Holds the index and refs locks in the given modes, None does not take a lock."""
+    taken = []
+    try:
+        for name, mode in ((INDEX, index), (REFS, refs)):
+            if mode is not None:
+                acquire(backup_folder, name, mode)
+                taken.append(name)
+        yield
+    finally:
+        for name in reversed(taken):
+            release(backup_folder, name)
+
+
+def holding(index: Optional[str] = None, refs: Optional[str] = None) -> Callable[[F], F]:
+    """Decorator, runs a function while holding the index and refs locks in the given modes.
+
+    The backup folder is the 'backup_folder' keyword argument, as given by
+    'run_only_if_backup', or else the first positional argument.
+    """
+    def decorator(function: F) -> F:
+        @functools.wraps(function)
+        def wrapper(*args, **kargs):
+            backup_folder = kargs['backup_folder'] if 'backup_folder' in kargs else args[0]
+            with locked(backup_folder, index, refs):
+                return function(*args, **kargs)
+        return wrapper  # type: ignore
+    return decorator
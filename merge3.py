@@ -0,0 +1,327 @@
+"""Three-way merge of wit trees and files.
+
+Trees are merged in a single walk over the base, ours and theirs trees.
+Sub-trees which are equal on two sides are resolved by their ids without
+being read. Only files changed on both sides get a line based merge.
+
+The line merge keeps one hash per line in memory instead of the lines
+themselves, aligns the three versions by those hashes with a patience
+diff, and then writes the result while reading each version once from
+start to end.
+"""
+import bisect
+import io
+import os
+import tempfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import objectstore
+
+
+BINARY_CHECK_SIZE: int = 8000
+# Kinds of conflicts, as the command line prints them.
+BOTH_MODIFIED: str = 'both modified'
+BOTH_ADDED: str = 'both added'
+DELETED_BY_US: str = 'deleted by us'
+DELETED_BY_THEM: str = 'deleted by them'
+FILE_DIRECTORY: str = 'file and directory'
+
+# (kind, object id) of a tree entry, or None if it is missing.
+Entry = Optional[Tuple[str, str]]
+
+
+class _LineReader:
+    """Reads the lines of a file forward only, by line numbers."""
+
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.position = 0
+
+    def lines(self, start: int, end: int) -> Iterator[bytes]:
+        while self.position < start:
+            self.file.readline()
+            self.position += 1
+        while self.position < end:
+            self.position += 1
+            yield self.file.readline()
+
+
+def line_hashes(file: BinaryIO) -> List[int]:
+    """Returns a hash for every line of a file."""
+    return [hash(line) for line in file]
+
+
+def is_binary(file: BinaryIO) -> bool:
+    """Check if a file looks binary, by looking for a NUL byte at its start."""
+    is_binary_file = b'\0' in file.read(BINARY_CHECK_SIZE)
+    file.seek(0)
+    return is_binary_file
+
+
+def _longest_increasing(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Returns the longest subsequence of pairs whose second items increase, by patience sorting."""
+    tails: List[int] = []  # The smallest last second item of the subsequences of every length.
+    tail_pairs: List[int] = []
+    previous = [-1] * len(pairs)
+    for index, (_, second) in enumerate(pairs):
+        length = bisect.bisect_left(tails, second)
+        if length == len(tails):
+            tails.append(second)
+            tail_pairs.append(index)
+        else:
+            tails[length] = second
+            tail_pairs[length] = index
+        previous[index] = tail_pairs[length - 1] if length else -1
+    result = []
+    index = tail_pairs[-1] if tail_pairs else -1
+    while index != -1:
+        result.append(pairs[index])
+        index = previous[index]
+    return result[::-1]
+
+
+def matching_blocks(a: Sequence[int], b: Sequence[int]) -> List[Tuple[int, int, int]]:
+    """Returns the (a start, b start, length) blocks of equal lines, ending with (len(a), len(b), 0).
+
+    Patience diff: the common start and end of a range are matched first,
+    then the lines which appear exactly once on both sides anchor the
+    alignment, following their longest increasing sequence, and the gaps
+    between anchors are aligned the same way. Every step is linear or
+    n log n, so files with many repeated lines stay fast.
+    """
+    matches = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a_start, a_end, b_start, b_end = stack.pop()
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            matches.append((a_start, b_start))
+            a_start += 1
+            b_start += 1
+        while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+            a_end -= 1
+            b_end -= 1
+            matches.append((a_end, b_end))
+        if a_start == a_end or b_start == b_end:
+            continue
+        counts: Dict[int, List[int]] = {}  # line -> [count in a, index in a, count in b, index in b]
+        for i in range(a_start, a_end):
+            counts.setdefault(a[i], [0, i, 0, 0])[0] += 1
+        for j in range(b_start, b_end):
+            count = counts.get(b[j])
+            if count is not None:
+                count[2] += 1
+                count[3] = j
+        anchors = _longest_increasing(sorted(
+            (i, j) for a_count, i, b_count, j in counts.values() if a_count == 1 and b_count == 1))
+        for i, j in anchors:
+            matches.append((i, j))
+            stack.append((a_start, i, b_start, j))
+            a_start, b_start = i + 1, j + 1
+        if anchors:
+            stack.append((a_start, a_end, b_start, b_end))
+
+    blocks: List[List[int]] = []
+    for i, j in sorted(matches):
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    return [(i, j, length) for i, j, length in blocks] + [(len(a), len(b), 0)]
+
+
+def _sync_regions(base: Sequence[int], ours: Sequence[int], theirs: Sequence[int]) -> List[Tuple[int, ...]]:
+    """Returns the base regions which are unchanged on both sides, with their positions on each side."""
+    ours_blocks = matching_blocks(base, ours)
+    theirs_blocks = matching_blocks(base, theirs)
+    regions = []
+    i = j = 0
+    while i < len(ours_blocks) and j < len(theirs_blocks):
+        ours_base, ours_start, ours_length = ours_blocks[i]
+        theirs_base, theirs_start, theirs_length = theirs_blocks[j]
+        start = max(ours_base, theirs_base)
+        end = min(ours_base + ours_length, theirs_base + theirs_length)
+        if start < end:
+            ours_match = ours_start + start - ours_base
+            theirs_match = theirs_start + start - theirs_base
+            regions.append((
+                start, end,
+                ours_match, ours_match + end - start,
+                theirs_match, theirs_match + end - start,
+            ))
+        if ours_base + ours_length < theirs_base + theirs_length:
+            i += 1
+        else:
+            j += 1
+    regions.append((len(base), len(base), len(ours), len(ours), len(theirs), len(theirs)))
+    return regions
+
+
+def merge_lines(base: BinaryIO, ours: BinaryIO, theirs: BinaryIO, output: BinaryIO,
+                labels: Tuple[str, str] = ('ours', 'theirs')) -> bool:
+    """Merges three versions of a file into output.
+
+    Args:
+        base, ours, theirs (file): The versions, opened in binary mode.
+        output (file): Where the merged content is written.
+        labels (tuple): Names for ours and theirs in conflict markers.
+    Returns:
+        bool: True if the merge had no conflicts.
+    """
+    base_hashes, ours_hashes, theirs_hashes = (line_hashes(f) for f in (base, ours, theirs))
+    for file in (base, ours, theirs):
+        file.seek(0)
+    readers = {'ours': _LineReader(ours), 'theirs': _LineReader(theirs)}
+    clean = True
+    last_line = b'\n'
+
+    def write(lines: Iterator[bytes]) -> None:
+        nonlocal last_line
+        for line in lines:
+            output.write(line)
+            last_line = line
+
+    def marker(text: str) -> None:
+        if not last_line.endswith(b'\n'):
+            write(iter([b'\n']))
+        write(iter([text.encode() + b'\n']))
+
+    base_pos = ours_pos = theirs_pos = 0
+    for base_match, base_end, ours_match, ours_end, theirs_match, theirs_end in _sync_regions(
+            base_hashes, ours_hashes, theirs_hashes):
+        if ours_match > ours_pos or theirs_match > theirs_pos:
+            base_part = base_hashes[base_pos:base_match]
+            ours_part = ours_hashes[ours_pos:ours_match]
+            theirs_part = theirs_hashes[theirs_pos:theirs_match]
+            if base_part == ours_part or ours_part == theirs_part:
+                write(readers['theirs'].lines(theirs_pos, theirs_match))
+            elif base_part == theirs_part:
+                write(readers['ours'].lines(ours_pos, ours_match))
+            else:
+                clean = False
+                marker(f'<<<<<<< {labels[0]}')
+                write(readers['ours'].lines(ours_pos, ours_match))
+                marker('=======')
+                write(readers['theirs'].lines(theirs_pos, theirs_match))
+                marker(f'>>>>>>> {labels[1]}')
+        write(readers['ours'].lines(ours_match, ours_end))
+        base_pos, ours_pos, theirs_pos = base_end, ours_end, theirs_end
+    return clean
+
+
+def merge_blobs(backup_folder: str, base: Optional[str], ours: str, theirs: str,
+                labels: Tuple[str, str]) -> Tuple[str, bool]:
+    """Merges three blobs and stores the result.
+
+    Returns:
+        tuple: The merged blob id and True if the merge had no conflicts.
+    """
+    opened = [
+        objectstore.open_object(backup_folder, object_id) if object_id else None
+        for object_id in (base, ours, theirs)
+    ]
+    base_file, ours_file, theirs_file = opened
+    descriptor, temp_path = tempfile.mkstemp(prefix='tmp-merge-', dir=os.path.join(backup_folder, objectstore.OBJECTS))
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            if base_file is None:
+                base_file = io.BytesIO()
+            if is_binary(ours_file) or is_binary(theirs_file):
+                return ours, False
+            clean = merge_lines(base_file, ours_file, theirs_file, output, labels)
+        return objectstore.store_file(backup_folder, temp_path), clean
+    finally:
+        for file in opened:
+            if file is not None:
+                file.close()
+        os.remove(temp_path)
+
+
+def _entry_files(backup_folder: str, entry: Entry, path: str) -> Dict[str, str]:
+    """Returns relative path -> blob id for all files of a tree entry."""
+    if entry is None:
+        return {}
+    kind, object_id = entry
+    if kind == objectstore.TREE:
+        return {
+            os.path.join(path, file): blob
+            for file, blob in objectstore.walk_tree(backup_folder, object_id)
+        }
+    return {path: object_id}
+
+
+def merge_trees(backup_folder: str, base: str, ours: str, theirs: str,
+                labels: Tuple[str, str] = ('ours', 'theirs')) -> Tuple[Dict[str, Optional[str]], Dict[str, str]]:
+    """Merges theirs tree into ours tree.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        base, ours, theirs (str): The root tree ids.
+        labels (tuple): Names for ours and theirs in conflict markers.
+    Returns:
+        tuple: The changes to apply on ours, as relative path -> new blob id
+               or None for deleted files, and the kind of conflict of every
+               conflicted path, sorted by path. The change of a conflicted
+               path is the content to leave in the working tree for the user
+               to resolve: the file with conflict markers, or theirs file if
+               ours deleted it.
+    """
+    changes: Dict[str, Optional[str]] = {}
+    conflicts: Dict[str, str] = {}
+
+    def take_theirs(path: str, ours_entry: Entry, theirs_entry: Entry) -> None:
+        if (
+            ours_entry is not None and theirs_entry is not None
+            and ours_entry[0] == theirs_entry[0] == objectstore.TREE
+        ):
+            for file, _, blob in objectstore.diff_trees(backup_folder, ours_entry[1], theirs_entry[1]):
+                changes[os.path.join(path, file)] = blob
+            return
+        old_files = _entry_files(backup_folder, ours_entry, path)
+        new_files = _entry_files(backup_folder, theirs_entry, path)
+        for file in old_files.keys() - new_files.keys():
+            changes[file] = None
+        for file, blob in new_files.items():
+            if old_files.get(file) != blob:
+                changes[file] = blob
+
+    stack: List[Tuple[str, Entry, Entry, Entry]] = [
+        ('', (objectstore.TREE, base), (objectstore.TREE, ours), (objectstore.TREE, theirs))
+    ]
+    while stack:
+        path, base_entry, ours_entry, theirs_entry = stack.pop()
+        if ours_entry == theirs_entry or base_entry == theirs_entry:
+            continue
+        if base_entry == ours_entry:
+            take_theirs(path, ours_entry, theirs_entry)
+            continue
+        kinds = {entry[0] for entry in (base_entry, ours_entry, theirs_entry) if entry is not None}
+        if kinds == {objectstore.TREE} and ours_entry is not None and theirs_entry is not None:
+            trees = [
+                objectstore.read_tree(backup_folder, entry[1]) if entry is not None else {}
+                for entry in (base_entry, ours_entry, theirs_entry)
+            ]
+            for name in sorted(set().union(*trees), reverse=True):
+                stack.append((os.path.join(path, name), *(tree.get(name) for tree in trees)))
+            continue
+        if (
+            ours_entry is not None and theirs_entry is not None
+            and ours_entry[0] == theirs_entry[0] == objectstore.BLOB
+            and (base_entry is None or base_entry[0] == objectstore.BLOB)
+        ):
+            blob, clean = merge_blobs(
+                backup_folder, base_entry[1] if base_entry else None,
+                ours_entry[1], theirs_entry[1], labels)
+            if blob != ours_entry[1]:
+                changes[path] = blob
+            if not clean:
+                conflicts[path] = BOTH_MODIFIED if base_entry is not None else BOTH_ADDED
+            continue
+        if ours_entry is None:
+            conflicts[path] = DELETED_BY_US
+            if theirs_entry is not None and theirs_entry[0] == objectstore.BLOB:
+                changes[path] = theirs_entry[1]
+        elif theirs_entry is None:
+            conflicts[path] = DELETED_BY_THEM
+        else:
+            conflicts[path] = FILE_DIRECTORY
+    return changes, dict(sorted(conflicts.items()))
@@ -0,0 +1,466 @@
+"""Content-addressed object store for wit backups.
+
+Every file is stored once under '.wit/objects' by the sha1 of its content.
+Directories are stored as tree manifests, which list the blobs and
+sub-trees they contain, so a commit only needs to point at a root tree.
+Objects are written loose, one file each, and 'repack' moves them into
+a compressed pack file (see the pack module).
+
+Files larger than the chunking threshold are split into content-defined
+chunks (see the chunking module), stored as objects of their own, and the
+file blob is a chunk list under '.wit/chunks' which names them in order.
+The blob id is still the sha1 of the whole file content, so only the
+changed chunks of a new version are written.
+"""
+import bisect
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import chunking
+import iolimit
+import pack
+import storage
+import tracing
+import workers
+
+
+OBJECTS: str = 'objects'
+CHUNKS: str = 'chunks'
+BLOB: str = 'blob'
+TREE: str = 'tree'
+BUFFER_SIZE: int = 1024 * 1024
+EMPTY_TREE: str = hashlib.sha1(b'').hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """Return the sha1 hex digest of a file content."""
+    digest = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BUFFER_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+            iolimit.consume(len(block))
+    tracing.count('files_read')
+    tracing.count('bytes_read', size)
+    return digest.hexdigest()
+
+
+def object_path(backup_folder: str, object_id: str) -> str:
+    """Return the path of an object inside the objects folder."""
+    return os.path.join(backup_folder, OBJECTS, object_id[:2], object_id[2:])
+
+
+def chunk_list_path(backup_folder: str, object_id: str) -> str:
+    """Return the path of a chunked blob's chunk list."""
+    return os.path.join(backup_folder, CHUNKS, object_id[:2], object_id[2:])
+
+
+def read_chunk_list(backup_folder: str, object_id: str) -> Optional[List[Tuple[str, int]]]:
+    """Returns the (chunk id, size) pairs of a chunked blob, or None if it is not chunked."""
+    try:
+        with open(chunk_list_path(backup_folder, object_id), 'r') as file:
+            return [(chunk_id, int(size)) for chunk_id, size in (line.split() for line in file)]
+    except FileNotFoundError:
+        return None
+
+
+def has_object(backup_folder: str, object_id: str) -> bool:
+    """Check if an object is already stored, loose, chunked or packed."""
+    return (
+        os.path.exists(object_path(backup_folder, object_id))
+        or os.path.exists(chunk_list_path(backup_folder, object_id))
+        or pack.has_object(backup_folder, object_id)
+    )
+
+
+class _ChunkedFile(io.RawIOBase):
+    """Reads a chunked blob as one file, opening a single chunk at a time."""
+
+    def __init__(self, backup_folder: str, chunks: List[Tuple[str, int]]) -> None:
+        super().__init__()
+        self.backup_folder = backup_folder
+        self.chunk_ids = [chunk_id for chunk_id, _ in chunks]
+        self.offsets = [0]
+        for _, size in chunks:
+            self.offsets.append(self.offsets[-1] + size)
+        self.position = 0
+        self.current: Optional[BinaryIO] = None
+        self.current_index = -1
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.offsets[-1]
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.offsets[-1]:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        if index != self.current_index:
+            if self.current is not None:
+                self.current.close()
+            self.current = open_object(self.backup_folder, self.chunk_ids[index])
+            self.current_index = index
+        self.current.seek(self.position - self.offsets[index])
+        count = self.current.readinto(buffer)
+        self.position += count
+        return count
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+
+def open_object(backup_folder: str, object_id: str) -> BinaryIO:
+    """Opens an object content for reading, loose and chunked objects are streamed from their files."""
+    try:
+        return open(object_path(backup_folder, object_id), 'rb')
+    except FileNotFoundError:
+        chunks = read_chunk_list(backup_folder, object_id)
+        if chunks is not None:
+            return io.BufferedReader(_ChunkedFile(backup_folder, chunks), BUFFER_SIZE)
+        content = pack.read_object(backup_folder, object_id)
+        if content is None:
+            raise
+        return io.BytesIO(content)
+
+
+def read_object(backup_folder: str, object_id: str) -> bytes:
+    """Returns an object content, loose or packed."""
+    try:
+        with open(object_path(backup_folder, object_id), 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        chunks = read_chunk_list(backup_folder, object_id)
+        if chunks is not None:
+            return b''.join(read_object(backup_folder, chunk_id) for chunk_id, _ in chunks)
+        content = pack.read_object(backup_folder, object_id)
+        if content is None:
+            raise
+        return content
+
+
+def verify_object(backup_folder: str, object_id: str) -> bool:
+    """Check that an object is stored and that its content still hashes to its id."""
+    if object_id == EMPTY_TREE and not has_object(backup_folder, object_id):
+        return True
+    digest = hashlib.sha1()
+    try:
+        with open_object(backup_folder, object_id) as file:
+            for block in iter(lambda: file.read(BUFFER_SIZE), b''):
+                digest.update(block)
+                iolimit.consume(len(block))
+    except OSError:
+        return False
+    return digest.hexdigest() == object_id
+
+
+def _temp_object_path(backup_folder: str) -> str:
+    """Return a new unique temporary file path inside the objects folder."""
+    descriptor, temp_path = tempfile.mkstemp(prefix='tmp-', dir=os.path.join(backup_folder, OBJECTS))
+    os.close(descriptor)
+    return temp_path
+
+
+def _write_object(backup_folder: str, object_id: str, source: str) -> None:
+    """Move a temporary file into its final object path."""
+    destination = object_path(backup_folder, object_id)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(source, destination)
+    return None
+
+
+def store_file(backup_folder: str, path: str, object_id: Optional[str] = None,
+               mode: str = storage.COPY) -> str:
+    """Stores a file as a blob, only if its content is not stored yet.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        path (str): The file to store.
+        object_id (str, optional): The file hash, if it is already known.
+        mode (str, optional): The storage mode, see the storage module.
+    Returns:
+        str: The blob id.
+    """
+    if object_id is None:
+        object_id = hash_file(path)
+    if has_object(backup_folder, object_id):
+        return object_id
+    tracing.count('objects_written')
+    if os.path.getsize(path) >= chunking.CHUNKING_THRESHOLD:
+        _store_chunks(backup_folder, path, object_id)
+    else:
+        destination = object_path(backup_folder, object_id)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        storage.place_file(path, destination, mode)
+    return object_id
+
+
+def _store_chunks(backup_folder: str, path: str, object_id: str) -> None:
+    """Stores a file as a chunk list, writing only the chunks which are not stored yet."""
+    chunks = []
+    with open(path, 'rb') as file:
+        for chunk in chunking.iter_chunks(file):
+            chunk_id = hashlib.sha1(chunk).hexdigest()
+            iolimit.consume(len(chunk))
+            if not has_object(backup_folder, chunk_id):
+                temp_path = _temp_object_path(backup_folder)
+                with open(temp_path, 'wb') as temp_file:
+                    temp_file.write(chunk)
+                _write_object(backup_folder, chunk_id, temp_path)
+            chunks.append(f"{chunk_id} {len(chunk)}\n")
+
+    # The chunk list is written last, so the blob only exists once all its chunks do.
+    temp_path = _temp_object_path(backup_folder)
+    with open(temp_path, 'w') as file:
+        file.writelines(chunks)
+    destination = chunk_list_path(backup_folder, object_id)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(temp_path, destination)
+    return None
+
+
+def write_tree(backup_folder: str, entries: Dict[str, Tuple[str, str]]) -> str:
+    """Stores a tree manifest and returns its id.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        entries (dict): Entry name -> (object type, object id).
+    Returns:
+        str: The tree id.
+    """
+    content = ''.join(
+        f"{kind} {object_id}\t{name}\n"
+        for name, (kind, object_id) in sorted(entries.items())
+    ).encode()
+    tree_id = hashlib.sha1(content).hexdigest()
+    if not has_object(backup_folder, tree_id):
+        temp_path = _temp_object_path(backup_folder)
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        _write_object(backup_folder, tree_id, temp_path)
+    return tree_id
+
+
+def read_tree(backup_folder: str, tree_id: str) -> Dict[str, Tuple[str, str]]:
+    """Returns the entries of a stored tree manifest."""
+    if tree_id == EMPTY_TREE:
+        return {}
+    entries = {}
+    for line in read_object(backup_folder, tree_id).decode().splitlines():
+        header, _, name = line.partition('\t')
+        kind, _, object_id = header.partition(' ')
+        entries[name] = (kind, object_id)
+    return entries
+
+
+def build_tree(backup_folder: str, directory: str) -> str:
+    """Stores a directory content and returns its root tree id.
+
+    Blobs which are already stored are not written again.
+    """
+    entries = {}
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                entries[entry.name] = (TREE, build_tree(backup_folder, entry.path))
+            else:
+                entries[entry.name] = (BLOB, store_file(backup_folder, entry.path))
+    return write_tree(backup_folder, entries)
+
+
+def build_tree_from_files(backup_folder: str, files: Dict[str, str], source: str,
+                          mode: str = storage.COPY) -> str:
+    """Stores a tree for already hashed files and returns its root tree id.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        files (dict): Relative path -> blob id.
+        source (str): Directory to read the content of blobs which are not stored yet.
+        mode (str, optional): The storage mode of new blobs.
+    Returns:
+        str: The root tree id.
+    """
+    root: Dict = {}
+    missing: Dict[str, str] = {}
+    for relative_path, object_id in files.items():
+        node = root
+        *dirs, name = relative_path.split(os.sep)
+        for directory in dirs:
+            node = node.setdefault(directory, {})
+        node[name] = object_id
+        if object_id not in missing and not has_object(backup_folder, object_id):
+            missing[object_id] = os.path.join(source, relative_path)
+    workers.run(lambda object_id, path: store_file(backup_folder, path, object_id, mode),
+                missing.keys(), missing.values())
+
+    def write_node(node: Dict) -> str:
+        entries = {}
+        for name, value in node.items():
+            if isinstance(value, dict):
+                entries[name] = (TREE, write_node(value))
+            else:
+                entries[name] = (BLOB, value)
+        return write_tree(backup_folder, entries)
+
+    return write_node(root)
+
+
+def walk_tree(backup_folder: str, tree_id: str, prefix: str = '') -> Iterator[Tuple[str, str]]:
+    """Yields (relative path, blob id) for every file in a tree."""
+    for name, (kind, object_id) in sorted(read_tree(backup_folder, tree_id).items()):
+        relative_path = os.path.join(prefix, name)
+        if kind == TREE:
+            yield from walk_tree(backup_folder, object_id, relative_path)
+        else:
+            yield relative_path, object_id
+
+
+def flatten_tree(backup_folder: str, tree_id: str) -> Dict[str, str]:
+    """Returns a dict of relative path -> blob id for a tree."""
+    return dict(walk_tree(backup_folder, tree_id))
+
+
+def diff_trees(backup_folder: str, old_tree: str, new_tree: str) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Yields (relative path, old blob id, new blob id) for every file which differs between two trees.
+
+    A missing side is None. Sub-trees with the same id are skipped without being read.
+    """
+    stack = [('', old_tree, new_tree)]
+    while stack:
+        prefix, old_id, new_id = stack.pop()
+        if old_id == new_id:
+            continue
+        old_entries = read_tree(backup_folder, old_id) if old_id else {}
+        new_entries = read_tree(backup_folder, new_id) if new_id else {}
+        for name in sorted(old_entries.keys() | new_entries.keys(), reverse=True):
+            relative_path = os.path.join(prefix, name)
+            old_kind, old_object = old_entries.get(name, (None, None))
+            new_kind, new_object = new_entries.get(name, (None, None))
+            if old_object == new_object and old_kind == new_kind:
+                continue
+            if old_kind == TREE or new_kind == TREE:
+                stack.append((
+                    relative_path,
+                    old_object if old_kind == TREE else None,
+                    new_object if new_kind == TREE else None,
+                ))
+            if old_kind == TREE:
+                old_object = None
+            if new_kind == TREE:
+                new_object = None
+            if old_object is not None or new_object is not None:
+                yield relative_path, old_object, new_object
+
+
+def materialize_blob(backup_folder: str, object_id: str, destination: str,
+                     mode: str = storage.COPY) -> None:
+    """Writes a stored blob into a given file path, replacing the existing file."""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    source = object_path(backup_folder, object_id)
+    if os.path.exists(source):
+        try:
+            storage.place_file(source, destination, mode)
+            return None
+        except FileNotFoundError:
+            pass  # Packed meanwhile by a 'wit gc'.
+    temp_path = f'{destination}.wit-tmp'
+    with open_object(backup_folder, object_id) as content, open(temp_path, 'wb') as file:
+        shutil.copyfileobj(content, file, BUFFER_SIZE)
+        tracing.count('files_copied')
+        tracing.count('bytes_copied', file.tell())
+        iolimit.consume(file.tell())
+    os.replace(temp_path, destination)
+    return None
+
+
+def loose_objects(backup_folder: str) -> Iterator[str]:
+    """Yields the ids of all the loose objects."""
+    objects_folder = os.path.join(backup_folder, OBJECTS)
+    for prefix in sorted(os.listdir(objects_folder)):
+        directory = os.path.join(objects_folder, prefix)
+        if len(prefix) == 2 and os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if not name.startswith('.wit-tmp'):
+                    yield prefix + name
+
+
+def repack(backup_folder: str, tree_ids: List[str]) -> Tuple[Optional[str], int]:
+    """Moves all the objects into a single new pack and removes the previous ones.
+
+    Objects are delta encoded against the previous version of the same path,
+    following the order of the given root trees, oldest first.
+
+    Returns:
+        tuple: The new pack path and the number of packed objects.
+    """
+    order: List[str] = []
+    order_set = set()
+    bases: Dict[str, str] = {}
+    last_versions: Dict[str, str] = {}
+
+    def add(object_id: str, version_key: Optional[str]) -> None:
+        chunks = read_chunk_list(backup_folder, object_id)
+        if chunks is not None:
+            # Chunked blobs stay chunk lists, only their chunks are packed.
+            for chunk_id, _ in chunks:
+                add(chunk_id, None)
+            return
+        if object_id not in order_set:
+            order_set.add(object_id)
+            order.append(object_id)
+            if version_key in last_versions:
+                bases[object_id] = last_versions[version_key]
+        if version_key is not None:
+            last_versions[version_key] = object_id
+
+    stack = [('', tree_id) for tree_id in reversed(tree_ids)]
+    while stack:
+        tree_path, tree_id = stack.pop()
+        if tree_id == EMPTY_TREE and not has_object(backup_folder, tree_id):
+            continue
+        is_new = tree_id not in order_set
+        add(tree_id, tree_path + os.sep)  # A trailing separator keeps trees apart from files.
+        if not is_new:
+            continue
+        for name, (kind, child_id) in sorted(read_tree(backup_folder, tree_id).items(), reverse=True):
+            child_path = os.path.join(tree_path, name)
+            if kind == TREE:
+                stack.append((child_path, child_id))
+            else:
+                add(child_id, child_path)
+
+    loose = list(loose_objects(backup_folder))
+    packs = pack.load_packs(backup_folder, refresh=True)
+    packed = [object_id for loaded in packs for object_id in loaded.entries]
+    order.extend(object_id for object_id in sorted(set(loose + packed)) if object_id not in order_set)
+    old_packs = [loaded.path for loaded in packs]
+
+    pack_path = pack.write_pack(
+        backup_folder, order, lambda object_id: read_object(backup_folder, object_id), bases)
+    for old_pack in old_packs:
+        if old_pack != pack_path:
+            os.remove(f'{os.path.splitext(old_pack)[0]}.idx')
+            os.remove(old_pack)
+    for object_id in loose:
+        os.remove(object_path(backup_folder, object_id))
+    return pack_path, len(order)
@@ -0,0 +1,302 @@
+"""Compressed pack files for the wit object store.
+
+A pack consolidates many objects into a single file under '.wit/pack'.
+Every object is zlib compressed, either whole or as a delta against
+another object, usually the previous version of the same path. The pack
+index file next to it holds one line per object:
+    <object id> <offset> <length> <base object id or '-'>
+Packs are read through mmap, so only the requested regions are paged in.
+They are loaded once per process, and loaded again when an object is not
+found and the pack directory changed.
+"""
+import hashlib
+import mmap
+import os
+import re
+import struct
+import zlib
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+PACK_DIR: str = 'pack'
+MAX_DELTA_SIZE: int = 4 * 1024 * 1024
+MAX_CHAIN_DEPTH: int = 16
+MIN_TOKEN_SIZE: int = 16
+TOKEN_SIZE: int = 64
+# Occurrences of a base token tried for every target token.
+MAX_CANDIDATES: int = 16
+COMPRESSION_LEVEL: int = 6
+
+_COPY = b'C'
+_INSERT = b'I'
+_COPY_SIZE = 17  # The size of a copy instruction.
+
+
+class PackEntry(NamedTuple):
+    offset: int
+    length: int
+    base: Optional[str]
+
+
+class Pack(NamedTuple):
+    path: str
+    data: mmap.mmap
+    entries: Dict[str, PackEntry]
+
+
+# Backup folder -> (pack directory inode and mtime, its loaded packs).
+_packs: Dict[str, Tuple[Tuple[int, int], List[Pack]]] = {}
+
+
+def _tokens(data: bytes) -> List[bytes]:
+    """Splits data for delta matching, after the first newline of at least MIN_TOKEN_SIZE bytes.
+
+    Tokens end on content, so they line up again after an insertion, and
+    runs of short lines are not split into many tiny tokens. Tokens without
+    a newline are cut at TOKEN_SIZE bytes.
+    """
+    return re.findall(
+        rb'.{%d,%d}?\n|.{1,%d}' % (MIN_TOKEN_SIZE - 1, TOKEN_SIZE - 1, TOKEN_SIZE), data, re.DOTALL)
+
+
+def _match_length(base: bytes, base_start: int, target: bytes, target_start: int) -> int:
+    """Returns the length of the common prefix of base and target from the given offsets.
+
+    Slices are compared in doubling strides then by bisection, so the bytes
+    are compared in C and the work is linear in the match length.
+    """
+    limit = min(len(base) - base_start, len(target) - target_start)
+    length, stride = 0, TOKEN_SIZE
+    while length < limit:
+        size = min(stride, limit - length)
+        if base[base_start + length:base_start + length + size] == target[target_start + length:target_start + length + size]:
+            length += size
+            stride *= 2
+            continue
+        low, high = 0, size  # The first low bytes of the stride are equal, the first high are not.
+        while high - low > 1:
+            middle = (low + high) // 2
+            if base[base_start + length + low:base_start + length + middle] == target[target_start + length + low:target_start + length + middle]:
+                low = middle
+            else:
+                high = middle
+        return length + low
+    return length
+
+
+def make_delta(base: bytes, target: bytes) -> bytes:
+    """Returns instructions which rebuild target by copying ranges of base and inserting new bytes.
+
+    The base tokens are put in a hash index, as git and xdelta do with
+    blocks. For every token of target, the longest match starting at one
+    of its first MAX_CANDIDATES occurrences in base is copied, and the
+    target moves past it, so the work stays linear in the sizes however
+    repetitive the content is.
+    """
+    import bisect  # Only needed when writing packs.
+    import itertools
+
+    base_tokens = _tokens(base)
+    target_tokens = _tokens(target)
+    target_offsets = list(itertools.accumulate(map(len, target_tokens), initial=0))
+    candidates: Dict[bytes, List[int]] = {}
+    for offset, token in zip(itertools.accumulate(map(len, base_tokens), initial=0), base_tokens):
+        positions = candidates.setdefault(token, [])
+        if len(positions) < MAX_CANDIDATES:
+            positions.append(offset)
+
+    delta = bytearray()
+    inserted = 0  # The first target token which is not written yet.
+    position = 0
+    while position < len(target_tokens):
+        offset = target_offsets[position]
+        best_start, best_length = 0, 0
+        for start in candidates.get(target_tokens[position], ()):
+            length = _match_length(base, start, target, offset)
+            if length > best_length:
+                best_start, best_length = start, length
+            if offset + best_length == len(target):
+                break
+        # Matches end on a token boundary, so the next lookup starts on a token.
+        end = bisect.bisect_right(target_offsets, offset + best_length) - 1
+        size = target_offsets[end] - offset
+        if size <= _COPY_SIZE:  # Shorter than its copy instruction.
+            position += 1
+            continue
+        if inserted < position:
+            data = target[target_offsets[inserted]:offset]
+            delta += _INSERT + struct.pack('>Q', len(data)) + data
+        delta += _COPY + struct.pack('>QQ', best_start, size)
+        position = inserted = end
+    if inserted < len(target_tokens):
+        data = target[target_offsets[inserted]:]
+        delta += _INSERT + struct.pack('>Q', len(data)) + data
+    return bytes(delta)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """Rebuilds an object from its base and its delta instructions."""
+    result = bytearray()
+    position = 0
+    while position < len(delta):
+        op = delta[position:position + 1]
+        if op == _COPY:
+            start, length = struct.unpack_from('>QQ', delta, position + 1)
+            result += base[start:start + length]
+            position += _COPY_SIZE
+        else:
+            length, = struct.unpack_from('>Q', delta, position + 1)
+            position += 9
+            result += delta[position:position + length]
+            position += length
+    return bytes(result)
+
+
+def pack_dir(backup_folder: str) -> str:
+    return os.path.join(backup_folder, PACK_DIR)
+
+
+def _index_path(pack_path: str) -> str:
+    return f'{os.path.splitext(pack_path)[0]}.idx'
+
+
+def _load_pack(pack_path: str) -> Pack:
+    entries = {}
+    with open(_index_path(pack_path), 'r') as file:
+        for line in file:
+            object_id, offset, length, base = line.split()
+            entries[object_id] = PackEntry(int(offset), int(length), None if base == '-' else base)
+    with open(pack_path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return Pack(pack_path, data, entries)
+
+
+def _directory_key(directory: str) -> Tuple[int, int]:
+    try:
+        stat = os.stat(directory)
+    except FileNotFoundError:
+        return (0, 0)
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def load_packs(backup_folder: str, refresh: bool = False) -> List[Pack]:
+    """Returns the packs of a repository, they are loaded once per process.
+
+    With refresh, the packs are loaded again if the pack directory changed,
+    as it does when another process runs 'wit gc'.
+    """
+    cached = _packs.get(backup_folder)
+    if cached is not None and not refresh:
+        return cached[1]
+    directory = pack_dir(backup_folder)
+    key = _directory_key(directory)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    packs = []
+    for name in names:
+        if name.endswith('.idx'):
+            try:
+                packs.append(_load_pack(os.path.join(directory, f'{os.path.splitext(name)[0]}.pack')))
+            except FileNotFoundError:
+                pass  # Removed meanwhile by a 'wit gc'.
+    # Packs replaced by another process are not closed, other threads may still read them.
+    _packs[backup_folder] = (key, packs)
+    return packs
+
+
+def clear_cache(backup_folder: str) -> None:
+    """Forgets the loaded packs, after they were rewritten."""
+    _, packs = _packs.pop(backup_folder, (None, []))
+    for loaded in packs:
+        loaded.data.close()
+    return None
+
+
+def _find(backup_folder: str, object_id: str) -> Optional[Tuple[Pack, PackEntry]]:
+    """Looks an object up in the packs, loading them again when it is missing and they changed."""
+    packs = load_packs(backup_folder)
+    for loaded in packs:
+        entry = loaded.entries.get(object_id)
+        if entry is not None:
+            return loaded, entry
+    refreshed = load_packs(backup_folder, refresh=True)
+    if refreshed is packs:
+        return None
+    for loaded in refreshed:
+        entry = loaded.entries.get(object_id)
+        if entry is not None:
+            return loaded, entry
+    return None
+
+
+def has_object(backup_folder: str, object_id: str) -> bool:
+    """Check if an object is stored in one of the packs."""
+    return _find(backup_folder, object_id) is not None
+
+
+def read_object(backup_folder: str, object_id: str) -> Optional[bytes]:
+    """Returns a packed object content, or None if it is not packed."""
+    found = _find(backup_folder, object_id)
+    if found is None:
+        return None
+    chain = []
+    while found is not None:
+        loaded, entry = found
+        chain.append(zlib.decompress(loaded.data[entry.offset:entry.offset + entry.length]))
+        found = None if entry.base is None else _find(backup_folder, entry.base)
+    content = chain.pop()
+    while chain:
+        content = apply_delta(content, chain.pop())
+    return content
+
+
+def write_pack(backup_folder: str, object_ids: Iterable[str], read: Callable[[str], bytes],
+               bases: Dict[str, str]) -> Optional[str]:
+    """Writes the given objects into a new pack.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        object_ids (iterable): The objects to pack, a delta base should come before the objects using it.
+        read (callable): Gets an object id and returns its content.
+        bases (dict): Object id -> the object id to try as its delta base.
+    Returns:
+        str: The new pack path, or None if there were no objects.
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return None
+    directory = pack_dir(backup_folder)
+    os.makedirs(directory, exist_ok=True)
+    name = hashlib.sha1(''.join(sorted(object_ids)).encode()).hexdigest()
+    pack_path = os.path.join(directory, f'pack-{name}.pack')
+    index_lines = []
+    depths: Dict[str, int] = {}
+    with open(f'{pack_path}.tmp', 'wb') as file:
+        for object_id in object_ids:
+            content = read(object_id)
+            record = zlib.compress(content, COMPRESSION_LEVEL)
+            base = bases.get(object_id)
+            depths[object_id] = 0
+            if (
+                base in depths and depths[base] < MAX_CHAIN_DEPTH
+                and len(content) <= MAX_DELTA_SIZE
+            ):
+                delta = zlib.compress(make_delta(read(base), content), COMPRESSION_LEVEL)
+                if len(delta) < len(record):
+                    record = delta
+                    depths[object_id] = depths[base] + 1
+                else:
+                    base = None
+            else:
+                base = None
+            index_lines.append(f"{object_id} {file.tell()} {len(record)} {base or '-'}\n")
+            file.write(record)
+    index_path = _index_path(pack_path)
+    with open(f'{index_path}.tmp', 'w') as file:
+        file.writelines(index_lines)
+    # The index is renamed last, so a pack is only used once it is complete.
+    os.replace(f'{pack_path}.tmp', pack_path)
+    os.replace(f'{index_path}.tmp', index_path)
+    clear_cache(backup_folder)
+    return pack_path
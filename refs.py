@@ -0,0 +1,60 @@
+"""Reference store for HEAD and the branches.
+
+References are kept in 'references.txt' as 'name=commit id' lines, HEAD
+first and master second. The file is read into a dict which is kept while
+the file stat data does not change, so processes which run many commands
+read it once and still see the changes of other invocations. It is written
+back at once through a temporary file and a rename, so other invocations
+never see a partially written file.
+"""
+import os
+from typing import Dict, Tuple
+
+import tracing
+
+
+REFERENCES_FILE: str = 'references.txt'
+HEAD: str = 'HEAD'
+MASTER: str = 'master'
+
+_refs: Dict[str, Tuple[Tuple[int, int, int], Dict[str, str]]] = {}
+
+
+def _file_key(reference_path: str) -> Tuple[int, int, int]:
+    stat = os.stat(reference_path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def load_refs(backup_folder: str) -> Dict[str, str]:
+    """Returns the references of a repository, reading the file only when it was replaced."""
+    reference_path = os.path.join(backup_folder, REFERENCES_FILE)
+    key = _file_key(reference_path)
+    cached = _refs.get(backup_folder)
+    if cached is None or cached[0] != key:
+        refs = {}
+        with tracing.span('refs.read'), open(reference_path, 'r') as file:
+            for line in file:
+                name, separator, commit_id = line.strip().partition('=')
+                if separator:
+                    refs[name] = commit_id
+        cached = _refs[backup_folder] = (key, refs)
+    return cached[1]
+
+
+def save_refs(backup_folder: str, refs: Dict[str, str]) -> None:
+    """Writes the references, replacing the previous file at once."""
+    ordered = {HEAD: refs.get(HEAD, 'None'), MASTER: refs.get(MASTER, 'None'), **refs}
+    reference_path = os.path.join(backup_folder, REFERENCES_FILE)
+    temp_path = f'{reference_path}.{os.getpid()}.tmp'
+    with tracing.span('refs.write'):
+        with open(temp_path, 'w') as file:
+            file.write('\n'.join(f"{name}={commit_id}" for name, commit_id in ordered.items()))
+        os.replace(temp_path, reference_path)
+    _refs[backup_folder] = (_file_key(reference_path), ordered)
+    return None
+
+
+def clear_cache() -> None:
+    """Forgets the loaded references, so the next command reads them again."""
+    _refs.clear()
+    return None
@@ -0,0 +1,162 @@
+"""In-process API over a wit repository.
+
+'Repository' finds the '.wit' directory once and runs the same operations
+as the command line, but it never changes the working directory of the
+process, prints nothing and returns structured results. Operations which
+can not be done raise wit.WitError, with the message the command line
+prints.
+
+Parsed state is shared between calls: the references and the commit graph
+are kept in memory while their files are unchanged, and parsed commits are
+cached, so a long running process pays for discovery and parsing once and
+still sees the changes made by other processes.
+
+Usage:
+    repository = Repository('/path/to/project')
+    repository.add('src', 'README.md')
+    commit_id = repository.commit('Update the sources')
+    print(repository.status().modified)
+"""
+import os
+from datetime import datetime
+from itertools import islice
+from typing import Dict, List, NamedTuple, Optional
+
+import locks
+import refs
+import storage
+import wit
+
+
+class Status(NamedTuple):
+    head: Optional[str]
+    staged: List[str]
+    modified: List[str]
+    untracked: List[str]
+
+
+class MergeResult(NamedTuple):
+    commit_id: Optional[str]
+    conflicts: List[str]
+
+
+class LogEntry(NamedTuple):
+    commit_id: str
+    parents: List[str]
+    date: str
+    message: str
+
+
+class Repository:
+    """A wit repository, found from any path inside it."""
+
+    def __init__(self, path: str) -> None:
+        backup_folder = wit.find_directory(path)
+        if backup_folder is None:
+            raise wit.WitError(f"Not inside a wit repository: {path}")
+        self.backup_folder: str = backup_folder
+        self.root: str = os.path.dirname(backup_folder)
+
+    @classmethod
+    def init(cls, path: str, storage_mode: str = storage.COPY) -> 'Repository':
+        """Creates a new repository in a directory."""
+        wit.init_repository(os.path.abspath(path), storage_mode)
+        return cls(path)
+
+    @property
+    def head(self) -> Optional[str]:
+        """The commit id of HEAD, None before the first commit."""
+        head = wit.get_head(self.backup_folder)
+        return None if head == 'None' else head
+
+    @property
+    def active_branch(self) -> Optional[str]:
+        branch = wit.get_active_branch(self.backup_folder)
+        return None if branch == 'None' else branch
+
+    def branches(self) -> Dict[str, str]:
+        """Returns the commit id of every branch, by name."""
+        return {
+            name: commit_id
+            for name, commit_id in refs.load_refs(self.backup_folder).items() if name != refs.HEAD
+        }
+
+    def add(self, *paths: str, add_all: bool = False) -> List[str]:
+        """Stages files, directories or glob patterns, relative to the repository root.
+
+        Args:
+            paths (tuple): The paths to add. Nothing is staged if one of them does not match.
+            add_all (bool, optional): Add the whole working tree, deleted files included.
+        Returns:
+            list: The staged files. Files out of the sparse checkout are skipped.
+        """
+        staged, _ = wit.add_paths(self.backup_folder, list(paths), self.root, add_all)
+        return staged
+
+    def commit(self, message: str) -> Optional[str]:
+        """Commits the staging area, returns the commit id or None if nothing changed."""
+        return wit.create_commit(self.backup_folder, message)
+
+    def status(self, exact: bool = True) -> Status:
+        """Returns the staged, modified and untracked files.
+
+        Args:
+            exact (bool, optional): False accepts a daemon answer which may miss the latest changes.
+        """
+        with locks.locked(self.backup_folder, index=locks.SHARED, refs=locks.SHARED):
+            head = wit.get_head(self.backup_folder)
+            modified, untracked = wit.working_tree_changes(self.backup_folder, exact)
+            return Status(
+                head=None if head == 'None' else head,
+                staged=wit.Changes_to_be_committed(head, self.backup_folder),
+                modified=modified,
+                untracked=untracked,
+            )
+
+    def checkout(self, target: str) -> str:
+        """Checks out a branch or a commit, and returns the commit id."""
+        return wit.checkout_commit(self.backup_folder, target)
+
+    def branch(self, name: str) -> str:
+        """Creates a branch at HEAD, and returns the commit id it points at."""
+        if wit.is_branch(self.backup_folder, name) is not None:
+            raise wit.WitError("Branch name is already exist.")
+        return wit.add_branch(self.backup_folder, name)
+
+    def merge(self, branch: str) -> MergeResult:
+        """Merges a branch into HEAD, see wit.merge_branch."""
+        commit_id, conflicts = wit.merge_branch(self.backup_folder, branch)
+        return MergeResult(commit_id, list(conflicts))
+
+    def log(self, revision: Optional[str] = None, limit: Optional[int] = None,
+            first_parent: bool = False, since: Optional[datetime] = None,
+            until: Optional[datetime] = None) -> List[LogEntry]:
+        """Returns the history of HEAD or of a branch or commit, newest first.
+
+        Args:
+            revision (str, optional): A branch name or a commit id, defaults to HEAD.
+            limit (int, optional): The maximum number of commits.
+            first_parent (bool, optional): Follow only the first parent of merge commits.
+            since, until (datetime, optional): Only commits in a date range.
+        """
+        with locks.locked(self.backup_folder, refs=locks.SHARED):
+            commit_id = revision or wit.get_head(self.backup_folder)
+            commit_id = wit.is_branch(self.backup_folder, commit_id) or commit_id
+            if commit_id == 'None':
+                return []
+            if not wit.is_commit_id_valid(self.backup_folder, commit_id):
+                raise wit.WitError("Your commit id or branch name is not exist.")
+            history = wit.iter_history(
+                self.backup_folder, commit_id, first_parent,
+                int(since.timestamp()) if since is not None else None,
+                int(until.timestamp()) if until is not None else None,
+            )
+            return [
+                LogEntry(
+                    commit_id=commit,
+                    parents=wit.get_commit_parents(self.backup_folder, commit),
+                    date=info.get('date', ''),
+                    message=info.get('message', ''),
+                )
+                for commit, info in islice(history, limit)
+            ]
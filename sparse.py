@@ -0,0 +1,108 @@
+"""Sparse checkout, which limits the working tree to some directories.
+
+The selected directories are listed in '.wit/sparse-checkout', one per
+line, relative to the repository root. As in the cone mode of git, a
+selected directory brings all of its content, and the files directly in
+the root and in the parents of selected directories are always selected.
+Without that file, the whole tree is selected.
+
+Only the selected files are placed in the working tree and the staging
+area, and working tree walks prune the other directories, so checkout,
+status and add scale with the selection instead of the repository. The
+index still lists every file of the tree, so commits carry the files which
+are not selected forward unchanged.
+"""
+import os
+from typing import Iterable, List, Optional, Set
+
+
+SPARSE_FILE: str = 'sparse-checkout'
+
+
+def normalize_directory(directory: str) -> str:
+    """Return a directory as a normalized relative path.
+
+    Raises:
+        ValueError: If the directory is not inside the repository.
+    """
+    normalized = os.path.normpath(directory.replace('/', os.sep).strip(os.sep))
+    if normalized == os.curdir or os.path.isabs(directory) or normalized.split(os.sep)[0] == os.pardir:
+        raise ValueError(directory)
+    return normalized
+
+
+class SparseSet:
+    """The selected directories of a sparse checkout, None selects the whole tree."""
+
+    def __init__(self, directories: Optional[Iterable[str]] = None) -> None:
+        self.directories: Optional[Set[str]] = None
+        self.parents: Set[str] = set()
+        if directories is None:
+            return
+        self.directories = {normalize_directory(directory) for directory in directories}
+        for directory in self.directories:
+            parent = os.path.dirname(directory)
+            while parent:
+                self.parents.add(parent)
+                parent = os.path.dirname(parent)
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.directories is not None
+
+    def _is_selected_directory(self, relative_dir: str) -> bool:
+        """Check if a directory is a selected directory or is inside one."""
+        while relative_dir:
+            if relative_dir in self.directories:
+                return True
+            relative_dir = os.path.dirname(relative_dir)
+        return False
+
+    def includes(self, relative_path: str) -> bool:
+        """Check if a file is part of the working tree."""
+        if self.directories is None:
+            return True
+        directory = os.path.dirname(relative_path)
+        return not directory or directory in self.parents or self._is_selected_directory(directory)
+
+    def includes_directory(self, relative_dir: str) -> bool:
+        """Check if a directory may hold selected files, so walks must enter it."""
+        if self.directories is None:
+            return True
+        return relative_dir in self.parents or self._is_selected_directory(relative_dir)
+
+    def prune(self, relative_path: str, entry: os.DirEntry) -> bool:
+        """Prune callback for directory walks, see dirscomparison.walk_files."""
+        if self.directories is None:
+            return False
+        if entry.is_dir(follow_symlinks=False):
+            return not self.includes_directory(relative_path)
+        return not self.includes(relative_path)
+
+
+def sparse_path(backup_folder: str) -> str:
+    return os.path.join(backup_folder, SPARSE_FILE)
+
+
+def load_sparse(backup_folder: str) -> SparseSet:
+    """Returns the sparse checkout selection of a repository."""
+    try:
+        with open(sparse_path(backup_folder), 'r') as file:
+            lines = file.read().splitlines()
+    except FileNotFoundError:
+        return SparseSet()
+    return SparseSet(line.strip() for line in lines if line.strip() and not line.startswith('#'))
+
+
+def save_sparse(backup_folder: str, directories: Optional[List[str]]) -> None:
+    """Writes the selected directories, None disables the sparse checkout."""
+    path = sparse_path(backup_folder)
+    if directories is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        file.writelines(f"{directory.replace(os.sep, '/')}\n" for directory in sorted(directories))
+    os.replace(temp_path, path)
+    return None
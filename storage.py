@@ -0,0 +1,110 @@
+"""File placement modes for the staging area and the object store.
+
+COPY duplicates the file bytes. HARDLINK and REFLINK only add metadata:
+a hard link shares the same inode, and a reflink (FICLONE) shares the data
+blocks copy-on-write, on filesystems which support it (btrfs, XFS...).
+When linking is not possible the file is copied instead.
+
+Hard linked files must be replaced and not edited in place, since an in
+place edit would change every linked copy. Files are always written through
+a temporary name and renamed over their destination, and hard links are
+only made between files inside '.wit', never with working tree files.
+"""
+import contextlib
+import os
+import shutil
+import tempfile
+from typing import Iterator, TextIO
+
+import iolimit
+import tracing
+
+
+COPY: str = 'copy'
+HARDLINK: str = 'hardlink'
+REFLINK: str = 'reflink'
+MODES = (COPY, HARDLINK, REFLINK)
+
+FICLONE: int = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+
+
+def working_tree_mode(mode: str) -> str:
+    """Return the mode to use for files going to or coming from the working tree."""
+    if mode == HARDLINK:
+        return COPY
+    return mode
+
+
+def reflink(source: str, destination: str) -> None:
+    """Clone a file copy-on-write, raises OSError if it is not supported."""
+    import fcntl  # Not available on Windows.
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, destination)
+    return None
+
+
+def _place(source: str, destination: str, mode: str) -> None:
+    """Places a file in a destination path which does not exist yet."""
+    if mode == HARDLINK:
+        try:
+            os.link(source, destination)
+            tracing.count('files_linked')
+            return None
+        except OSError:
+            pass
+    elif mode == REFLINK:
+        try:
+            reflink(source, destination)
+            tracing.count('files_reflinked')
+            return None
+        except (OSError, ImportError):
+            pass
+    shutil.copy2(source, destination)
+    tracing.count('files_copied')
+    if tracing.is_enabled() or iolimit.is_limited():
+        size = os.path.getsize(destination)
+        tracing.count('bytes_copied', size)
+        iolimit.consume(size)
+    return None
+
+
+def place_file(source: str, destination: str, mode: str = COPY) -> None:
+    """Puts a file in a destination path using the given storage mode.
+
+    The destination is replaced at once, which also breaks any link it had.
+    """
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return None
+    directory = os.path.dirname(destination)
+    descriptor, temp_path = tempfile.mkstemp(prefix='.wit-tmp-', dir=directory)
+    os.close(descriptor)
+    os.remove(temp_path)
+    try:
+        _place(source, temp_path, mode)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return None
+
+
+@contextlib.contextmanager
+def replacing(path: str) -> Iterator[TextIO]:
+    """Opens a new text file which replaces path at once, when the block ends without error.
+
+    Every writer gets its own temporary file next to path, so threads and
+    processes which write the same file never write into each other's.
+    """
+    descriptor, temp_path = tempfile.mkstemp(
+        prefix=f'{os.path.basename(path)}.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(descriptor, 'w') as file:
+            yield file
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
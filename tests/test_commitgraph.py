@@ -0,0 +1,56 @@
+import commitgraph
+
+
+def make_graph(tmp_path, commits):
+    """Builds a graph from {commit id: (parent ids, timestamp)}."""
+    return commitgraph.rebuild_graph(str(tmp_path), commits, lambda commit_id: commits[commit_id])
+
+
+def test_merge_base_of_diverged_branches(tmp_path):
+    graph = make_graph(tmp_path, {
+        'a': ([], 1), 'b': (['a'], 2), 'c': (['b'], 3), 'd': (['b'], 4), 'e': (['d'], 5),
+    })
+    assert commitgraph.merge_base(graph, 'c', 'e') == 'b'
+    assert commitgraph.merge_base(graph, 'e', 'c') == 'b'
+
+
+def test_merge_base_of_an_ancestor_is_the_ancestor(tmp_path):
+    graph = make_graph(tmp_path, {'a': ([], 1), 'b': (['a'], 2), 'c': (['b'], 3)})
+    assert commitgraph.merge_base(graph, 'a', 'c') == 'a'
+    assert commitgraph.merge_base(graph, 'c', 'c') == 'c'
+
+
+def test_merge_base_after_a_merge_is_the_merged_commit(tmp_path):
+    # 'm' merged 'b2' into 'a2', so the next merge of 'b3' only starts from 'b2'.
+    graph = make_graph(tmp_path, {
+        'root': ([], 1), 'a1': (['root'], 2), 'b1': (['root'], 3), 'b2': (['b1'], 4),
+        'a2': (['a1'], 5), 'm': (['a2', 'b2'], 6), 'b3': (['b2'], 7),
+    })
+    assert commitgraph.merge_base(graph, 'm', 'b3') == 'b2'
+
+
+def test_merge_base_of_criss_cross_merges(tmp_path):
+    # 'x' and 'y' both merge 'b' and 'c', each of them is a best common ancestor.
+    graph = make_graph(tmp_path, {
+        'a': ([], 1), 'b': (['a'], 2), 'c': (['a'], 3),
+        'x': (['b', 'c'], 4), 'y': (['c', 'b'], 5),
+        'x1': (['x'], 6), 'y1': (['y'], 7),
+    })
+    base = commitgraph.merge_base(graph, 'x1', 'y1')
+    assert base in ('b', 'c')
+    assert base != 'a'
+    # The same ancestor is chosen whatever the order of the commits.
+    assert commitgraph.merge_base(graph, 'y1', 'x1') == base
+
+
+def test_merge_base_of_unrelated_histories(tmp_path):
+    graph = make_graph(tmp_path, {'a': ([], 1), 'b': (['a'], 2), 'c': ([], 3), 'd': (['c'], 4)})
+    assert commitgraph.merge_base(graph, 'b', 'd') is None
+
+
+def test_graph_file_round_trip(tmp_path):
+    commits = {'a': ([], 1), 'b': (['a'], 2), 'c': (['a'], 3), 'd': (['b', 'c'], 4)}
+    graph = make_graph(tmp_path, commits)
+    commitgraph.add_commit(str(tmp_path), 'e', ['d'], 5, graph)
+    assert commitgraph.read_graph(str(tmp_path)) == graph
+    assert graph.generations[graph.positions['e']] == 4
@@ -0,0 +1,38 @@
+import os
+
+import wit
+from repository import Repository
+
+
+def commit_files(tmp_path, count):
+    repository = Repository.init(str(tmp_path))
+    commits = []
+    for number in range(count):
+        (tmp_path / 'file.txt').write_text(str(number))
+        repository.add('file.txt')
+        commits.append(repository.commit(f'commit {number}'))
+    return repository, commits
+
+
+def draw(tmp_path, *options):
+    wit.graph('--output', 'graph.dot', *options, path=str(tmp_path))
+    return (tmp_path / 'graph.dot').read_text()
+
+
+def test_graph_is_cached_by_its_options(tmp_path):
+    repository, commits = commit_files(tmp_path, 3)
+    full = draw(tmp_path)
+    assert all(f'"{commit_id}" [label=' in full for commit_id in commits)
+    newest = draw(tmp_path, '--max-commits', '1')
+    assert f'"{commits[-1]}" [label=' in newest
+    assert f'"{commits[0]}" [label=' not in newest
+    assert draw(tmp_path) == full
+
+
+def test_graph_cache_without_its_key_is_written_again(tmp_path):
+    repository, commits = commit_files(tmp_path, 2)
+    full = draw(tmp_path)
+    cache_path = os.path.join(repository.backup_folder, wit.GRAPH_CACHE)
+    with open(cache_path, 'w') as file:
+        file.write('digraph "stale" {\n}\n')  # As written by another call, with other options.
+    assert draw(tmp_path) == full
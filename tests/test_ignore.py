@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import ignore
+import wit
+from repository import Repository
+
+
+@pytest.mark.parametrize('pattern, path, is_dir, ignored', [
+    ('*.o', 'out.o', False, True),
+    ('*.o', 'src/deep/out.o', False, True),
+    ('*.o', 'out.c', False, False),
+    ('build/', 'build', True, True),
+    ('build/', 'build', False, False),
+    ('build/', 'src/build', True, True),
+    ('/build', 'src/build', True, False),
+    ('src/*.txt', 'src/a.txt', False, True),
+    ('src/*.txt', 'src/sub/a.txt', False, False),
+    ('src/**/a.txt', 'src/sub/deep/a.txt', False, True),
+    ('src/**/a.txt', 'src/a.txt', False, True),
+    ('file?.txt', 'file1.txt', False, True),
+    ('file[0-3].txt', 'file4.txt', False, False),
+])
+def test_patterns(pattern, path, is_dir, ignored):
+    rules = ignore.IgnoreRules('.', [pattern])
+    assert rules.is_ignored(path.replace('/', os.sep), is_dir) == ignored
+
+
+def test_last_matching_pattern_wins():
+    rules = ignore.IgnoreRules('.', ['*.log', '!keep.log'])
+    assert rules.is_ignored('debug.log', False)
+    assert not rules.is_ignored('keep.log', False)
+    rules = ignore.IgnoreRules('.', ['!keep.log', '*.log'])
+    assert rules.is_ignored('keep.log', False)
+
+
+def test_files_inside_ignored_directories_are_ignored():
+    rules = ignore.IgnoreRules('.', ['build/'])
+    assert rules.is_path_ignored(os.path.join('build', 'sub', 'out.o'))
+    assert not rules.is_path_ignored(os.path.join('src', 'out.o'))
+
+
+def test_comments_and_blank_lines_are_skipped(tmp_path):
+    (tmp_path / ignore.IGNORE_FILE).write_text('# comment\n\n*.o  \n')
+    assert ignore.read_patterns(str(tmp_path)) == ['*.o']
+
+
+def make_old(path):
+    """Moves a directory mtime out of the racy window, so its ignored names are cached."""
+    old = os.stat(path).st_mtime - 10
+    os.utime(path, (old, old))
+
+
+def test_ignored_files_are_not_untracked(tmp_path):
+    repository = Repository.init(str(tmp_path))
+    (tmp_path / ignore.IGNORE_FILE).write_text('build/\n*.o\n')
+    (tmp_path / 'build').mkdir()
+    (tmp_path / 'build' / 'out.o').write_text('binary')
+    (tmp_path / 'main.o').write_text('binary')
+    (tmp_path / 'main.c').write_text('source')
+    make_old(tmp_path)
+    for _ in range(2):  # The second run reads the ignored names from the cache.
+        assert repository.status().untracked == [ignore.IGNORE_FILE, 'main.c']
+    assert os.path.exists(os.path.join(repository.backup_folder, ignore.CACHE_FILE))
+
+
+def test_cache_is_complete_after_a_sparse_status(tmp_path):
+    repository = Repository.init(str(tmp_path))
+    (tmp_path / ignore.IGNORE_FILE).write_text('build/\n')
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'main.c').write_text('source')
+    repository.add(ignore.IGNORE_FILE, 'src')
+    repository.commit('initial')
+    wit.sparse_checkout('set', 'src', path=str(tmp_path))
+    (tmp_path / 'build').mkdir()
+    (tmp_path / 'build' / 'out.o').write_text('binary')
+    make_old(tmp_path)
+
+    assert repository.status().untracked == []
+    wit.sparse_checkout('disable', path=str(tmp_path))
+    assert repository.status().untracked == []
+    assert repository.add(add_all=True) == [ignore.IGNORE_FILE, os.path.join('src', 'main.c')]
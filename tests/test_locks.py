@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+
+import locks
+from repository import Repository
+
+
+def test_threads_exclude_each_other(tmp_path):
+    backup_folder = str(tmp_path)
+    events = []
+    locks.acquire(backup_folder, locks.INDEX, locks.EXCLUSIVE)
+
+    def reader():
+        with locks.locked(backup_folder, index=locks.SHARED):
+            events.append('read')
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    time.sleep(0.1)
+    events.append('write done')
+    locks.release(backup_folder, locks.INDEX)
+    thread.join(5)
+    assert events == ['write done', 'read']
+
+
+def test_shared_locks_are_held_together(tmp_path):
+    backup_folder = str(tmp_path)
+    inside = threading.Barrier(2, timeout=5)
+
+    def reader():
+        with locks.locked(backup_folder, index=locks.SHARED, refs=locks.SHARED):
+            inside.wait()
+
+    threads = [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not inside.broken
+
+
+def test_status_and_add_on_two_threads(tmp_path):
+    repository = Repository.init(str(tmp_path))
+    errors = []
+
+    def run(operation):
+        try:
+            for number in range(20):
+                operation(number)
+        except Exception as error:  # Reported by the assertion below.
+            errors.append(error)
+
+    def add(number):
+        (tmp_path / f'file{number}.txt').write_text(str(number))
+        repository.add(f'file{number}.txt')
+
+    threads = [
+        threading.Thread(target=run, args=(add,)),
+        threading.Thread(target=run, args=(lambda number: repository.status(),)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    assert errors == []
+    assert len(repository.status().staged) == 20
+
+
+def test_status_on_several_threads(tmp_path):
+    repository = Repository.init(str(tmp_path))
+    for number in range(20):
+        (tmp_path / f'file{number}.txt').write_text(str(number))
+    repository.add('.')
+    repository.commit('initial')
+    errors = []
+
+    def run():
+        try:
+            for _ in range(10):
+                for number in range(20):
+                    os.utime(tmp_path / f'file{number}.txt')  # The index and digest cache are written again.
+                repository.status()
+        except Exception as error:  # Reported by the assertion below.
+            errors.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+    assert errors == []
+    assert not [name for name in os.listdir(repository.backup_folder) if name.endswith('.tmp')]
@@ -0,0 +1,177 @@
+import io
+import os
+import random
+import time
+
+import pytest
+
+import merge3
+import objectstore
+
+
+def merge(base, ours, theirs):
+    output = io.BytesIO()
+    clean = merge3.merge_lines(
+        io.BytesIO(base), io.BytesIO(ours), io.BytesIO(theirs), output, labels=('ours', 'theirs'))
+    return clean, output.getvalue()
+
+
+def test_changes_on_different_lines_merge_cleanly():
+    base = b'a\nb\nc\nd\ne\n'
+    assert merge(base, b'A\nb\nc\nd\ne\n', b'a\nb\nc\nd\nE\n') == (True, b'A\nb\nc\nd\nE\n')
+
+
+def test_insertions_and_deletions_merge_cleanly():
+    base = b'a\nb\nc\nd\ne\n'
+    assert merge(base, b'a\nnew\nb\nc\nd\ne\n', b'a\nb\nc\ne\n') == (True, b'a\nnew\nb\nc\ne\n')
+
+
+def test_same_change_on_both_sides_is_clean():
+    base = b'a\nb\nc\n'
+    assert merge(base, b'a\nB\nc\n', b'a\nB\nc\n') == (True, b'a\nB\nc\n')
+
+
+def test_change_on_one_side_only():
+    base = b'a\nb\nc\n'
+    assert merge(base, base, b'a\nb\nc\nd\n') == (True, b'a\nb\nc\nd\n')
+    assert merge(base, b'b\nc\n', base) == (True, b'b\nc\n')
+
+
+def test_conflicting_changes_get_a_conflict_region():
+    base = b'a\nb\nc\nd\ne\n'
+    clean, result = merge(base, b'a\nours\nc\nd\nE\n', b'a\ntheirs\nc\nd\ne\n')
+    assert not clean
+    assert result == (
+        b'a\n'
+        b'<<<<<<< ours\nours\n=======\ntheirs\n>>>>>>> theirs\n'
+        b'c\nd\nE\n'
+    )
+
+
+def test_insertions_at_the_same_place_conflict():
+    base = b'a\nb\n'
+    clean, result = merge(base, b'a\nx\nb\n', b'a\ny\nb\n')
+    assert not clean
+    assert result == b'a\n<<<<<<< ours\nx\n=======\ny\n>>>>>>> theirs\nb\n'
+
+
+def test_conflict_markers_start_on_their_own_line():
+    clean, result = merge(b'a\nb', b'a\nours', b'a\ntheirs')
+    assert not clean
+    assert result == b'a\n<<<<<<< ours\nours\n=======\ntheirs\n>>>>>>> theirs\n'
+
+
+def test_repeated_lines_merge_fast():
+    count = 20000
+    base = b'\n' * count
+    ours = b'\n' * (count // 3) + b'ours\n' + b'\n' * (count - count // 3)
+    theirs = b'\n' * (2 * count // 3) + b'theirs\n' + b'\n' * (count - 2 * count // 3)
+    start = time.perf_counter()
+    clean, result = merge(base, ours, theirs)
+    assert time.perf_counter() - start < 5
+    assert clean
+    assert result.count(b'ours\n') == result.count(b'theirs\n') == 1
+    assert len(result) == count + len(b'ours\ntheirs\n')
+
+
+def test_matching_blocks_are_ordered_equal_runs():
+    rng = random.Random(0)
+    for _ in range(500):
+        a = [rng.randrange(5) for _ in range(rng.randrange(40))]
+        b = [rng.choice((line, line, rng.randrange(7))) for line in a if rng.random() > 0.1]
+        blocks = merge3.matching_blocks(a, b)
+        assert blocks[-1] == (len(a), len(b), 0)
+        a_end = b_end = 0
+        for i, j, length in blocks:
+            assert i >= a_end and j >= b_end
+            assert a[i:i + length] == b[j:j + length]
+            a_end, b_end = i + length, j + length
+
+
+def store_tree(backup_folder, tmp_path, name, files):
+    directory = tmp_path / name
+    for relative_path, content in files.items():
+        path = directory / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    directory.mkdir(exist_ok=True)
+    return objectstore.build_tree(backup_folder, str(directory))
+
+
+@pytest.fixture
+def backup_folder(tmp_path):
+    folder = tmp_path / '.wit'
+    (folder / objectstore.OBJECTS).mkdir(parents=True)
+    return str(folder)
+
+
+def test_merge_trees(backup_folder, tmp_path):
+    base = store_tree(backup_folder, tmp_path, 'base', {
+        'same.txt': b'same\n',
+        'src/ours.txt': b'one\n',
+        'src/theirs.txt': b'one\n',
+        'both.txt': b'a\nb\nc\n',
+        'conflict.txt': b'a\n',
+        'deleted.txt': b'old\n',
+    })
+    ours = store_tree(backup_folder, tmp_path, 'ours', {
+        'same.txt': b'same\n',
+        'src/ours.txt': b'two\n',
+        'src/theirs.txt': b'one\n',
+        'both.txt': b'A\nb\nc\n',
+        'conflict.txt': b'ours\n',
+        'deleted.txt': b'changed\n',
+    })
+    theirs = store_tree(backup_folder, tmp_path, 'theirs', {
+        'same.txt': b'same\n',
+        'src/ours.txt': b'one\n',
+        'src/theirs.txt': b'two\n',
+        'src/added.txt': b'new\n',
+        'both.txt': b'a\nb\nC\n',
+        'conflict.txt': b'theirs\n',
+    })
+    changes, conflicts = merge3.merge_trees(backup_folder, base, ours, theirs)
+    assert conflicts == {'conflict.txt': merge3.BOTH_MODIFIED, 'deleted.txt': merge3.DELETED_BY_THEM}
+    assert sorted(changes) == ['both.txt', 'conflict.txt', 'src/added.txt', 'src/theirs.txt']
+    assert objectstore.read_object(backup_folder, changes['both.txt']) == b'A\nb\nC\n'
+    assert objectstore.read_object(backup_folder, changes['src/theirs.txt']) == b'two\n'
+    assert objectstore.read_object(backup_folder, changes['src/added.txt']) == b'new\n'
+    assert b'<<<<<<< ours' in objectstore.read_object(backup_folder, changes['conflict.txt'])
+
+
+def test_merge_trees_keeps_binary_files_of_ours(backup_folder, tmp_path):
+    base = store_tree(backup_folder, tmp_path, 'base', {'data.bin': b'\0base'})
+    ours = store_tree(backup_folder, tmp_path, 'ours', {'data.bin': b'\0ours'})
+    theirs = store_tree(backup_folder, tmp_path, 'theirs', {'data.bin': b'\0theirs'})
+    changes, conflicts = merge3.merge_trees(backup_folder, base, ours, theirs)
+    assert conflicts == {'data.bin': merge3.BOTH_MODIFIED}
+    assert changes == {}
+    assert not any(name.startswith('tmp-merge-') for name in os.listdir(
+        os.path.join(backup_folder, objectstore.OBJECTS)))
+
+
+def test_merge_trees_conflict_kinds(backup_folder, tmp_path):
+    base = store_tree(backup_folder, tmp_path, 'base', {
+        'deleted_by_us.txt': b'base\n',
+        'deleted_by_them.txt': b'base\n',
+        'kind.txt': b'base\n',
+    })
+    ours = store_tree(backup_folder, tmp_path, 'ours', {
+        'deleted_by_them.txt': b'ours\n',
+        'kind.txt': b'ours\n',
+        'added.txt': b'ours\n',
+    })
+    theirs = store_tree(backup_folder, tmp_path, 'theirs', {
+        'deleted_by_us.txt': b'theirs\n',
+        'kind.txt/file.txt': b'theirs\n',
+        'added.txt': b'theirs\n',
+    })
+    changes, conflicts = merge3.merge_trees(backup_folder, base, ours, theirs)
+    assert conflicts == {
+        'added.txt': merge3.BOTH_ADDED,
+        'deleted_by_them.txt': merge3.DELETED_BY_THEM,
+        'deleted_by_us.txt': merge3.DELETED_BY_US,
+        'kind.txt': merge3.FILE_DIRECTORY,
+    }
+    # Theirs version of a file ours deleted is left for the user to resolve.
+    assert objectstore.read_object(backup_folder, changes['deleted_by_us.txt']) == b'theirs\n'
@@ -0,0 +1,78 @@
+import os
+import shutil
+import time
+
+import pytest
+
+import pack
+
+
+def round_trip(base, target):
+    delta = pack.make_delta(base, target)
+    assert pack.apply_delta(base, delta) == target
+    return delta
+
+
+@pytest.mark.parametrize('base, target', [
+    (b'', b''),
+    (b'', b'new content\n'),
+    (b'old content\n', b''),
+    (b'same\n' * 100, b'same\n' * 100),
+    (b'a\nb\nc\n' * 50, b'a\nb\nX\n' * 50),
+    (bytes(range(256)) * 20, bytes(range(255, -1, -1)) * 20),
+])
+def test_delta_round_trip(base, target):
+    round_trip(base, target)
+
+
+def test_delta_copies_the_unchanged_parts():
+    base = b''.join(b'line %d of the file\n' % i for i in range(5000))
+    target = base.replace(b'line 2500 ', b'changed line ')
+    assert len(round_trip(base, target)) < 200
+
+
+@pytest.mark.parametrize('base, target', [
+    (bytes(512 * 1024), bytes(512 * 1024 - 10) + b'x' * 10),
+    (b'\n' * (512 * 1024), b'\n' * (256 * 1024) + b'inserted\n' + b'\n' * (256 * 1024)),
+    (bytes(512 * 1024), bytes(256 * 1024) + b'inserted header' + bytes(256 * 1024)),
+])
+def test_delta_of_repetitive_data_is_fast_and_small(base, target):
+    start = time.perf_counter()
+    delta = round_trip(base, target)
+    assert time.perf_counter() - start < 5
+    assert len(delta) < 200
+
+
+def test_delta_of_shifted_random_data():
+    base = os.urandom(256 * 1024)
+    target = base[:1000] + b'inserted' + base[1000:100000] + base[100100:]
+    assert len(round_trip(base, target)) < 5000
+
+
+def test_packed_objects_round_trip(tmp_path):
+    contents = {
+        'base': b'first version\n' * 1000,
+        'next': b'first version\n' * 500 + b'second version\n' + b'first version\n' * 500,
+        'other': os.urandom(5000),
+    }
+    pack_path = pack.write_pack(str(tmp_path), contents, contents.__getitem__, {'next': 'base'})
+    assert os.path.exists(pack_path)
+    for object_id, content in contents.items():
+        assert pack.read_object(str(tmp_path), object_id) == content
+    assert pack.read_object(str(tmp_path), 'missing') is None
+    pack.clear_cache(str(tmp_path))
+
+
+def test_packs_written_by_another_process_are_found(tmp_path):
+    backup_folder = str(tmp_path)
+    pack.write_pack(backup_folder, ['one'], lambda object_id: b'one', {})
+    assert pack.read_object(backup_folder, 'one') == b'one'
+    # Another process replaces the pack, the loaded list is now stale.
+    other = tmp_path / 'other'
+    pack.write_pack(str(other), ['one', 'two'], lambda object_id: object_id.encode(), {})
+    shutil.rmtree(pack.pack_dir(backup_folder))
+    shutil.copytree(pack.pack_dir(str(other)), pack.pack_dir(backup_folder))
+    assert pack.read_object(backup_folder, 'two') == b'two'
+    assert pack.has_object(backup_folder, 'one')
+    pack.clear_cache(backup_folder)
+    pack.clear_cache(str(other))
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+import objectstore
+import wit
+from repository import Repository
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return Repository.init(str(tmp_path))
+
+
+def write(repository, relative_path, content):
+    with open(f'{repository.root}/{relative_path}', 'w') as file:
+        file.write(content)
+
+
+def test_merge_of_a_branch(repository):
+    write(repository, 'ours.txt', 'one\n')
+    write(repository, 'theirs.txt', 'one\n')
+    repository.add('ours.txt', 'theirs.txt')
+    repository.commit('initial')
+    repository.branch('feature')
+    repository.checkout('feature')
+    write(repository, 'theirs.txt', 'two\n')
+    repository.add('theirs.txt')
+    feature = repository.commit('feature change')
+    repository.checkout('master')
+    write(repository, 'ours.txt', 'two\n')
+    repository.add('ours.txt')
+    repository.commit('master change')
+
+    result = repository.merge('feature')
+    assert result.conflicts == []
+    assert result.commit_id == repository.head
+    assert wit.get_commit_parents(repository.backup_folder, result.commit_id)[1] == feature
+    with open(f'{repository.root}/theirs.txt') as file:
+        assert file.read() == 'two\n'
+
+
+def test_merge_of_a_branch_without_commits(repository):
+    repository.branch('empty')
+    write(repository, 'file.txt', 'content\n')
+    repository.add('file.txt')
+    repository.commit('initial')
+    with pytest.raises(wit.WitError, match='no commits yet'):
+        repository.merge('empty')
+
+
+def test_merge_before_the_first_commit(repository):
+    with pytest.raises(wit.WitError, match='no commits yet'):
+        repository.merge('master')
+
+
+def conflicting_branches(repository):
+    """Master modifies modified.txt and deletes deleted.txt, the branch 'side' does the opposite."""
+    write(repository, 'modified.txt', 'base\n')
+    write(repository, 'deleted.txt', 'base\n')
+    repository.add('modified.txt', 'deleted.txt')
+    repository.commit('initial')
+    repository.branch('side')
+    repository.checkout('side')
+    write(repository, 'modified.txt', 'side\n')
+    write(repository, 'deleted.txt', 'side\n')
+    repository.add('modified.txt', 'deleted.txt')
+    side = repository.commit('side change')
+    repository.checkout('master')
+    write(repository, 'modified.txt', 'master\n')
+    os.remove(f'{repository.root}/deleted.txt')
+    repository.add(add_all=True)
+    repository.commit('master change')
+    return side
+
+
+def test_merge_conflicts_are_not_committed_until_added(repository):
+    side = conflicting_branches(repository)
+    result = repository.merge('side')
+    assert result.commit_id is None
+    assert result.conflicts == ['deleted.txt', 'modified.txt']
+    with open(f'{repository.root}/modified.txt') as file:
+        assert '<<<<<<< HEAD' in file.read()
+    status = repository.status()
+    assert status.staged == []
+    assert status.modified == ['modified.txt']
+    with pytest.raises(wit.WitError, match='deleted.txt, modified.txt'):
+        repository.commit('with conflict markers')
+
+    write(repository, 'modified.txt', 'resolved\n')
+    repository.add('modified.txt', 'deleted.txt')
+    commit_id = repository.commit('merge side')
+    assert wit.get_commit_parents(repository.backup_folder, commit_id)[1] == side
+    assert not os.path.exists(os.path.join(repository.backup_folder, wit.MERGE_CONFLICTS))
+
+
+def test_deletion_resolves_a_conflict_with_add_all(repository):
+    conflicting_branches(repository)
+    repository.merge('side')
+    os.remove(f'{repository.root}/deleted.txt')
+    write(repository, 'modified.txt', 'resolved\n')
+    repository.add(add_all=True)
+    commit_id = repository.commit('merge side')
+    tree = wit.get_commit_tree(repository.backup_folder, commit_id)
+    assert [file for file, _ in objectstore.walk_tree(repository.backup_folder, tree)] == ['modified.txt']
+
+
+def test_checkout_and_merge_wait_for_a_merge_in_progress(repository):
+    conflicting_branches(repository)
+    repository.merge('side')
+    with pytest.raises(wit.WitError, match='merge is in progress'):
+        repository.checkout('side')
+    with pytest.raises(wit.WitError, match='merge is in progress'):
+        repository.merge('side')
+
+
+def test_merge_prints_the_kind_of_conflicts(repository, capsys):
+    conflicting_branches(repository)
+    wit.merge('side', path=repository.root)
+    output = capsys.readouterr().out
+    assert 'deleted by us: deleted.txt' in output
+    assert 'both modified: modified.txt' in output
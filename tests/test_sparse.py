@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import objectstore
+import sparse
+import wit
+from repository import Repository
+
+
+def test_whole_tree_without_selection():
+    selection = sparse.SparseSet()
+    assert not selection.is_enabled
+    assert selection.includes(os.path.join('any', 'file.txt'))
+    assert selection.includes_directory('any')
+
+
+def test_selected_directories_and_their_parents():
+    selection = sparse.SparseSet([os.path.join('src', 'app')])
+    assert selection.includes('root.txt')
+    assert selection.includes(os.path.join('src', 'file.txt'))
+    assert selection.includes(os.path.join('src', 'app', 'deep', 'file.txt'))
+    assert not selection.includes(os.path.join('src', 'other', 'file.txt'))
+    assert not selection.includes(os.path.join('docs', 'file.txt'))
+    assert selection.includes_directory('src')
+    assert not selection.includes_directory('docs')
+
+
+@pytest.mark.parametrize('directory', ['', '.', '..', os.path.join('..', 'outside'), os.path.abspath(os.sep)])
+def test_directories_outside_the_repository_are_rejected(directory):
+    with pytest.raises(ValueError):
+        sparse.normalize_directory(directory)
+
+
+def test_normalize_directory():
+    assert sparse.normalize_directory('src/app/') == os.path.join('src', 'app')
+
+
+def test_save_and_load(tmp_path):
+    sparse.save_sparse(str(tmp_path), ['src', 'docs'])
+    assert sparse.load_sparse(str(tmp_path)).directories == {'src', 'docs'}
+    sparse.save_sparse(str(tmp_path), None)
+    assert not sparse.load_sparse(str(tmp_path)).is_enabled
+
+
+def test_sparse_checkout_limits_the_working_tree(tmp_path):
+    repository = Repository.init(str(tmp_path))
+    for directory in ('src', 'docs'):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / 'file.txt').write_text(directory)
+    repository.add('src', 'docs')
+    repository.commit('initial')
+
+    wit.sparse_checkout('set', 'src', path=str(tmp_path))
+    assert not (tmp_path / 'docs').exists()
+    assert repository.status() == (repository.head, [], [], [])
+    (tmp_path / 'src' / 'file.txt').write_text('changed')
+    repository.add(add_all=True)
+    commit_id = repository.commit('change')
+    tree = wit.get_commit_tree(repository.backup_folder, commit_id)
+    # The files out of the selection are carried forward.
+    assert sorted(file for file, _ in objectstore.walk_tree(repository.backup_folder, tree)) == [
+        os.path.join('docs', 'file.txt'), os.path.join('src', 'file.txt')]
+
+    wit.sparse_checkout('disable', path=str(tmp_path))
+    assert (tmp_path / 'docs' / 'file.txt').read_text() == 'docs'
+    assert (tmp_path / 'src' / 'file.txt').read_text() == 'changed'
+    assert repository.status() == (commit_id, [], [], [])
@@ -0,0 +1,175 @@
+"""Tracing of wit commands, to find out where their time goes.
+
+Tracing is off unless a command runs with '--profile', or with the WIT_TRACE
+environment variable set to a file path, or to '1' for the standard error.
+A traced command records the time spent in named phases and counters such
+the files read or copied and the bytes they moved, and writes them as JSON
+lines when it ends: one line per phase, then one line for the command.
+'--profile-output FILE' also dumps cProfile statistics of the command, to
+be read with 'python -m pstats FILE'.
+
+When tracing is off, 'span' returns a shared empty context and 'count'
+returns at once, so instrumented code pays a function call at most.
+Counters may be updated by the workers, they are locked.
+"""
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+
+ENVIRONMENT_VARIABLE: str = 'WIT_TRACE'
+STANDARD_ERROR: str = '1'
+
+
+class Tracer:
+    """The phases and counters of a traced command."""
+
+    def __init__(self, command: str) -> None:
+        self.command = command
+        self.phases: Dict[str, List[float]] = {}  # name -> [calls, seconds]
+        self.counters: Dict[str, int] = {}
+        import threading  # Only needed by traced commands.
+
+        self.lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += 1
+            phase[1] += seconds
+        return None
+
+    def count(self, name: str, amount: int) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        return None
+
+    def records(self, seconds: float) -> List[Dict[str, Any]]:
+        """Returns the JSON records of the command, its phases first."""
+        records: List[Dict[str, Any]] = [
+            {'command': self.command, 'phase': name, 'calls': int(calls), 'seconds': round(total, 6)}
+            for name, (calls, total) in self.phases.items()
+        ]
+        records.append({
+            'command': self.command,
+            'seconds': round(seconds, 6),
+            'counters': dict(sorted(self.counters.items())),
+        })
+        return records
+
+
+class _NullSpan:
+    """The context returned when tracing is off."""
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> bool:
+        return False
+
+
+class _Span:
+    """Adds its duration to a phase of the current tracer."""
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> '_Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> bool:
+        if _tracer is not None:
+            _tracer.add_phase(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _Command:
+    """Traces a whole command, and writes its records when it ends."""
+
+    def __init__(self, name: str, output: str, profile_output: Optional[str]) -> None:
+        self.name = name
+        self.output = output
+        self.profile_output = profile_output
+        self.profiler = None
+        self.start = 0.0
+
+    def __enter__(self) -> '_Command':
+        global _tracer
+        _tracer = Tracer(self.name)
+        if self.profile_output is not None:
+            import cProfile  # Only needed when profiling.
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> bool:
+        global _tracer
+        seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_output)
+        tracer, _tracer = _tracer, None
+        write_records(self.output, tracer.records(seconds))
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_tracer: Optional[Tracer] = None
+_forced: bool = False
+_profile_output: Optional[str] = None
+
+
+def configure(profile: bool = False, profile_output: Optional[str] = None) -> None:
+    """Turns tracing on for the next commands, as '--profile' and '--profile-output' do."""
+    global _forced, _profile_output
+    _forced = profile or profile_output is not None
+    _profile_output = profile_output
+    return None
+
+
+def is_enabled() -> bool:
+    """Check if a command is being traced, for counters which are costly to compute."""
+    return _tracer is not None
+
+
+def span(name: str):
+    """Returns a context which adds its duration to a named phase."""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Adds an amount to a named counter."""
+    if _tracer is not None:
+        _tracer.count(name, amount)
+    return None
+
+
+def command(name: str):
+    """Returns a context which traces a command, if tracing was asked for."""
+    output = os.environ.get(ENVIRONMENT_VARIABLE) or (STANDARD_ERROR if _forced else None)
+    if output is None or _tracer is not None:
+        return _NULL_SPAN
+    return _Command(name, output, _profile_output)
+
+
+def write_records(output: str, records: List[Dict[str, Any]]) -> None:
+    """Writes records as JSON lines, appended to a file or to the standard error."""
+    import json  # Only needed by traced commands.
+
+    lines = ''.join(json.dumps(record) + '\n' for record in records)
+    if output in (STANDARD_ERROR, '-'):
+        sys.stderr.write(lines)
+        sys.stderr.flush()
+        return None
+    with open(output, 'a') as file:
+        file.write(lines)
+    return None
@@ -1,28 +1,56 @@
 from datetime import datetime
+import functools
+import glob
+import hashlib
 import os
 import os.path
-import random
 import shutil  # copy files operations
 import string
 import sys
-from typing import Any, Dict, List, Optional, Union
+import time
+from typing import Any, Callable, Collection, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import commitgraph
+import daemon
+import digests
 import dirscomparison  # A basic module I created for folders comparisons.
-from graphviz import Digraph  # type: ignore
-import pytz
+import ignore
+import index
+import iolimit
+import locks
+import merge3
+import objectstore
+import refs
+import sparse
+import storage
+import tracing
+import workers
 
 
 BACKUP_DIR_NAME: str = '.wit'
-WIT_METADATA_FILE: str = 'references.txt'
+WIT_METADATA_FILE: str = refs.REFERENCES_FILE
 STAGING_AREA: str = 'staging_area'
 IMAGES: str = 'images'
 ACTIVATE_BRANCH: str = 'activated.txt'
+CONFIG_FILE: str = 'config.txt'
+MERGE_HEAD: str = 'MERGE_HEAD'
+MERGE_CONFLICTS: str = 'MERGE_CONFLICTS'
+COMMIT_CACHE_SIZE: int = 8192
+GRAPH_CACHE: str = 'graph.dot'
+GRAPH_OUTPUT: str = 'graph.png'
+LEGACY_TREES: str = 'legacy-trees'
+
+_graphs: Dict[str, Tuple[Tuple[int, int, int], commitgraph.CommitGraph]] = {}
+
+
+class WitError(Exception):
+    """An operation which can not be done, the command line prints its message."""
 
 
 def run_only_if_backup(f):
     """Decorator, will run function only if there is a backup directory in path."""
     def wrapper(*args, **kargs):
-        if f.__name__ == 'add':
+        if f.__name__ == 'add' and args and not args[0].startswith('-'):
             full_path = is_abs_path(args[0], kargs['path'])
         else:
             full_path = kargs['path']
@@ -33,22 +61,78 @@ def run_only_if_backup(f):
 
 
 def init(*args: str, **kargs: str) -> None:
-    """Creates initial folders for backup."""
-    path: str = kargs['path']
-    sub_folders: List[str] = [IMAGES, STAGING_AREA]
+    """Creates initial folders for backup.
+
+    The storage mode can be chosen with '--storage MODE', see the storage module.
+    """
+    _, mode = pop_option(list(args), '--storage')
+    try:
+        init_repository(kargs['path'], mode or storage.COPY)
+    except WitError as error:
+        print(error)
+    return None
+
+
+def init_repository(path: str, mode: str = storage.COPY) -> str:
+    """Creates the backup folder of a new repository and returns its path."""
+    if mode not in storage.MODES:
+        raise WitError(f"Storage mode should be one of: {', '.join(storage.MODES)}.")
+    sub_folders: List[str] = [IMAGES, STAGING_AREA, objectstore.OBJECTS]
     create_folders(path, BACKUP_DIR_NAME)
     backup_folder_path = os.path.join(path, BACKUP_DIR_NAME)
     create_folders(backup_folder_path, *sub_folders)
     backup_directory_metadata(backup_folder_path)
+    set_config(backup_folder_path, 'storage', mode)
+    return backup_folder_path
 
 
 def backup_directory_metadata(path: str) -> None:
     """Create the initial metadate for the backup folder."""
-    file_path: str = os.path.join(path, WIT_METADATA_FILE)
-    with open(file_path, 'w') as file:
-        file.write("HEAD=None\nmaster=None")
+    refs.save_refs(path, {refs.HEAD: 'None', refs.MASTER: 'None'})
     with open(os.path.join(path, ACTIVATE_BRANCH), 'w') as file:
         file.write('master')
+    index.write_index(path, {})
+    commitgraph.init_graph(path)
+
+
+def get_config(path: str) -> Dict[str, str]:
+    """Return the repository configuration."""
+    try:
+        with open(os.path.join(path, CONFIG_FILE), 'r') as file:
+            lines = [line.strip().partition('=') for line in file if line.strip()]
+    except FileNotFoundError:
+        return {}
+    return {key: value for key, _, value in lines}
+
+
+def set_config(path: str, key: str, value: str) -> None:
+    """Set a repository configuration value."""
+    config = get_config(path)
+    config[key] = value
+    with open(os.path.join(path, CONFIG_FILE), 'w') as file:
+        file.write('\n'.join(f"{key}={value}" for key, value in config.items()))
+    return None
+
+
+def get_storage_mode(path: str) -> str:
+    """Return the storage mode of the staging area and the object store."""
+    return get_config(path).get('storage', storage.COPY)
+
+
+@run_only_if_backup
+def config(*args: str, **kargs: str) -> None:
+    """Prints or sets a configuration value, such: 'python x.py config storage reflink'."""
+    path = kargs['backup_folder']
+    if not args:
+        for key, value in get_config(path).items():
+            print(f"{key}={value}")
+    elif len(args) == 1:
+        print(get_config(path).get(args[0], 'None'))
+    elif args[0] == 'storage' and args[1] not in storage.MODES:
+        print(f"Storage mode should be one of: {', '.join(storage.MODES)}.")
+    else:
+        set_config(path, args[0], args[1])
+    return None
 
 
 def create_folders(path: str, *args: str) -> None:
@@ -60,31 +144,177 @@ def create_folders(path: str, *args: str) -> None:
     Returns:
         None.
     """
-    os.chdir(path)
     for directory in args:
-        new_path = os.path.join(path, directory)
-        if not os.path.exists(new_path):
-            os.mkdir(directory)
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
 
 
 @run_only_if_backup
 def add(*args: str, **kargs: str) -> None:
-    """Adds files in given path to the neerest backup directory.
+    """Adds files to the neerest backup directory, all in a single index update.
 
     Args:
-        args (tuple): File \ directory name.
+        args (tuple): Files, directories or glob patterns, relative to the working directory.
+                      '-A' adds the whole working tree, deleted files included,
+                      and '--pathspec-from-file FILE' reads more paths from a file,
+                      one per line, or from the standard input if FILE is '-'.
         kargs (dict): Path of current working directory.
     Returns:
         None.
     """
     backup_folder = kargs['backup_folder']
-    full_path = kargs['full_path']
-    relative_path = os.path.join(
-        backup_folder, STAGING_AREA, args[0])
+    cwd = kargs['path']
+    inputs, pathspec_file = pop_option(list(args), '--pathspec-from-file')
+    add_all = '-A' in inputs or '--all' in inputs
+    pathspecs = [item for item in inputs if item not in ('-A', '--all')]
+    if pathspec_file is not None:
+        pathspecs.extend(read_pathspecs(pathspec_file, cwd))
+    if not pathspecs and not add_all:
+        print("You need to insert a path as argument such: 'python x.py add PATH")
+        return None
+    try:
+        _, outside = add_paths(backup_folder, pathspecs, cwd, add_all)
+    except WitError as error:
+        print(error)
+        return None
+    if outside:
+        print(f"Out of the sparse checkout, not added: {', '.join(outside)}")
+    return None
+
+
+def add_paths(backup_folder: str, pathspecs: List[str], cwd: str,
+              add_all: bool = False) -> Tuple[List[str], List[str]]:
+    """Stages files, directories and glob patterns, or nothing if one of them does not match.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        pathspecs (list): Paths or glob patterns, relative to cwd.
+        cwd (str): The directory of relative pathspecs.
+        add_all (bool, optional): Add the whole working tree, deleted files included.
+    Returns:
+        tuple: The staged files and the files out of the sparse checkout, as relative paths.
+    """
+    source_path = os.path.dirname(backup_folder)
+    full_paths = [source_path] if add_all else []
+    unmatched = []
+    for pathspec in pathspecs:
+        full_path = os.path.abspath(is_abs_path(pathspec, cwd))
+        if glob.has_magic(pathspec):
+            matches = sorted(glob.glob(full_path, recursive=True))
+        else:
+            matches = [full_path] if os.path.lexists(full_path) else []
+        if not matches or any(
+                os.path.relpath(match, source_path).split(os.sep)[0] == os.pardir for match in matches):
+            unmatched.append(pathspec)
+        full_paths.extend(matches)
+    if unmatched:
+        # Nothing is staged, so a batch is either added as a whole or not at all.
+        raise WitError(f"Did not match any files in the repository: {', '.join(unmatched)}")
+    return stage_files(backup_folder, full_paths, remove_missing=add_all)
+
+
+def read_pathspecs(pathspec_file: str, cwd: str) -> List[str]:
+    """Return the paths listed in a file, one per line, or in the standard input for '-'."""
+    if pathspec_file == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(is_abs_path(pathspec_file, cwd), 'r') as file:
+            lines = file.read().splitlines()
+    return [line for line in lines if line]
 
-    if os.path.dirname(relative_path) != STAGING_AREA:
-        os.makedirs(os.path.dirname(relative_path), exist_ok=True)
-    copy_files(full_path, relative_path, inside=True)
+
+@locks.holding(index=locks.EXCLUSIVE)
+def stage_files(backup_folder: str, full_paths: List[str],
+                remove_missing: bool = False) -> Tuple[List[str], List[str]]:
+    """Copies added files into the staging area, and records their stat data and content hash in the index.
+
+    All the given paths are collected first, the files are placed and hashed
+    by the workers, and the index is written once at the end. Ignored files
+    are skipped when a directory is added, see the ignore module, and files
+    out of the sparse checkout are never added, see the sparse module.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        full_paths (list): Files and directories to add.
+        remove_missing (bool, optional): Also remove the tracked files which were deleted,
+                                         only meaningful when the whole working tree is added.
+    Returns:
+        tuple: The staged files and the files out of the sparse checkout, as relative paths.
+    """
+    source_path = os.path.dirname(backup_folder)
+    staging_path = os.path.join(backup_folder, STAGING_AREA)
+    entries = load_index(backup_folder)
+    rules = ignore.load_rules(backup_folder)
+    selection = sparse.load_sparse(backup_folder)
+    prune = working_tree_prune(rules, selection)
+    found: Dict[str, Tuple[str, os.stat_result]] = {}
+    outside = []
+    with tracing.span('walk'):
+        for full_path in full_paths:
+            relative_path = os.path.relpath(full_path, source_path)
+            if relative_path == os.curdir:
+                relative_path = ''
+            if BACKUP_DIR_NAME in relative_path.split(os.sep):
+                continue
+            if not os.path.isdir(full_path):
+                if selection.includes(relative_path):
+                    found[relative_path] = (full_path, os.stat(full_path))
+                else:
+                    outside.append(relative_path)
+                continue
+            for file, entry in dirscomparison.walk_files(full_path, prune=prune, prefix=relative_path):
+                found[file] = (entry.path, entry.stat())
+    tracing.count('files_stat', len(found))
+    rules.save_cache()
+
+    if remove_missing:
+        for file in entries.keys() - found.keys():
+            if not selection.includes(file):
+                continue
+            file_path = os.path.join(source_path, file)
+            if os.path.isfile(file_path):
+                found[file] = (file_path, os.stat(file_path))  # Tracked, though ignored.
+            else:
+                entries.pop(file)
+                remove_file(staging_path, file)
+    files = [(file, file_path, stat) for file, (file_path, stat) in found.items()]
+
+    mode = storage.working_tree_mode(get_storage_mode(backup_folder))
+
+    def place(file: str, file_path: str) -> None:
+        destination = os.path.join(staging_path, file)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        storage.place_file(file_path, destination, mode)
+
+    with tracing.span('place'):
+        workers.run(place, (file for file, _, _ in files), (file_path for _, file_path, _ in files))
+    cache = digests.load_cache(backup_folder)
+    # The staged copies are hashed, their ids must match the content the commit stores.
+    with tracing.span('hash'):
+        object_ids = list(workers.imap(
+            lambda item: cache.digest(item[1], item[2], os.path.join(staging_path, item[0])), files))
+    for (file, _, stat), object_id in zip(files, object_ids):
+        entries[file] = index.make_entry(object_id, stat)
+    index.write_index(backup_folder, entries)
+    cache.save()
+    conflicts = get_conflicts(backup_folder)
+    if conflicts:
+        # Adding a conflicted file again, or its deletion with '-A', resolves it.
+        set_conflicts(backup_folder, [
+            file for file in conflicts
+            if file not in found
+            and not any(added.startswith(file + os.sep) for added in found)
+            and not (remove_missing and not os.path.lexists(os.path.join(source_path, file)))
+        ])
+    return sorted(found), outside
+
+
+def load_index(backup_folder: str) -> Dict[str, index.IndexEntry]:
+    """Return the staging area index, rebuilding it if it is missing."""
+    entries = index.read_index(backup_folder)
+    if entries is None:
+        staging_area = os.path.join(backup_folder, STAGING_AREA)
+        entries = index.rebuild_index(backup_folder, staging_area)
+    return entries
 
 
 def is_abs_path(path: str, cwd: str) -> str:
@@ -103,32 +333,16 @@ def find_directory(path: str, name: str = BACKUP_DIR_NAME) -> Any:
         str: Path of the parent direcory.
         None: In case directory is not in the path root.
     """
-    if os.path.isfile(path):
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
         path = os.path.dirname(path)
-    if name in os.listdir(path):
-        return os.path.join(path, name)
-    if len(path.split(os.sep)) == 1:
-        return None
-    return find_directory(os.path.dirname(path))
-
-
-def copy_files(copy_from: str, copy_to: str, inside=False) -> None:
-    """Copy file or full path directory to a given destination directory.
-
-    Args:
-        copy_from (str): Path indicates what to copy
-        copy_to   (str): Path indicates the copy destination directory.
-        inside   (bool): Indicate if to copy into a new folder or directly to the given path.
-    Returns:
-        None.
-    """
-    if not inside:
-        copy_to = os.path.join(copy_to, os.path.basename(copy_from))
-    if os.path.isfile(copy_from):
-        shutil.copy2(copy_from, copy_to)
-    else:
-        shutil.copytree(copy_from, copy_to, dirs_exist_ok=True)
-    return None
+    while True:
+        if os.path.isdir(os.path.join(path, name)):
+            return os.path.join(path, name)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
 
 
 def delete_dir(path: str, parent: bool = True) -> None:
@@ -144,85 +358,179 @@ def delete_dir(path: str, parent: bool = True) -> None:
     return None
 
 
-def create_metadata(path: str, name: str, message: str, parent: Optional[str] = None) -> None:
-    """Creates metadate for a file.
+def commit_date() -> datetime:
+    """Return the current time, as commit dates are recorded."""
+    import pytz  # Loaded on first use, to keep the startup of other commands fast.
+
+    greenwich = pytz.timezone('GB')
+    return greenwich.localize(datetime.now().replace(microsecond=0))
+
+
+def create_metadata(path: str, message: str, parent: Optional[str] = None,
+                    tree: str = objectstore.EMPTY_TREE, date: Optional[datetime] = None) -> str:
+    """Creates the metadata file of a new commit.
+
+    The commit id is the sha1 of the metadata, which holds the tree, the
+    parents, the message and the date, so equal commits get equal ids and
+    every commit can be verified against its id.
 
     Args:
-        path (str): The path for the new file.
-        name (str): The file name.
+        path (str): The images directory.
         message (str): The message contant.
         parent  (str): Indicate the previews commit id folder.
+        tree    (str): The root tree id of the commit content.
+        date    (datetime, optional): The commit date, defaults to now.
     Returns:
-        None.
+        str: The commit id.
     """
-    greenwich = pytz.timezone('GB')
-    date = greenwich.localize(datetime.now())
+    if date is None:
+        date = commit_date()
     metadata = (
         f"parent={parent},\n"
         + f"date={date.strftime('%c %z')}\n"
+        + f"tree={tree}\n"
         + f"message={message}"
-    )
-    file_path = os.path.join(path, f'{name}.txt')
-    with open(file_path, 'w') as file:
+    ).encode()
+    commit_id = hashlib.sha1(metadata).hexdigest()
+    file_path = os.path.join(path, f'{commit_id}.txt')
+    with open(file_path, 'wb') as file:
         file.write(metadata)
-    return None
+    return commit_id
 
 
 def update_branch(path: str, branch: str, commit_id: str) -> None:
     """Update branch with new commit id."""
-    with open(os.path.join(path, WIT_METADATA_FILE), 'r') as file:
-        file_info = file.read().split('\n')
-
-    is_found = False
-    index = 0
-    while index < len(file_info) and not is_found:
-        line_parts = list(file_info[index].partition('='))
-        if line_parts[0] == branch:
-            line_parts[2] = commit_id
-            file_info[index] = ''.join(line_parts)
-            is_found = True
-        index += 1
-
-    with open(os.path.join(path, WIT_METADATA_FILE), 'w') as file:
-        file.write('\n'.join(file_info))
+    references = refs.load_refs(path)
+    if branch in references:
+        refs.save_refs(path, {**references, branch: commit_id})
     return None
 
 
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
 def get_commit_info(path: str, head: str, file_type='.txt') -> Dict[str, str]:
-    """Return dict contain all commit information by categories."""
+    """Return dict contain all commit information by categories.
+
+    Commit files never change once written, so they are parsed once and
+    kept in a bounded LRU cache. The returned dict is shared, do not modify it.
+    """
     file_path = os.path.join(path, IMAGES, head + file_type)
     with open(file_path, 'r') as file:
         file_info = file.readlines()
-    return dict([line.strip().split('=') for line in file_info])
+    info = [line.strip().partition('=') for line in file_info]
+    return {key: value for key, _, value in info}
+
+
+def get_commit_tree(path: str, commit_id: str) -> str:
+    """Return the root tree id of a commit.
+
+    Commits which were saved as a full image directory are imported
+    into the object store on first use, and their tree id is kept in the
+    LEGACY_TREES file, so the image is not read again.
+    """
+    if commit_id == 'None':
+        return objectstore.EMPTY_TREE
+    tree = get_commit_info(path, commit_id).get('tree')
+    if tree is not None:
+        return tree
+    legacy_trees_path = os.path.join(path, LEGACY_TREES)
+    try:
+        with open(legacy_trees_path, 'r') as file:
+            legacy_trees = dict(line.split() for line in file if line.strip())
+    except FileNotFoundError:
+        legacy_trees = {}
+    tree = legacy_trees.get(commit_id)
+    if tree is None:
+        tree = objectstore.build_tree(path, os.path.join(path, IMAGES, commit_id))
+        with open(legacy_trees_path, 'a') as file:  # One short append, safe for concurrent writers.
+            file.write(f'{commit_id} {tree}\n')
+    return tree
 
 
 @run_only_if_backup
 def commit(*args: str, merge=None, **kargs: str) -> None:
-    backup_folder = kargs['backup_folder']
+    try:
+        create_commit(kargs['backup_folder'], ' '.join(args), merge)
+    except WitError as error:
+        print(error)
+    return None
 
-    branch = is_branch(backup_folder, get_active_branch(backup_folder))
-    head_directory = get_head(backup_folder)
-    # print("HEAD:", head_directory)
-    if head_directory == branch:
-        update_branch(backup_folder, branch, head_directory)
 
-    commit_id: str = generate_directory_name()
-    message: str = ' '.join(args)
+@locks.holding(index=locks.SHARED, refs=locks.EXCLUSIVE)
+def create_commit(backup_folder: str, message: str, merge: Optional[str] = None) -> Optional[str]:
+    """Commits the staging area and returns the new commit id.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        message (str): The commit message.
+        merge (str, optional): The second parent, for merge commits.
+    Returns:
+        str: The new commit id, or None if nothing changed since HEAD.
+    Raises:
+        WitError: If a merge left conflicts which were not added again.
+    """
+    merge_head_path = os.path.join(backup_folder, MERGE_HEAD)
+    unresolved = get_conflicts(backup_folder)
+    if merge is None and os.path.exists(merge_head_path) and unresolved:
+        raise WitError(f"Fix the conflicts and add the files before committing: {', '.join(unresolved)}")
+    head_directory = get_head(backup_folder)
     image_path: str = os.path.join(backup_folder, IMAGES)
 
-    if is_same_backup(backup_folder):  # BONUS
-        return None
+    staging_path: str = os.path.join(backup_folder, STAGING_AREA)
+    staged = {file: entry.object_id for file, entry in load_index(backup_folder).items()}
+    with tracing.span('build_tree'):
+        tree: str = objectstore.build_tree_from_files(
+            backup_folder, staged, staging_path, mode=get_storage_mode(backup_folder))
+    if merge is None and os.path.exists(merge_head_path):
+        # Concluding a merge which stopped on conflicts.
+        with open(merge_head_path, 'r') as file:
+            merge = file.read().strip()
+    else:
+        with tracing.span('compare'):
+            is_same = is_same_backup(backup_folder, tree)  # BONUS
+        if is_same:
+            return None
 
     if merge is None:
         parents = head_directory
     else:
         parents = ','.join([head_directory, merge])
 
-    create_metadata(image_path, commit_id, message, parent=parents)
+    date = commit_date()
+    with tracing.span('metadata'):
+        commit_id = create_metadata(image_path, message, parent=parents, tree=tree, date=date)
+        commitgraph.add_commit(
+            backup_folder, commit_id, get_commit_parents(backup_folder, commit_id), int(date.timestamp()))
     update_backup_folder_metadata(backup_folder, commit_id)
-    create_folders(image_path, commit_id)
-    staging_path: str = os.path.join(backup_folder, STAGING_AREA)
-    copy_files(staging_path, os.path.join(image_path, commit_id), inside=True)
+    if os.path.exists(merge_head_path):
+        os.remove(merge_head_path)
+    return commit_id
+
+
+def get_conflicts(path: str) -> List[str]:
+    """Return the files a merge left with conflicts, until they are added again."""
+    try:
+        with open(os.path.join(path, MERGE_CONFLICTS), 'r') as file:
+            return file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def set_conflicts(path: str, conflicts: Iterable[str]) -> None:
+    """Record the files with unresolved conflicts, no files removes the record."""
+    conflicts_path = os.path.join(path, MERGE_CONFLICTS)
+    conflicts = sorted(conflicts)
+    if conflicts:
+        with open(conflicts_path, 'w') as file:
+            file.write(''.join(f'{file_name}\n' for file_name in conflicts))
+    elif os.path.exists(conflicts_path):
+        os.remove(conflicts_path)
+    return None
+
+
+def check_no_merge(path: str) -> None:
+    """Raises WitError if a merge stopped on conflicts and was not committed yet."""
+    if os.path.exists(os.path.join(path, MERGE_HEAD)):
+        raise WitError("A merge is in progress, fix the conflicts, then add and commit the result first.")
     return None
 
 
@@ -231,66 +539,45 @@ def join_path(path: str, files: List[str]) -> List[str]:
     return [os.path.join(path, file) for file in files]
 
 
-def is_same_backup(backup_folder: str) -> bool:
-    """Check if the last backup is equal to the next one."""
+def is_same_backup(backup_folder: str, tree: str) -> bool:
+    """Check if the last backup is equal to the next one, by their root tree ids."""
     head_directory = get_head(backup_folder)
-    images_folder = os.path.join(backup_folder, IMAGES)
-    last_backup_folder = os.path.join(images_folder, head_directory)
-    if os.path.basename(last_backup_folder) == "None":
+    if head_directory == "None":
         return False
-
-    staging_folder = os.path.join(backup_folder, STAGING_AREA)
-    result = dirscomparison.deep_comparison(
-        last_backup_folder, staging_folder)[0]
-    return result
+    return get_commit_tree(backup_folder, head_directory) == tree
 
 
 def get_head(path: str) -> str:
     """Returns the current head directory name."""
-    with open(os.path.join(path, WIT_METADATA_FILE), 'r') as file:
-        return file.readline().partition('=')[2].strip()
+    return refs.load_refs(path).get(refs.HEAD, 'None')
 
 
 def get_master(path: str) -> str:
     """Returns the current master directory name."""
-    with open(os.path.join(path, WIT_METADATA_FILE), 'r') as file:
-        return file.readlines()[1].partition('=')[2].strip()
+    return refs.load_refs(path).get(refs.MASTER, 'None')
 
 
 def is_commit_id_valid(backup_folder: str, commit_id: str) -> bool:
-    """Check if a given commit id directory is exist."""
-    path = os.path.join(backup_folder, IMAGES, commit_id)
+    """Check if a given commit id is exist."""
+    path = os.path.join(backup_folder, IMAGES, f'{commit_id}.txt')
     return os.path.exists(path)
 
 
 def update_backup_folder_metadata(path: str, commit_id: str, checkout=False) -> None:
-    """Updates the backup folder metadata."""
+    """Updates the backup folder metadata.
 
-    head = get_head(path)
-    master = get_master(path)
+    On a new commit, the active branch moves with HEAD if it pointed at it.
+    """
+    references = dict(refs.load_refs(path))
     if not checkout:
-        if head == master and get_active_branch(path) == 'master':
-            master = commit_id
-
-    reference_path = os.path.join(path, WIT_METADATA_FILE)
-    with open(reference_path, 'r') as file:
-        current_info = [line.strip() for line in file.readlines()[2:]]
-
-    with open(reference_path, 'w') as file:
-        file.write(
-            f"HEAD={commit_id}\n"
-            + f"master={master}\n"
-            + '\n'.join(current_info)
-        )
+        active_branch = get_active_branch(path)
+        if references.get(active_branch) == references.get(refs.HEAD):
+            references[active_branch] = commit_id
+    references[refs.HEAD] = commit_id
+    refs.save_refs(path, references)
     return None
 
 
-def generate_directory_name(n: int = 40) -> str:
-    """Generate a random folder name in a given length."""
-    chars = string.ascii_lowercase + string.digits
-    return ''.join(random.choice(chars) for i in range(n))
-
-
 def print_list(*args) -> None:
     """Prints list items.
 
@@ -306,27 +593,116 @@ def print_list(*args) -> None:
     return None
 
 
-def Changes_to_be_committed(head_directory: str, backup_folder: str) -> Dict[str, Union[str, bool]]:
-    """Returns all the files in staging area and not in last image folder."""
-    last_image = os.path.join(backup_folder, IMAGES, head_directory)
-    staging_area = os.path.join(backup_folder, STAGING_AREA)
-    report = dirscomparison.deep_comparison(
-        last_image, staging_area)[1]
-    return report['diffrent_files']
+def Changes_to_be_committed(head_directory: str, backup_folder: str) -> List[str]:
+    """Returns all the files in staging area which differ from the last commit.
+
+    Staged hashes are taken from the index, so no file content is read.
+    """
+    last_image = objectstore.flatten_tree(
+        backup_folder, get_commit_tree(backup_folder, head_directory))
+    staged = {file: entry.object_id for file, entry in load_index(backup_folder).items()}
+    return sorted(
+        file for file in last_image.keys() | staged.keys()
+        if last_image.get(file) != staged.get(file)
+    )
+
+
+@locks.holding(index=locks.SHARED)
+def working_tree_changes(backup_folder: str, exact: bool = True) -> Tuple[List[str], List[str]]:
+    """Returns the modified and the untracked files of the working tree.
+
+    A running daemon answers at once, see the daemon module. Otherwise
+    the working tree is scanned: files whose stat data matches their index
+    entry are not read, and files which were only touched get their index
+    entry refreshed. Large modified files are hashed once while they are
+    unchanged, see the digests module.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        exact (bool, optional): False accepts a daemon answer which may miss the latest changes.
+    """
+    answer = daemon.query_status(backup_folder, exact)
+    if answer is not None:
+        return answer
+    source_path = os.path.dirname(backup_folder)
+    entries = load_index(backup_folder)
+    rules = ignore.load_rules(backup_folder)
+    selection = sparse.load_sparse(backup_folder)
+    modified, untracked = [], []
+    seen = set()
+    candidates = []
+    with tracing.span('walk'):
+        for relative_path, dir_entry in dirscomparison.walk_files(
+                source_path, prune=working_tree_prune(rules, selection)):
+            entry = entries.get(relative_path)
+            if entry is None:
+                untracked.append(relative_path)
+                continue
+            seen.add(relative_path)
+            stat = dir_entry.stat()
+            if not index.is_stat_unchanged(entry, stat):
+                candidates.append((relative_path, dir_entry.path, stat))
+    tracing.count('files_stat', len(seen))
+    rules.save_cache()
+
+    for relative_path in entries.keys() - seen:
+        if not selection.includes(relative_path):
+            continue  # Out of the sparse checkout, the file is not in the working tree.
+        # Ignored files stay tracked once they were added, they are checked one by one.
+        file_path = os.path.join(source_path, relative_path)
+        if not rules.is_path_ignored(relative_path) or not os.path.isfile(file_path):
+            modified.append(relative_path)
+            continue
+        stat = os.stat(file_path)
+        if not index.is_stat_unchanged(entries[relative_path], stat):
+            candidates.append((relative_path, file_path, stat))
+
+    refreshed = False
+    cache = digests.load_cache(backup_folder)
+    with tracing.span('hash'):
+        object_ids = list(workers.imap(lambda item: cache.digest(item[1], item[2]), candidates))
+    cache.save()
+    for (relative_path, _, stat), object_id in zip(candidates, object_ids):
+        if object_id == entries[relative_path].object_id:
+            entries[relative_path] = index.make_entry(object_id, stat)
+            refreshed = True
+        else:
+            modified.append(relative_path)
+    if refreshed:
+        index.write_index(backup_folder, entries)
+    return sorted(modified), sorted(untracked)
+
+
+def is_backup_dir(relative_path: str, entry: os.DirEntry) -> bool:
+    """Prune callback which skips the backup directory in working tree walks."""
+    return entry.name == BACKUP_DIR_NAME
+
+
+def working_tree_prune(rules: ignore.IgnoreRules,
+                       selection: sparse.SparseSet) -> Callable[[str, os.DirEntry], bool]:
+    """Returns the prune callback of working tree walks.
+
+    It skips the backup directory, ignored entries and the directories out of the sparse checkout.
+    The ignore rules see every entry, whatever the selection, since the names
+    they find ignored are cached for the whole directory.
+    """
+    return lambda relative_path, entry: (
+        is_backup_dir(relative_path, entry)
+        or rules.prune(relative_path, entry)
+        or selection.prune(relative_path, entry)
+    )
 
 
 def Changes_not_staged_for_commit(backup_folder: str, untracked: bool = False) -> List[str]:
     """Returns all files are in both stageing area and source path but has changed."""
-    staging_area = os.path.join(backup_folder, STAGING_AREA)
-    source_path = os.path.dirname(backup_folder)
-    report = dirscomparison.deep_comparison(
-        source_path, staging_area)[1]
+    modified, untracked_files = working_tree_changes(backup_folder)
     if not untracked:
-        return [file for file in report['diffrent_files'] if os.path.isabs(file)]
-    return [file for file in report['diffrent_files'] if not os.path.isabs(file)]
+        return modified
+    return untracked_files
 
 
 @run_only_if_backup
+@locks.holding(index=locks.SHARED, refs=locks.SHARED)
 def status(*args: str, **kargs: str) -> None:
     """Prints out the file status."""
     backup_folder = kargs['backup_folder']
@@ -339,36 +715,39 @@ def status(*args: str, **kargs: str) -> None:
     else:
         print("\t-> None")
 
+    modified, untracked = working_tree_changes(backup_folder, exact=False)
     print("Changes not staged for commit:".title())
-    print_list(*Changes_not_staged_for_commit(backup_folder))
+    print_list(*modified)
     print("Untracked files:".title())
-    print_list(*Changes_not_staged_for_commit(backup_folder, untracked=True))
+    print_list(*untracked)
     return None
 
 
 def get_all_branches(path: str) -> Optional[List[Dict[str, str]]]:
     """Return all branches."""
-    with open(os.path.join(path, WIT_METADATA_FILE), 'r') as file:
-        lines = [line.partition('=') for line in file.readlines()[1:]]
-    if not lines:
+    branches = [
+        {'name': name, 'commit_id': commit_id}
+        for name, commit_id in refs.load_refs(path).items() if name != refs.HEAD
+    ]
+    if not branches:
         return None
-    return [{'name': line[0], 'commit_id': line[2].strip()} for line in lines]
+    return branches
 
 
 def is_branch(path: str, name: str) -> Optional[str]:
     """Return branch commit id is brunch name if is exist."""
-    branches = get_all_branches(path)
-    if branches:
-        for brunch in branches:
-            if brunch['name'] == name:
-                return brunch['commit_id']
-    return None
+    if name == refs.HEAD:
+        return None
+    return refs.load_refs(path).get(name)
 
 
 def set_active_branch(path: str, name: str) -> None:
     """Set name of active branch."""
-    with open(os.path.join(path, ACTIVATE_BRANCH), 'w') as file:
+    active_path = os.path.join(path, ACTIVATE_BRANCH)
+    temp_path = f'{active_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as file:
         file.write(name)
+    os.replace(temp_path, active_path)
     return None
 
 
@@ -380,71 +759,313 @@ def get_active_branch(path: str) -> str:
 
 @ run_only_if_backup
 def checkout(*args: str, **kargs: str) -> None:
-    backup_folder = kargs['backup_folder']
     try:
         commit_id = args[0]
     except IndexError:
         print("You need to insert a commit as argument such: 'python x.py checkout COMMIT")
         return None
+    try:
+        checkout_commit(kargs['backup_folder'], commit_id)
+    except WitError as error:
+        print(error)
+    return None
+
+
+@locks.holding(index=locks.EXCLUSIVE, refs=locks.EXCLUSIVE)
+def checkout_commit(backup_folder: str, commit_id: str) -> str:
+    """Checks out a branch or a commit, and returns the commit id.
 
+    Raises:
+        WitError: If the commit does not exist, the working tree has changes
+                  or a merge is in progress.
+    """
+    check_no_merge(backup_folder)
+    branch_name = commit_id
     branch = is_branch(backup_folder, commit_id)
     if branch is not None:
         commit_id = branch
     else:
-        set_active_branch(backup_folder, 'None')
+        branch_name = 'None'
 
     head_directory = get_head(backup_folder)
-    master = get_master(backup_folder)
     # Checks if Commit id path is exist
-    if commit_id == 'master':
-        head_directory = master
-    elif not is_commit_id_valid(backup_folder, commit_id):
-        return None
+    if not is_commit_id_valid(backup_folder, commit_id):
+        raise WitError("Your commit id or branch name is not exist.")
 
     # Checks id there are not "changes to be commit" or "Changes not staged for commit" files.
     ctbc = Changes_to_be_committed(head_directory, backup_folder)
     cnsfc = Changes_not_staged_for_commit(backup_folder)
 
     if ctbc or cnsfc:
-        return None
+        raise WitError("Commit your changes before checking out.")
 
-    copy_from = os.path.join(backup_folder, IMAGES, commit_id)
-    copy_to = os.path.dirname(backup_folder)
-    copy_files(copy_from, copy_to, inside=True)
+    current_tree = get_commit_tree(backup_folder, head_directory)
+    tree = get_commit_tree(backup_folder, commit_id)
+    with tracing.span('diff'):
+        changes = [
+            (file, object_id)
+            for file, _, object_id in objectstore.diff_trees(backup_folder, current_tree, tree)
+        ]
+    apply_changes(backup_folder, changes)
 
     # Update head to the new commit id.
     update_backup_folder_metadata(backup_folder, commit_id, checkout=True)
+    set_active_branch(backup_folder, branch_name)
+    return commit_id
+
 
-    # Deleting the content of a directory
+def apply_changes(backup_folder: str, changes: Iterable[Tuple[str, Optional[str]]],
+                  unresolved: Collection[str] = ()) -> None:
+    """Updates the working tree, the staging area and the index with file changes.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        changes (iterable): (relative path, new blob id) pairs, None deletes the file.
+        unresolved (collection, optional): Files with merge conflicts, only changed in the working tree.
+    Existing files are removed before their new content is placed, so files
+    linked to the object store are never modified in place. Files out of the
+    sparse checkout only have their index entry updated.
+    """
+    selection = sparse.load_sparse(backup_folder)
+    entries = load_index(backup_folder)
+    changes = list(changes)
+    for file, object_id in changes:
+        if not selection.includes(file) and file not in unresolved:
+            entries.pop(file, None)
+            if object_id is not None:
+                entries[file] = index.make_entry(object_id)
+    changes = [(file, object_id) for file, object_id in changes if selection.includes(file)]
+    place_blobs(backup_folder, entries, changes, unresolved)
+    index.write_index(backup_folder, entries)
+    return None
+
+
+def place_blobs(backup_folder: str, entries: Dict[str, index.IndexEntry],
+                changes: List[Tuple[str, Optional[str]]], unresolved: Collection[str] = ()) -> None:
+    """Writes blobs into the working tree and the staging area, and updates their index entries.
+
+    Args:
+        backup_folder (str): Path of the '.wit' directory.
+        entries (dict): The index entries, updated in place.
+        changes (list): (relative path, new blob id) pairs, None deletes the file.
+        unresolved (collection, optional): Files only written in the working tree,
+                                           their staged version and entry are kept.
+    """
+    source_path = os.path.dirname(backup_folder)
     staging_path = os.path.join(backup_folder, STAGING_AREA)
-    delete_dir(staging_path, parent=False)
-    copy_files(copy_from, staging_path, inside=True)
+    mode = get_storage_mode(backup_folder)
+    modes = {staging_path: mode, source_path: storage.working_tree_mode(mode)}
+
+    def roots(file: str) -> Tuple[str, ...]:
+        return (source_path,) if file in unresolved else (source_path, staging_path)
+
+    # Deleting first, so a file can replace a directory and the other way around.
+    for file, _ in changes:
+        for root in roots(file):
+            remove_file(root, file)
+        if file not in unresolved:
+            entries.pop(file, None)
+
+    written = [(file, object_id) for file, object_id in changes if object_id is not None]
+    destinations = [
+        (object_id, root, os.path.join(root, file))
+        for file, object_id in written
+        for root in roots(file)
+    ]
+    with tracing.span('place'):
+        workers.run(
+            lambda object_id, root, destination: objectstore.materialize_blob(
+                backup_folder, object_id, destination, modes[root]),
+            (object_id for object_id, _, _ in destinations),
+            (root for _, root, _ in destinations),
+            (destination for _, _, destination in destinations),
+        )
+    for file, object_id in written:
+        if file not in unresolved:
+            entries[file] = index.make_entry(object_id, os.stat(os.path.join(source_path, file)))
+    return None
+
+
+def remove_file(root: str, relative_path: str) -> None:
+    """Removes a file and the directories it leaves empty, up to a given root."""
+    path = os.path.join(root, relative_path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        return None
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return None
+    directory = os.path.dirname(path)
+    while directory != root and not os.listdir(directory):
+        os.rmdir(directory)
+        directory = os.path.dirname(directory)
     return None
 
 
 @ run_only_if_backup
+@locks.holding(index=locks.EXCLUSIVE)
+def sparse_checkout(*args: str, **kargs: str) -> None:
+    """Limits the working tree to some directories, see the sparse module.
+
+    'set DIR...' selects only the given directories, 'add DIR...' adds
+    directories to the selection, 'list' prints them and 'disable' brings
+    back the whole tree. Changing the selection needs a working tree without
+    unstaged changes, as the files which leave it are removed.
+    """
+    path = kargs['backup_folder']
+    action = args[0] if args else 'list'
+    current = sparse.load_sparse(path)
+    if action == 'list':
+        if current.is_enabled:
+            print_list(*sorted(current.directories))
+        else:
+            print("The whole tree is checked out.")
+        return None
+    if action not in ('set', 'add', 'disable') or (action != 'disable' and len(args) < 2):
+        print("Usage: 'python x.py sparse [list|set DIR...|add DIR...|disable]'")
+        return None
+
+    source_path = os.path.dirname(path)
+    directories: Optional[List[str]] = None
+    if action != 'disable':
+        directories = list(current.directories or ()) if action == 'add' else []
+        try:
+            for directory in args[1:]:
+                full_path = os.path.abspath(is_abs_path(directory, kargs['path']))
+                directories.append(sparse.normalize_directory(os.path.relpath(full_path, source_path)))
+        except ValueError as error:
+            print(f"Not a directory of the repository: {error}")
+            return None
+    if Changes_not_staged_for_commit(path):
+        print("Add or revert your changes before changing the sparse checkout.")
+        return None
+
+    selection = sparse.SparseSet(directories)
+    entries = load_index(path)
+    changes: List[Tuple[str, Optional[str]]] = []
+    for file, entry in entries.items():
+        was_included, is_included = current.includes(file), selection.includes(file)
+        if was_included and not is_included:
+            # A staged blob may only be in the staging area, it is stored before the file is removed.
+            objectstore.store_file(path, os.path.join(path, STAGING_AREA, file), entry.object_id)
+            changes.append((file, None))
+        elif is_included and not was_included:
+            changes.append((file, entry.object_id))
+    removed = {file: entries[file].object_id for file, object_id in changes if object_id is None}
+    place_blobs(path, entries, changes)
+    for file, object_id in removed.items():
+        entries[file] = index.make_entry(object_id)  # Still tracked, out of the working tree.
+    index.write_index(path, entries)
+    sparse.save_sparse(path, directories)
+    return None
+
+
+@ run_only_if_backup
+@locks.holding(refs=locks.SHARED)
 def graph(*args: str, **kargs: str) -> None:
-    """Display a commit id chain path as a graph."""
+    """Writes the commit graph of all the branches to a file.
+
+    The DOT source is streamed while walking the history, so the history
+    size does not matter. Other formats are rendered from it with graphviz,
+    no viewer is opened. The last DOT source is cached by the references
+    and the options, so a repeated call does not walk the history again.
+    Its first line is a comment with the cache key.
+
+    Options:
+        --output FILE: The output file, its extension is the format. Defaults to 'graph.png'.
+        --since DATE: Only commits from a given date, such '2021-05-01'.
+        --max-commits N: Only the N newest commits, in topological order.
+    """
     path = kargs['backup_folder']
-    g = Digraph('file chain')
-
-    # g.attr(dir="forward", arrowhead='normal', arrowtail='dot')
-
-    all_dirs = dirscomparison.differentiate(os.path.join(path, IMAGES))['dirs']
-    all_dirs = {commit: index for index, commit in enumerate(all_dirs, 0)}
-    connections = []
-    for d in all_dirs:
-        g.node(str(all_dirs[d]), f"{d[:20]}\n{d[20:]}")
-        parents = get_commit_info(path, d)['parent'].split(',')
-        for p in parents:
-            if p != 'None' and p:
-                connections.append(f"{all_dirs[d]}{all_dirs[p]}")
-
-    g.edges(connections)
-    g.render('graph.png', view=True, format='png')
+    inputs, output = pop_option(list(args), '--output')
+    inputs, since = pop_option(inputs, '--since')
+    inputs, max_commits = pop_option(inputs, '--max-commits')
+    output = os.path.join(kargs['path'], output or GRAPH_OUTPUT)
+    try:
+        start_time = parse_date(since) if since is not None else None
+    except ValueError:
+        print("Dates should be such '2021-05-01' or '2021-05-01 13:30'.")
+        return None
+    try:
+        max_count = parse_count(max_commits, '--max-commits')
+    except WitError as error:
+        print(error)
+        return None
+
+    references = refs.load_refs(path)
+    cache_key = hashlib.sha1(repr((sorted(references.items()), since, max_count)).encode()).hexdigest()
+    # The key heads the DOT source as a comment, so both are replaced at once.
+    header = f'// wit graph {cache_key}\n'
+    dot_path = os.path.join(path, GRAPH_CACHE)
+    try:
+        with open(dot_path, 'r') as file:
+            is_cached = file.readline() == header
+    except FileNotFoundError:
+        is_cached = False
+    if not is_cached:
+        with storage.replacing(dot_path) as file:
+            file.write(header)
+            file.writelines(iter_graph_dot(path, references, start_time, max_count))
+
+    output_format = os.path.splitext(output)[1].lstrip('.') or 'dot'
+    if output_format == 'dot':
+        shutil.copyfile(dot_path, output)
+    elif not is_cached or not os.path.exists(output) or os.path.getmtime(output) < os.path.getmtime(dot_path):
+        try:
+            import graphviz  # type: ignore  # Only needed by this command.
+
+            graphviz.render('dot', output_format, dot_path, outfile=output)
+        except (ImportError, RuntimeError, ValueError) as error:
+            print(f"Could not render the graph ({error}), its DOT source is in {dot_path}.")
+            return None
+    print(f"The graph was written to {output}.")
     return None
 
 
+def iter_graph_dot(path: str, references: Dict[str, str], start_time: Optional[int] = None,
+                   max_commits: Optional[int] = None) -> Iterator[str]:
+    """Yields the lines of a DOT graph of the referenced commits and their history.
+
+    Commits are named by their ids. Parents outside of the window are
+    drawn as small boundary nodes.
+    """
+    yield 'digraph "file chain" {\n'
+    yield '    node [shape=ellipse]\n'
+    targets = {}
+    for name, commit_id in references.items():
+        if commit_id != 'None':
+            targets.setdefault(commit_id, []).append(name)
+    if targets:
+        graph = load_commit_graph(path, *targets)
+        pending = set()
+        shown = set()
+        count = 0
+        for position in commitgraph.walk(graph, targets):
+            if max_commits is not None and count >= max_commits:
+                break
+            if start_time is not None and graph.timestamps[position] < start_time:
+                continue
+            count += 1
+            commit_id = graph.ids[position]
+            pending.discard(commit_id)
+            if commit_id in targets:
+                shown.add(commit_id)
+            yield f'    "{commit_id}" [label="{commit_id[:20]}\\n{commit_id[20:]}"]\n'
+            for parent in graph.parents[position]:
+                parent_id = graph.ids[parent]
+                pending.add(parent_id)
+                yield f'    "{commit_id}" -> "{parent_id}"\n'
+        for commit_id in sorted(pending):
+            yield f'    "{commit_id}" [label="{commit_id[:8]}...", shape=plaintext]\n'
+        for commit_id, names in sorted(targets.items()):
+            if commit_id not in shown and commit_id not in pending:
+                continue
+            label = ', '.join(names)
+            yield f'    "ref:{label}" [label="{label}", shape=box]\n'
+            yield f'    "ref:{label}" -> "{commit_id}" [style=dashed]\n'
+    yield '}\n'
+
+
 @ run_only_if_backup
 def branch(*args: str, **kargs: str) -> None:
     path = kargs['backup_folder']
@@ -460,75 +1081,435 @@ def branch(*args: str, **kargs: str) -> None:
     return None
 
 
-def add_branch(path: str, name: str) -> None:
-    """Adding branch to reference file."""
-    head: str = get_head(path)
-    with open(os.path.join(path, WIT_METADATA_FILE), 'a') as file:
-        file.write(f"\n{name}={head}")
-    return None
+@locks.holding(refs=locks.EXCLUSIVE)
+def add_branch(path: str, name: str) -> str:
+    """Adding branch to reference file, returns the commit id it points at."""
+    references = refs.load_refs(path)
+    commit_id = references.get(refs.HEAD, 'None')
+    refs.save_refs(path, {**references, name: commit_id})
+    return commit_id
 
 
 @ run_only_if_backup
 def merge(*args: str, **kargs: str) -> None:
-    path = kargs['backup_folder']
-    head = get_head(path)
-    staging_area = os.path.join(path, STAGING_AREA)
+    """Merges a branch into HEAD, file by file and line by line.
+
+    Files changed on a single side are taken as they are, files changed on
+    both sides are merged by lines. If some files have conflicts, they are
+    written with conflict markers in the working tree only, and the merge
+    commit is left to the user once the files are added again.
+    """
     try:
         branch_name = args[0]
     except IndexError:
         print("You need to insert a branch name as argument such: 'python x.py merge NAME")
+        return None
+    try:
+        _, conflicts = merge_branch(kargs['backup_folder'], branch_name)
+    except WitError as error:
+        print(error)
+        return None
+    if conflicts:
+        print("Automatic merge failed, fix the conflicts, then add and commit the result:")
+        for file, kind in conflicts.items():
+            print(f"    {kind}: {file}")
+    return None
+
 
+@locks.holding(index=locks.EXCLUSIVE, refs=locks.EXCLUSIVE)
+def merge_branch(path: str, branch_name: str) -> Tuple[Optional[str], Dict[str, str]]:
+    """Merges a branch into HEAD.
+
+    Returns:
+        tuple: The merge commit id, or None if the merge stopped on conflicts
+               or changed nothing, and the kind of conflict of every file with
+               conflicts, see merge3.merge_trees.
+    Raises:
+        WitError: If the branch does not exist, either side has no commits yet,
+                  there are uncommitted changes or a merge is in progress.
+    """
+    check_no_merge(path)
+    head = get_head(path)
     branch = is_branch(path, branch_name)
     if branch is None:
-        print("Your branch name is not exist.")
-        return None
+        raise WitError("Your branch name is not exist.")
+    if branch == 'None':
+        raise WitError(f"The branch {branch_name} has no commits yet, there is nothing to merge.")
+    if head == 'None':
+        raise WitError("There are no commits yet, commit before merging.")
+    if Changes_to_be_committed(head, path) or Changes_not_staged_for_commit(path):
+        raise WitError("Commit your changes before merging.")
+
     common_branch = get_common_branch(path, branch, head)
-    branch_path = os.path.join(path, IMAGES, branch)
-    common_branch_path = os.path.join(path, IMAGES, common_branch)
+    with tracing.span('merge_trees'):
+        changes, conflicts = merge3.merge_trees(
+            path,
+            get_commit_tree(path, common_branch),
+            get_commit_tree(path, head),
+            get_commit_tree(path, branch),
+            labels=(refs.HEAD, branch_name),
+        )
+    apply_changes(path, changes.items(), unresolved=conflicts)
+
+    if conflicts:
+        set_conflicts(path, conflicts)
+        with open(os.path.join(path, MERGE_HEAD), 'w') as file:
+            file.write(branch)
+        return None, conflicts
+    return create_commit(path, f"Branch: {branch_name} -> merge with {head}", merge=branch), {}
+
+
+@ run_only_if_backup
+@locks.holding(refs=locks.SHARED)
+def log(*args: str, **kargs: str) -> None:
+    """Prints the history of HEAD, or of a given branch or commit.
+
+    Options:
+        --limit N: Print at most N commits.
+        --since DATE, --until DATE: Only commits in a date range, such '2021-05-01'.
+        --first-parent: Follow only the first parent of merge commits.
+    """
+    path = kargs['backup_folder']
+    inputs, limit = pop_option(list(args), '--limit')
+    inputs, since = pop_option(inputs, '--since')
+    inputs, until = pop_option(inputs, '--until')
+    first_parent = '--first-parent' in inputs
+    inputs = [item for item in inputs if item != '--first-parent']
+    try:
+        start_time = parse_date(since) if since is not None else None
+        end_time = parse_date(until) if until is not None else None
+    except ValueError:
+        print("Dates should be such '2021-05-01' or '2021-05-01 13:30'.")
+        return None
+    try:
+        max_count = parse_count(limit, '--limit')
+    except WitError as error:
+        print(error)
+        return None
+
+    commit_id = inputs[0] if inputs else get_head(path)
+    commit_id = is_branch(path, commit_id) or commit_id
+    if commit_id == 'None':
+        print("There are no commits yet.")
+        return None
+    if not is_commit_id_valid(path, commit_id):
+        print("Your commit id or branch name is not exist.")
+        return None
+
+    for count, entry in enumerate(iter_history(path, commit_id, first_parent, start_time, end_time)):
+        if max_count is not None and count >= max_count:
+            break
+        print_commit(*entry)
+    return None
+
+
+def parse_date(date: str) -> int:
+    """Return the timestamp of an ISO date, in local time if it has no timezone."""
+    return int(datetime.fromisoformat(date).timestamp())
 
-    comperison = dirscomparison.dirs_comparison(
-        branch_path, common_branch_path)
-    all_diffrents = comperison['diffrent_dirs'].union(
-        comperison['diffrent_files'])
 
-    for file in all_diffrents:
-        file_optional_path = os.path.join(branch_path, file)
-        if os.path.exists(file_optional_path):
-            copy_files(file_optional_path, staging_area)
+def iter_history(path: str, commit_id: str, first_parent: bool = False,
+                 start_time: Optional[int] = None,
+                 end_time: Optional[int] = None) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """Yields (commit id, commit info) for a commit and its ancestors, newest first.
 
-    commit(staging_area,
-           f"Branch: {branch} -> merge with {head}", path=path, merge=branch)
+    The walk follows the commit graph, so commit files are only read for
+    the commits which are yielded.
 
+    Args:
+        path (str): Path of the '.wit' directory.
+        commit_id (str): The commit to start from.
+        first_parent (bool, optional): Follow only the first parent of merge commits.
+        start_time, end_time (int, optional): Skip commits out of this time range.
+    """
+    graph = load_commit_graph(path, commit_id)
+    for position in commitgraph.walk(graph, [commit_id], first_parent):
+        timestamp = graph.timestamps[position]
+        if start_time is not None and timestamp < start_time:
+            continue
+        if end_time is not None and timestamp > end_time:
+            continue
+        commit = graph.ids[position]
+        yield commit, get_commit_info(path, commit)
+
+
+def print_commit(commit_id: str, info: Dict[str, str]) -> None:
+    """Prints a commit as a log entry."""
+    parents = [parent for parent in info.get('parent', '').split(',') if parent and parent != 'None']
+    print(f"commit {commit_id}")
+    if len(parents) > 1:
+        print(f"Merge: {' '.join(parent[:8] for parent in parents)}")
+    print(f"Date:   {info.get('date', '')}")
+    print(f"\n    {info.get('message', '')}\n")
+    return None
+
+
+@ run_only_if_backup
+def run_daemon(*args: str, **kargs: str) -> None:
+    """Controls the watcher daemon: 'start', 'stop', 'status', or 'run' in the foreground."""
+    backup_folder = kargs['backup_folder']
+    action = args[0] if args else 'start'
+    if action == 'run':
+        try:
+            daemon.Daemon(backup_folder, prune=is_backup_dir).serve()
+        except RuntimeError as error:
+            print(error)
+        return None
+    if action == 'start':
+        if daemon.request(backup_folder, {'command': 'ping'}) is not None:
+            print("The daemon is already running.")
+            return None
+        import subprocess  # Only needed by this command.
+
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'daemon', 'run'],
+            cwd=os.path.dirname(backup_folder), start_new_session=True,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + daemon.CLIENT_TIMEOUT
+        while time.monotonic() < deadline:
+            answer = daemon.request(backup_folder, {'command': 'ping'})
+            if answer is not None:
+                print(f"The daemon is running ({answer['mode']}, pid {answer['pid']}).")
+                return None
+            time.sleep(0.05)
+        print("The daemon did not start.")
+        return None
+    if action == 'stop':
+        if daemon.request(backup_folder, {'command': 'stop'}) is None:
+            print("The daemon is not running.")
+        return None
+    if action == 'status':
+        answer = daemon.request(backup_folder, {'command': 'ping'})
+        if answer is None:
+            print("The daemon is not running.")
+        else:
+            print(f"The daemon is running ({answer['mode']}, pid {answer['pid']}, {answer['files']} files).")
+        return None
+    print("Usage: 'python x.py daemon [start|stop|status|run]'")
+    return None
+
+
+def run_batch(*args: str, **kargs: str) -> None:
+    """Runs an operation on many repositories and prints a JSON report, see the batch module.
+
+    Usage: 'python x.py batch OPERATION [REPO...] [--repos-from-file FILE]
+            [--message MESSAGE] [--limit N] [--concurrency N] [--bandwidth RATE] [--output FILE]'
+    The operation is status, add, commit or log, repositories are also read
+    from FILE, one per line, or from the standard input if FILE is '-'.
+    RATE is in bytes per second, such '20M'.
+    """
+    cwd = kargs['path']
+    inputs, repos_file = pop_option(list(args), '--repos-from-file')
+    inputs, message = pop_option(inputs, '--message')
+    inputs, limit = pop_option(inputs, '--limit')
+    inputs, concurrency = pop_option(inputs, '--concurrency')
+    inputs, bandwidth = pop_option(inputs, '--bandwidth')
+    inputs, output = pop_option(inputs, '--output')
+    if not inputs:
+        print("You need to insert an operation such: 'python x.py batch status REPO...")
+        return None
+    operation, paths = inputs[0], inputs[1:]
+    if repos_file is not None:
+        paths.extend(read_pathspecs(repos_file, cwd))
+    paths = [os.path.abspath(is_abs_path(path, cwd)) for path in paths]
+    if operation == 'commit' and message is None:
+        print("A batch commit needs a message such: 'python x.py batch commit --message MESSAGE REPO...")
+        return None
+    import json
+    import batch  # Loaded on first use, it imports asyncio.
+
+    if operation not in batch.OPERATIONS:
+        print(f"The batch operation should be one of: {', '.join(batch.OPERATIONS)}.")
+        return None
+    try:
+        report = batch.run_batch(
+            paths, operation,
+            {'message': message, 'limit': None if limit is None else int(limit)},
+            concurrency=batch.DEFAULT_CONCURRENCY if concurrency is None else int(concurrency),
+            bandwidth=None if bandwidth is None else iolimit.parse_rate(bandwidth),
+        )
+    except ValueError as error:
+        print(f"Could not read a number: {error}")
+        return None
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(is_abs_path(output, cwd), 'w') as file:
+            json.dump(report, file, indent=2)
+    return None
+
+
+@ run_only_if_backup
+@locks.holding(refs=locks.SHARED)
+def fsck(*args: str, **kargs: str) -> None:
+    """Verifies the commits and all the objects they reach.
+
+    Commit ids are the sha1 of their metadata and object ids the sha1 of
+    their content, so every stored file is checked against its id. Commits
+    with random ids, from older versions, can not be verified and are only
+    counted. Objects are verified in parallel.
+    """
+    path = kargs['backup_folder']
+    problems: List[str] = []
+    commits = get_all_commits(path)
+    legacy = 0
+    trees = set()
+    for commit_id, (commit_problems, tree, is_legacy) in zip(
+            commits, workers.imap(lambda commit_id: check_commit(path, commit_id), commits)):
+        problems.extend(commit_problems)
+        legacy += is_legacy
+        if tree is not None:
+            trees.add(tree)
+
+    # Trees are verified before they are read, so a corrupt tree is not followed.
+    objects = set(trees)
+    stack = list(trees)
+    blobs = set()
+    while stack:
+        tree_id = stack.pop()
+        if not objectstore.verify_object(path, tree_id):
+            problems.append(f"object {tree_id}: missing or corrupt")
+            continue
+        for kind, object_id in objectstore.read_tree(path, tree_id).values():
+            if object_id not in objects:
+                objects.add(object_id)
+                if kind == objectstore.TREE:
+                    stack.append(object_id)
+                else:
+                    blobs.add(object_id)
+    object_ids = sorted(blobs)
+    for object_id, is_valid in zip(
+            object_ids, workers.imap(lambda object_id: objectstore.verify_object(path, object_id), object_ids)):
+        if not is_valid:
+            problems.append(f"object {object_id}: missing or corrupt")
+
+    for problem in problems:
+        print(problem)
+    print(f"Checked {len(commits)} commits ({legacy} with unverifiable legacy ids) "
+          + f"and {len(objects)} objects, found {len(problems)} problems.")
+    return None
 
-def get_all_parents(path: str, commit: str) -> Optional[str]:
-    """Parents generator. returns all parents of a commit chain."""
-    yield commit
-    parents = get_commit_info(path, commit)['parent'].split(',')
-    for parent in parents:
-        if parent != 'None' and parent:
-            yield parent
-            yield from get_all_parents(path, parent)
+
+def check_commit(path: str, commit_id: str) -> Tuple[List[str], Optional[str], bool]:
+    """Verifies a commit metadata file.
+
+    Returns:
+        tuple: The problems found, the commit tree id if it has one, and
+               True if the commit id is a legacy random id.
+    """
+    problems = []
+    with open(os.path.join(path, IMAGES, f'{commit_id}.txt'), 'rb') as file:
+        content = file.read()
+    is_legacy = not set(commit_id) <= set(string.hexdigits.lower())
+    if not is_legacy and hashlib.sha1(content).hexdigest() != commit_id:
+        problems.append(f"commit {commit_id}: content does not match its id")
+    for parent in get_commit_parents(path, commit_id):
+        if not is_commit_id_valid(path, parent):
+            problems.append(f"commit {commit_id}: missing parent {parent}")
+    tree = get_commit_info(path, commit_id).get('tree')
+    if tree is None and not os.path.isdir(os.path.join(path, IMAGES, commit_id)):
+        problems.append(f"commit {commit_id}: missing tree and image directory")
+    return problems, tree, is_legacy
+
+
+@ run_only_if_backup
+@locks.holding(refs=locks.EXCLUSIVE)
+def gc(*args: str, **kargs: str) -> None:
+    """Packs all the stored objects into a single compressed pack file."""
+    path = kargs['backup_folder']
+    graph = load_commit_graph(path, *get_all_commits(path))
+    trees = [get_commit_tree(path, commit_id) for commit_id in graph.ids]
+    pack_path, count = objectstore.repack(path, trees)
+    print(f"Packed {count} objects into {pack_path}.")
+    return None
+
+
+def get_all_commits(path: str) -> List[str]:
+    """Return the ids of all the commits."""
+    return sorted(
+        os.path.splitext(file)[0]
+        for file in dirscomparison.differentiate(os.path.join(path, IMAGES))['files']
+    )
+
+
+def get_commit_parents(path: str, commit_id: str) -> List[str]:
+    """Return the parent ids of a commit."""
+    parents = get_commit_info(path, commit_id)['parent'].split(',')
+    return [parent for parent in parents if parent != 'None' and parent]
+
+
+def read_commit(path: str, commit_id: str) -> Tuple[List[str], int]:
+    """Return the parents and the timestamp of a commit, for building the commit graph."""
+    date = datetime.strptime(get_commit_info(path, commit_id)['date'], '%c %z')
+    return get_commit_parents(path, commit_id), int(date.timestamp())
+
+
+@locks.holding(refs=locks.SHARED)
+def load_commit_graph(path: str, *commit_ids: str) -> commitgraph.CommitGraph:
+    """Return the commit graph, rebuilding it if it is missing any of the given commits.
+
+    The graph is kept in memory while its file is unchanged, for processes which run many commands.
+    """
+    graph_path = os.path.join(path, commitgraph.COMMIT_GRAPH_FILE)
+    try:
+        stat = os.stat(graph_path)
+        key: Optional[Tuple[int, int, int]] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        key = None
+    cached = _graphs.get(path)
+    graph = cached[1] if cached is not None and cached[0] == key else commitgraph.read_graph(path)
+    if graph is None or any(c not in graph.positions for c in commit_ids):
+        graph = commitgraph.rebuild_graph(
+            path, get_all_commits(path), lambda commit_id: read_commit(path, commit_id))
+        stat = os.stat(graph_path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    if key is not None:
+        _graphs[path] = (key, graph)
+    return graph
 
 
 def get_common_branch(path: str, b1: str, b2: str) -> str:
     """Return a common branch name for two given branches."""
-    b1_parents = get_all_parents(path, b1)
-    b2_parents = get_all_parents(path, b2)
-    common_branches = list(set(b1_parents).intersection(set(b2_parents)))
-    first = common_branches.pop(0)
-    for branch in common_branches:
-        first_time = datetime.strptime(
-            get_commit_info(path, first)['date'], '%c %z')
-        branch_time = datetime.strptime(
-            get_commit_info(path, branch)['date'], '%c %z')
-        if branch_time > first_time:
-            first = branch
-    return first
+    graph = load_commit_graph(path, b1, b2)
+    common_branch = commitgraph.merge_base(graph, b1, b2)
+    if common_branch is None:
+        return 'None'
+    return common_branch
+
+
+def pop_option(inputs: List[str], name: str) -> Tuple[List[str], Optional[str]]:
+    """Removes an option such '--name VALUE' or '--name=VALUE' from the inputs.
+
+    Returns:
+        tuple: The remaining inputs and the option value, or None if it is not given.
+    """
+    for position, item in enumerate(inputs):
+        if item == name and position + 1 < len(inputs):
+            return inputs[:position] + inputs[position + 2:], inputs[position + 1]
+        if item.startswith(f'{name}='):
+            return inputs[:position] + inputs[position + 1:], item.partition('=')[2]
+    return inputs, None
+
+
+def parse_count(value: Optional[str], name: str, unit: str = 'commits') -> Optional[int]:
+    """Return the number of an option such '--limit 10', or None if it is not given.
+
+    Raises:
+        WitError: If the value is not a non-negative integer.
+    """
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise WitError(f"{name} should be a number of {unit}, such '{name} 10'.")
+    return int(value)
 
 
 def inputs_manager(f: str, *args: str, **kargs: str) -> None:
     """Manage user inputs and router them to the right function.
 
+    Commands are traced when it was asked for, see the tracing module.
+
     Args:
         f (function): Function name.
         args (tuple): Function arguments.
@@ -545,14 +1526,36 @@ def inputs_manager(f: str, *args: str, **kargs: str) -> None:
         'graph': graph,
         'branch': branch,
         'merge': merge,
+        'config': config,
+        'log': log,
+        'sparse': sparse_checkout,
+        'daemon': run_daemon,
+        'batch': run_batch,
+        'fsck': fsck,
+        'gc': gc,
+        'repack': gc,
     }
     if f in functions:
-        functions[f](*args, **kargs)
+        refs.clear_cache()
+        with tracing.command(f):
+            functions[f](*args, **kargs)
     return None
 
 
 if __name__ == '__main__':
     inputs: List[str] = sys.argv
     path: str = os.getcwd()
+    inputs, jobs = pop_option(inputs, '--jobs')
+    try:
+        jobs_count = parse_count(jobs, '--jobs', 'workers')
+    except WitError as error:
+        print(error)
+        sys.exit(1)
+    if jobs_count is not None:
+        workers.set_jobs(jobs_count)
+    inputs, profile_output = pop_option(inputs, '--profile-output')
+    if '--profile' in inputs or profile_output is not None:
+        inputs = [item for item in inputs if item != '--profile']
+        tracing.configure(profile=True, profile_output=profile_output)
     if len(inputs) > 1:
         inputs_manager(inputs[1], *inputs[2:], path=path)
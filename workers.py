@@ -0,0 +1,46 @@
+"""Shared worker pool for concurrent file hashing, comparing and copying.
+
+Results are always returned in the order of the given items, so metadata
+built from them stays deterministic whatever the number of workers is.
+"""
+import os
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, Optional, TypeVar
+
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+JOBS: int = min(32, (os.cpu_count() or 1) + 4)
+_executor: Optional['ThreadPoolExecutor'] = None
+
+
+def set_jobs(jobs: int) -> None:
+    """Set the number of workers, 1 means running everything serially."""
+    global JOBS, _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+    JOBS = max(1, jobs)
+    return None
+
+
+def imap(function: Callable[[T], R], items: Iterable[T]) -> Iterator[R]:
+    """Applies a function on all items using the worker pool, keeping the items order."""
+    global _executor
+    items = list(items)
+    if JOBS == 1 or len(items) < 2:
+        return map(function, items)
+    if _executor is None:
+        # Imported here, commands which never use the pool do not pay for it.
+        from concurrent.futures import ThreadPoolExecutor
+
+        _executor = ThreadPoolExecutor(max_workers=JOBS)
+    return _executor.map(function, items)
+
+
+def run(function: Callable[..., R], *iterables: Iterable) -> List[R]:
+    """Like imap, for functions with several arguments, and waits for all results."""
+    return list(imap(lambda args: function(*args), zip(*iterables)))